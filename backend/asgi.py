@@ -0,0 +1,517 @@
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+from werkzeug.wrappers import Request
+
+import server
+
+# ASGI で server.py を動かすためのエントリポイント
+#   - PDF変換・翻訳・解説・スレ生成・取り込みの進捗 (ingest_events) の SSE は async ハンドラで処理する
+#     (手順は Flask と共通の server.*_steps。LLM は astream、docling やファイル操作はスレッドプールで実行)
+#     → 1プロセスで多数の SSE ストリームを同時に保持できる
+#   - それ以外のエンドポイントは Flask アプリ (WSGI) を WSGI_WORKERS 個のスレッドで呼び出す
+#
+#   python asgi.py --workers 2 --port 5601 [--aoai]
+#   uvicorn asgi:app --workers 2 --port 5601   (モデルは環境変数 USE_AOAI / FAKE_LLM で指定)
+#
+#   docling は変換ワーカー (PDF_CONVERT_WORKERS) の中で初回変換時に読み込まれる
+
+# docling の変換は CPU・メモリを大きく使うため、同時実行数を絞る
+PDF_CONVERT_WORKERS = int(os.getenv("PDF_CONVERT_WORKERS", "1"))
+# 1 なら起動直後に変換ワーカーで docling を読み込んでおく (起動自体は待たせない)
+PRELOAD_DOCLING = os.getenv("PRELOAD_DOCLING", "0") == "1"
+# WSGI 側のレスポンスを受け渡すキューの長さ (遅いクライアントに対する背圧)
+WSGI_QUEUE_SIZE = 16
+# Flask (WSGI) のリクエストを処理するスレッド数 (超えた分は空くまで待つ)
+WSGI_WORKERS = int(os.getenv("WSGI_WORKERS", "32"))
+
+SSE_HEADERS = [
+    (b"content-type", b"text/event-stream; charset=utf-8"),
+    (b"cache-control", b"no-cache"),
+    (b"access-control-allow-origin", b"*"),
+    (b"vary", b"Accept-Encoding"),
+]
+
+class ClientDisconnected(Exception):
+    pass
+
+def get_header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        body.extend(message.get("body", b""))
+        if not message.get("more_body"):
+            return bytes(body)
+
+async def run_blocking(executor, func, *args):
+    """
+    スレッドプールで func を実行する。トレースの親 span を引き継ぐため contextvars をコピーして渡す
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args))
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def run_until_disconnect(receive, coro):
+    """
+    クライアントが切断したら coro をキャンセルする (LLM 呼び出しを無駄に続けない)。
+    戻り値: 最後まで処理できたら True
+    """
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait([task, watcher], return_when=asyncio.FIRST_COMPLETED)
+        if not task.done():
+            task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, ClientDisconnected):
+            return False
+        return True
+    finally:
+        watcher.cancel()
+
+########################################################################
+# SSE ハンドラ (async)
+########################################################################
+class EventStream:
+    """
+    SSE のレスポンスを送るためのヘルパー。Accept-Encoding に gzip があればイベントごとに圧縮する
+    """
+    def __init__(self, scope, send, span):
+        self.send = send
+        self.span = span
+        self.compressor = None
+        if server.SSE_COMPRESSION and parse_accept_header(get_header(scope, b"accept-encoding"))["gzip"] > 0:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    async def start(self):
+        headers = list(SSE_HEADERS) + [(b"x-request-id", self.span.request_id.encode("latin-1"))]
+        if self.compressor:
+            headers.append((b"content-encoding", b"gzip"))
+        await self.send({"type": "http.response.start", "status": 200, "headers": headers})
+        self.span.set("http.status_code", 200)
+        await self.event({"request_id": self.span.request_id})
+
+    async def event(self, data):
+        body = server.sse_event(data).encode("utf-8")
+        self.span.add("http.response.body.size", len(body))
+        if self.compressor:
+            body = self.compressor.compress(body) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        try:
+            await self.send({"type": "http.response.body", "body": body, "more_body": True})
+        except OSError:
+            raise ClientDisconnected()
+
+    async def end(self):
+        body = self.compressor.flush() if self.compressor else b""
+        try:
+            await self.send({"type": "http.response.body", "body": body, "more_body": False})
+        except OSError:
+            pass
+
+async def send_json(send, status, data, headers=()):
+    body = json.dumps(data).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"access-control-allow-origin", b"*"),
+        ] + list(headers),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def admit_request(scope, send, span, kind, username):
+    """
+    server.stream_with_admission の async 版 (受付)。上限を超えていれば 429 / 503 を返して None
+    """
+    queue = parse_qs(scope["query_string"].decode("latin-1")).get("queue") == ["1"]
+    try:
+        return server.admission.admit(kind, username, scope["path"], queue=queue)
+    except server.AdmissionRejected as e:
+        span.set("http.status_code", e.status)
+        await send_json(
+            send, e.status, {"error": str(e), "reason": e.reason, "retry_after": e.retry_after},
+            [(b"retry-after", str(e.retry_after).encode())],
+        )
+        return None
+
+async def run_admitted(stream, ticket, coro):
+    """
+    順番が来るまで {"queue_position": N} を送って待ち、それから coro を実行する
+    """
+    started = False
+    try:
+        deadline = time.monotonic() + server.ADMISSION_QUEUE_TIMEOUT
+        last_position = None
+        while True:
+            position = server.admission.poll(ticket)
+            if position is None:
+                break
+            if time.monotonic() > deadline:
+                error = server.AdmissionRejected("queue_timeout", server.admission.retry_after(ticket["kind"]))
+                await stream.event({"error": str(error), "reason": error.reason})
+                return
+            if position != last_position:
+                await stream.event({"queue_position": position})
+                last_position = position
+            await asyncio.sleep(server.ADMISSION_QUEUE_POLL_INTERVAL)
+        started = True
+        await coro
+    finally:
+        if not started:
+            coro.close()
+
+async def send_step_events(stream, steps):
+    """
+    server.iter_step_events の async 版。手順 (server.pdf2markdown_steps / generation_steps) の
+    ブロッキング処理はスレッドプールで、LLM は astream で実行する。
+    切断・キャンセルされたら手順も閉じる (手順側には GeneratorExit が届く)
+    """
+    streams = []
+    value = error = None
+    try:
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration:
+                return
+            value = error = None
+            if isinstance(step, server.Emit):
+                await stream.event(step.data)
+                continue
+            try:
+                if isinstance(step, server.Call):
+                    value = await run_blocking(None, step.func, *step.args)
+                elif isinstance(step, server.OpenLLMStream):
+                    value = server.astream_llm(step.route, step.messages, step.temperature)
+                    streams.append(value)
+                elif isinstance(step, server.NextChunk):
+                    try:
+                        value = await step.stream.__anext__()
+                    except StopAsyncIteration:
+                        value = None
+                elif isinstance(step, server.Sleep):
+                    await asyncio.sleep(step.seconds)
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+        for llm_stream in streams:
+            await llm_stream.aclose()
+
+GENERATION_ROUTES = {
+    "/trans_markdown": server.TRANS_SPEC,
+    "/explain_paper": server.EXPLAIN_SPEC,
+    "/thread_paper": server.THREAD_SPEC,
+}
+
+########################################################################
+# WSGI (Flask) へのブリッジ
+#   Flask のリクエストコンテキストはスレッドに紐づくため、1リクエストを1スレッドで最後まで処理する。
+#   スレッドは WSGI_WORKERS 個のプールから使う (リクエストごとにスレッドを作らない)
+########################################################################
+def build_environ(scope, body):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for key, value in scope["headers"]:
+        name = key.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name == "CONTENT_LENGTH":
+            continue
+        else:
+            name = f"HTTP_{name}"
+            environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+def run_wsgi_app(wsgi_app, environ, loop, queue, disconnected):
+    """
+    別スレッドで WSGI アプリを実行し、レスポンスを asyncio のキューへ流す
+    """
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        put(("start", status, headers))
+        return lambda data: put(("body", data))
+
+    # プールの空きを待っている間に切断されたリクエストは処理しない
+    if disconnected.is_set():
+        put(("end",))
+        return
+
+    result = None
+    try:
+        result = wsgi_app(environ, start_response)
+        for chunk in result:
+            if chunk:
+                put(("body", chunk))
+            if disconnected.is_set():
+                break
+    except Exception:
+        traceback.print_exc()
+        put(("error",))
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+        put(("end",))
+
+async def call_wsgi(wsgi_app, executor, scope, receive, send):
+    body = await read_body(receive)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(WSGI_QUEUE_SIZE)
+    disconnected = threading.Event()
+    executor.submit(run_wsgi_app, wsgi_app, build_environ(scope, body), loop, queue, disconnected)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    watcher.add_done_callback(lambda _: disconnected.set())
+
+    started = False
+    try:
+        while True:
+            item = await queue.get()
+            if item[0] == "end":
+                break
+            # 切断後もスレッドが止まるまでキューは空にし続ける
+            if disconnected.is_set():
+                continue
+            try:
+                if item[0] == "start":
+                    status, headers = item[1], item[2]
+                    await send({
+                        "type": "http.response.start",
+                        "status": int(status.split(" ", 1)[0]),
+                        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+                    })
+                    started = True
+                elif item[0] == "body":
+                    await send({"type": "http.response.body", "body": item[1], "more_body": True})
+                elif item[0] == "error" and not started:
+                    await send_json(send, 500, {"error": "Internal Server Error"})
+                    disconnected.set()
+            except OSError:
+                disconnected.set()
+        if not disconnected.is_set():
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        watcher.cancel()
+
+########################################################################
+# ASGI アプリ
+########################################################################
+class PaperAsgiApp:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.convert_executor = ThreadPoolExecutor(
+            max_workers=PDF_CONVERT_WORKERS, thread_name_prefix="pdf-convert"
+        )
+        self.wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_WORKERS, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        try:
+            if scope["method"] == "POST" and scope["path"] == "/pdf2markdown":
+                await self.traced(scope, self.handle_pdf2markdown, receive, send)
+            elif scope["method"] == "POST" and scope["path"] in GENERATION_ROUTES:
+                spec = GENERATION_ROUTES[scope["path"]]
+                await self.traced(scope, functools.partial(self.handle_generation, spec=spec), receive, send)
+            elif scope["method"] == "GET" and scope["path"] == "/ingest_events":
+                await self.traced(scope, self.handle_ingest_events, receive, send)
+            else:
+                # Flask 側のフック (before_request など) でトレースされる
+                await call_wsgi(self.wsgi_app, self.wsgi_executor, scope, receive, send)
+        except ClientDisconnected:
+            pass
+
+    async def traced(self, scope, handler, receive, send):
+        """
+        root span を開始して handler を実行する (Flask の start_request_trace に相当)
+        """
+        headers = Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]])
+        span = server.start_request_span(
+            f"{scope['method']} {scope['path']}", headers,
+            **{"http.method": scope["method"], "http.route": scope["path"]}
+        )
+        server.set_current_span(span)
+        error = None
+        try:
+            await handler(scope, receive, send, span)
+        except ClientDisconnected:
+            span.set("cancelled", True)
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            span.end(error=error)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # 再起動で中断された本変換を片付ける (他のワーカーで実行中のものはロックで見分ける)
+                reconciled = await run_blocking(None, server.reconcile_ingest_jobs)
+                if reconciled:
+                    print(f">>> 中断された本変換を {reconciled} 件片付けました。")
+                if PRELOAD_DOCLING:
+                    self.convert_executor.submit(server.preload_docling)
+                if server.PREGEN_ENABLED:
+                    # 複数ワーカーの場合も実行するのは1プロセスのみ
+                    server.pregen.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.convert_executor.shutdown(wait=False)
+                self.wsgi_executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def handle_pdf2markdown(self, scope, receive, send, span):
+        body = await read_body(receive)
+        environ = build_environ(scope, body)
+        username = Request(environ).args.get("username")
+        if not username:
+            span.set("http.status_code", 400)
+            await send_json(send, 400, {"error": "username is required"})
+            return
+
+        ticket = await admit_request(scope, send, span, "convert", username)
+        if ticket is None:
+            return
+        try:
+            stream = EventStream(scope, send, span)
+            await stream.start()
+            # 本変換は変換ワーカーで続け、ここでは進捗を中継する (切断しても変換は止めない)
+            steps = server.pdf2markdown_steps(Request(environ), username, ticket, self.convert_executor)
+            completed = await run_until_disconnect(
+                receive, run_admitted(stream, ticket, send_step_events(stream, steps))
+            )
+            if not completed:
+                span.set("cancelled", True)
+            await stream.end()
+        finally:
+            server.admission.release(ticket)
+
+    async def handle_generation(self, scope, receive, send, span, spec):
+        body = await read_body(receive)
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+
+        ticket = await admit_request(scope, send, span, "generate", server.generation_username(data))
+        if ticket is None:
+            return
+        try:
+            stream = EventStream(scope, send, span)
+            await stream.start()
+            completed = await run_until_disconnect(
+                receive, run_admitted(stream, ticket, send_step_events(stream, server.generation_steps(spec, data)))
+            )
+            if not completed:
+                span.set("cancelled", True)
+            await stream.end()
+        finally:
+            server.admission.release(ticket)
+
+    async def handle_ingest_events(self, scope, receive, send, span):
+        """
+        server.ingest_events の async 版 (変換が終わるまで続くので WSGI のスレッドを使わない)
+        """
+        dir_name = parse_qs(scope["query_string"].decode("latin-1")).get("dir_name", [""])[0]
+        if not dir_name:
+            span.set("http.status_code", 400)
+            await send_json(send, 400, {"error": "dir_name is required"})
+            return
+        steps = await run_blocking(None, server.open_ingest_steps, dir_name)
+        if steps is None:
+            span.set("http.status_code", 404)
+            await send_json(send, 404, {"error": "No ingest job for this directory"})
+            return
+
+        stream = EventStream(scope, send, span)
+        await stream.start()
+        completed = await run_until_disconnect(receive, send_step_events(stream, steps))
+        if not completed:
+            span.set("cancelled", True)
+        await stream.end()
+
+app = PaperAsgiApp(server.app)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aoai', action='store_true', help="Use AzureOpenAI instead of ChatOpenAI")
+    parser.add_argument('--fake_llm', action='store_true',
+                        help="Use a fake streaming model (for load testing without API calls)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5601)
+    parser.add_argument('--workers', type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")))
+    parser.add_argument('--preload_docling', action='store_true',
+                        help="Import docling in the conversion worker right after startup")
+    args = parser.parse_args()
+
+    # ワーカープロセスは asgi.py を import し直すため、設定は環境変数で渡す
+    if args.aoai:
+        os.environ["USE_AOAI"] = "1"
+    if args.fake_llm:
+        os.environ["FAKE_LLM"] = "1"
+    if args.preload_docling:
+        os.environ["PRELOAD_DOCLING"] = "1"
+
+    uvicorn.run("asgi:app", host=args.host, port=args.port, workers=args.workers,
+                timeout_graceful_shutdown=10)
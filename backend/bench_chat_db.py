@@ -0,0 +1,105 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import server
+
+# チャット履歴DBへの書き込み性能を計測するマイクロベンチマーク
+#   legacy : 旧実装 (ensure_user_db_exists で接続→CREATE→close、再接続→INSERT→commit→close)
+#   pooled : 現行実装 (server.save_chat_message / bulk_save_chat 相当の executemany)
+#
+#   python bench_chat_db.py --n 2000
+
+def legacy_save_chat_message(db_path, session_id, role, content):
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dir_name TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT (datetime('now','+9 hours'))
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(session_id) REFERENCES chat_sessions(id)
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO chat_messages (session_id, role, content)
+        VALUES (?, ?, ?)
+    ''', (session_id, role, content))
+    conn.commit()
+    conn.close()
+
+def legacy_bulk_save_chat(db_path, session_id, messages):
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    cursor = conn.cursor()
+    for m in messages:
+        cursor.execute('''
+            INSERT INTO chat_messages (session_id, role, content)
+            VALUES (?, ?, ?)
+        ''', (session_id, m['role'], m['content']))
+    conn.commit()
+    conn.close()
+
+def report(label, n, elapsed):
+    print(f"{label:<28} {n:>6} writes  {elapsed:8.3f} s  {n / elapsed:10.1f} writes/s")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=1000, help="書き込み件数")
+    args = parser.parse_args()
+
+    content = '[{"type": "text", "text": "この論文の提案手法を教えてください。"}]'
+    messages = [{'role': 'user', 'content': content}] * args.n
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server.CONTENT_DATA_DIR = tmp_dir
+
+        # 旧実装 (ロールバックジャーナル、1件ごとに2接続)
+        legacy_path = os.path.join(tmp_dir, 'legacy.db')
+        start = time.perf_counter()
+        for _ in range(args.n):
+            legacy_save_chat_message(legacy_path, 1, 'user', content)
+        report("legacy save_chat_message", args.n, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        legacy_bulk_save_chat(legacy_path, 1, messages)
+        report("legacy bulk (execute loop)", args.n, time.perf_counter() - start)
+
+        # 現行実装 (プール + WAL)
+        with server.user_db('bench_user') as conn:
+            session_id = conn.execute(
+                'INSERT INTO chat_sessions (dir_name) VALUES (?)', ('bench_user/bench',)
+            ).lastrowid
+
+        start = time.perf_counter()
+        for _ in range(args.n):
+            server.save_chat_message('bench_user', session_id, 'user', content)
+        report("pooled save_chat_message", args.n, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with server.user_db('bench_user') as conn:
+            conn.executemany('''
+                INSERT INTO chat_messages (session_id, role, content)
+                VALUES (?, ?, ?)
+            ''', [(session_id, m['role'], m['content']) for m in messages])
+        report("pooled bulk (executemany)", args.n, time.perf_counter() - start)
+
+        server.close_db_pool(server.get_user_db_path('bench_user'))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+# PDF変換 (docling) のオフライン・ベンチマーク
+#   再現可能なコーパス (テキストのみ・図が多い・長文・表が多い・スキャン) を生成し、
+#   設定 (BENCH_CONFIGS) ごとに server.py と同じ変換処理を実行して JSON で結果を出力する。
+#   1件ごとに別プロセスで実行するため、ピークRSSは1件の変換のみの値になる。
+#
+#   python bench_pdf_convert.py --output result.json
+#   python bench_pdf_convert.py --configs default,tables_fast --docs tables --baseline result.json
+#
+#   ネットワーク・GPU は使わない (HF_HUB_OFFLINE=1 / CUDA_VISIBLE_DEVICES="")。
+#   docling のモデルは事前にダウンロードしておくこと。
+
+# server.PDF_PIPELINE_DEFAULTS への上書き
+BENCH_CONFIGS = {
+    "default": {},
+    "scale1": {"images_scale": 1.0},
+    "no_images": {"generate_picture_images": False, "generate_table_images": False},
+    "tables_fast": {"do_table_structure": True, "table_mode": "fast"},
+    "tables_accurate": {"do_table_structure": True, "table_mode": "accurate"},
+    "ocr": {"do_ocr": True},
+    "ocr_off": {"ocr_mode": "off"},
+    "tables_off": {"table_policy": "off"},
+}
+
+CORPUS_VERSION = 1
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+MARGIN = 72
+
+WORDS = (
+    "model attention layer training data network learning results method performance "
+    "transformer token sequence encoder decoder representation feature loss gradient "
+    "dataset benchmark evaluation accuracy baseline parameter inference latency memory "
+    "proposed approach experiment analysis section figure table we our show that the of "
+    "and to in for with on is are this by from as which can be"
+).split()
+
+########################################################################
+# 最小限の PDF 書き出し (外部ライブラリ不要・日時などを含めないのでバイト単位で再現可能)
+########################################################################
+class SimplePdf:
+    def __init__(self):
+        # 1: Catalog, 2: Pages, 3: Helvetica, 4: Helvetica-Bold
+        self.objects = [None, None,
+                        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+                        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold >>"]
+        self.page_ids = []
+
+    def add(self, body):
+        self.objects.append(body)
+        return len(self.objects)
+
+    def add_stream(self, entries, data):
+        return self.add(b"<< " + entries.encode() + b" /Length %d >>\nstream\n" % len(data) + data + b"\nendstream")
+
+    def add_image(self, width, height, data, color_space="/DeviceRGB", filter_name="/FlateDecode"):
+        if filter_name == "/FlateDecode":
+            data = zlib.compress(data, 6)
+        return self.add_stream(
+            f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace {color_space} /BitsPerComponent 8 /Filter {filter_name}", data
+        )
+
+    def add_page(self, content, images=None):
+        xobjects = " ".join(f"/Im{i} {obj_id} 0 R" for i, obj_id in enumerate(images or []))
+        contents_id = self.add_stream("/Filter /FlateDecode", zlib.compress(content.encode("latin-1"), 6))
+        page_id = self.add(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> /XObject << {xobjects} >> >> "
+            f"/Contents {contents_id} 0 R >>".encode()
+        )
+        self.page_ids.append(page_id)
+
+    def save(self, path):
+        kids = " ".join(f"{i} 0 R" for i in self.page_ids)
+        self.objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+        self.objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>".encode()
+
+        out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets = []
+        for i, body in enumerate(self.objects, start=1):
+            offsets.append(len(out))
+            out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+        xref = len(out)
+        out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(self.objects) + 1)
+        for offset in offsets:
+            out += b"%010d 00000 n \n" % offset
+        out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(self.objects) + 1, xref)
+        with open(path, "wb") as f:
+            f.write(out)
+
+def pdf_text(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+class PageBuilder:
+    """
+    上から順にテキスト・図・表を配置してページの content stream を作る
+    """
+    def __init__(self):
+        self.ops = []
+        self.images = []
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def room(self, height):
+        return self.y - height >= MARGIN
+
+    def text(self, line, font="F1", size=10, leading=13):
+        self.ops.append(f"BT /{font} {size} Tf {MARGIN} {self.y - size} Td {pdf_text(line)} Tj ET")
+        self.y -= leading
+
+    def paragraph(self, rng, n_lines):
+        for _ in range(n_lines):
+            if not self.room(13):
+                return
+            self.text(" ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 13))))
+        self.y -= 6
+
+    def heading(self, title):
+        self.y -= 6
+        self.text(title, font="F2", size=13, leading=20)
+
+    def image(self, image_id, width, height, caption):
+        self.y -= height
+        self.ops.append(f"q {width} 0 0 {height} {MARGIN} {self.y} cm /Im{len(self.images)} Do Q")
+        self.images.append(image_id)
+        self.y -= 6
+        self.text(caption, size=9, leading=18)
+
+    def table(self, rng, rows, cols, caption):
+        self.text(caption, size=9, leading=16)
+        cell_w = (PAGE_WIDTH - 2 * MARGIN) / cols
+        cell_h = 16
+        top = self.y
+        for r in range(rows):
+            for c in range(cols):
+                x = MARGIN + c * cell_w
+                y = top - (r + 1) * cell_h
+                self.ops.append(f"{x:.1f} {y:.1f} {cell_w:.1f} {cell_h} re S")
+                label = rng.choice(WORDS) if r == 0 or c == 0 else f"{rng.uniform(0, 100):.1f}"
+                font = "F2" if r == 0 else "F1"
+                self.ops.append(f"BT /{font} 8 Tf {x + 3:.1f} {y + 5:.1f} Td {pdf_text(label)} Tj ET")
+        self.y = top - rows * cell_h - 14
+
+    def content(self):
+        return "\n".join(self.ops)
+
+def make_chart_pixels(rng, width, height):
+    """
+    棒グラフ風の RGB 画像 (図の代わり)
+    """
+    pixels = bytearray(b"\xff" * (width * height * 3))
+    n_bars = rng.randint(5, 12)
+    bar_w = width // (n_bars * 2)
+    for i in range(n_bars):
+        color = bytes(rng.randrange(30, 220) for _ in range(3))
+        bar_h = rng.randint(height // 8, height - 10)
+        x0 = bar_w // 2 + i * bar_w * 2
+        for y in range(height - bar_h, height):
+            offset = (y * width + x0) * 3
+            pixels[offset:offset + bar_w * 3] = color * bar_w
+    # 軸
+    for y in range(height):
+        offset = (y * width + 2) * 3
+        pixels[offset:offset + 6] = b"\x00" * 6
+    pixels[(height - 3) * width * 3:(height - 1) * width * 3] = b"\x00" * (width * 6)
+    return bytes(pixels)
+
+def build_document(kind, seed):
+    rng = random.Random(f"{kind}-{seed}")
+    pdf = SimplePdf()
+    n_pages = {"text": 5, "figures": 6, "tables": 5, "long": 40}[kind]
+    figure_no = table_no = section_no = 0
+    for page_no in range(n_pages):
+        page = PageBuilder()
+        if page_no == 0:
+            page.text(f"Synthetic Benchmark Paper: {kind}", font="F2", size=16, leading=28)
+        while page.room(60):
+            section_no += 1
+            page.heading(f"{section_no} {rng.choice(WORDS).capitalize()} {rng.choice(WORDS)}")
+            # 図・表の多い文書は段落を短くして1ページに多く載せる
+            page.paragraph(rng, rng.randint(2, 4) if kind in ("figures", "tables") else rng.randint(4, 9))
+            if kind == "figures" and page.room(230):
+                figure_no += 1
+                width, height = 360, 200
+                image_id = pdf.add_image(width, height, make_chart_pixels(rng, width, height))
+                page.image(image_id, width, height, f"Figure {figure_no}: {' '.join(rng.choice(WORDS) for _ in range(8))}")
+            if kind == "tables" and page.room(150):
+                table_no += 1
+                page.table(rng, rng.randint(5, 7), rng.randint(4, 6), f"Table {table_no}: results on {rng.choice(WORDS)}")
+        pdf.add_page(page.content(), page.images)
+    return pdf
+
+def build_scanned_document(source_path, output_path, dpi=150):
+    """
+    テキストPDFを画像化し、画像のみのPDF (スキャン相当) を作る。pypdfium2 / Pillow は docling の依存
+    """
+    import pypdfium2
+    from io import BytesIO
+
+    pdf = SimplePdf()
+    document = pypdfium2.PdfDocument(source_path)
+    for index in range(len(document)):
+        image = document[index].render(scale=dpi / 72).to_pil().convert("L")
+        buffer = BytesIO()
+        image.save(buffer, "JPEG", quality=75)
+        image_id = pdf.add_image(image.width, image.height, buffer.getvalue(), "/DeviceGray", "/DCTDecode")
+        pdf.add_page(f"q {PAGE_WIDTH} 0 0 {PAGE_HEIGHT} 0 0 cm /Im0 Do Q", [image_id])
+    document.close()
+    pdf.save(output_path)
+
+CORPUS_KINDS = ("text", "figures", "long", "tables", "scanned")
+
+def ensure_corpus(corpus_dir, seed):
+    """
+    コーパスを生成する (既にあれば再利用)。戻り値: {名前: パス}
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    paths = {}
+    for kind in CORPUS_KINDS:
+        path = os.path.join(corpus_dir, f"v{CORPUS_VERSION}_{kind}_{seed}.pdf")
+        if not os.path.exists(path):
+            if kind == "scanned":
+                build_scanned_document(paths["text"], path)
+            else:
+                build_document(kind, seed).save(path)
+        paths[kind] = path
+    # 手持ちの PDF を置いておけば一緒に計測する
+    for file_name in sorted(os.listdir(corpus_dir)):
+        if file_name.lower().endswith(".pdf") and not file_name.startswith(f"v{CORPUS_VERSION}_"):
+            paths[os.path.splitext(file_name)[0]] = os.path.join(corpus_dir, file_name)
+    return paths
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+########################################################################
+# 計測 (子プロセス)
+########################################################################
+def run_worker(config_name, pdf_path, repeat):
+    """
+    1つの (設定, PDF) を repeat 回変換し、結果を JSON で標準出力に書く
+    """
+    import server
+
+    overrides = BENCH_CONFIGS[config_name]
+    ocr_mode = overrides.get("ocr_mode", server.PDF_PIPELINE_DEFAULTS["ocr_mode"])
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as output_dir:
+            started = time.perf_counter()
+            page_sources = server.detect_page_sources(pdf_path, ocr_mode)
+            conv_res = server.convert_pdf_adaptive(pdf_path, page_sources, **overrides)
+            converted = time.perf_counter()
+            tables, pictures = server.save_element_images(conv_res, output_dir)
+            saved = time.perf_counter()
+            md_text = server.export_markdown(conv_res)
+            finished = time.perf_counter()
+            image_bytes = sum(os.path.getsize(os.path.join(output_dir, f)) for f in os.listdir(output_dir))
+        runs.append({
+            "pages": len(conv_res.pages),
+            "ocr_pages": page_sources.count("ocr"),
+            "convert_seconds": converted - started,
+            "images_seconds": saved - converted,
+            "markdown_seconds": finished - saved,
+            "total_seconds": finished - started,
+            "tables": tables,
+            "pictures": pictures,
+            "image_bytes": image_bytes,
+            "markdown_bytes": len(md_text.encode("utf-8")),
+        })
+
+    # 1回目はモデル読み込みを含む (cold)。2回目以降の最速値を warm とする
+    warm = min(runs[1:], key=lambda r: r["total_seconds"]) if len(runs) > 1 else runs[0]
+    result = dict(warm)
+    result["pages_per_second"] = warm["pages"] / warm["total_seconds"] if warm["total_seconds"] else None
+    result["cold_total_seconds"] = runs[0]["total_seconds"]
+    # Linux では KiB 単位
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
+
+def run_case(config_name, doc_name, pdf_path, repeat, timeout):
+    env = dict(os.environ, HF_HUB_OFFLINE="1", CUDA_VISIBLE_DEVICES="", TRACING="0")
+    command = [sys.executable, os.path.abspath(__file__), "--worker", config_name, pdf_path, "--repeat", str(repeat)]
+    try:
+        proc = subprocess.run(command, capture_output=True, text=True, env=env, timeout=timeout,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return {"config": config_name, "doc": doc_name, "error": f"timeout ({timeout}s)"}
+    if proc.returncode != 0:
+        return {"config": config_name, "doc": doc_name, "error": proc.stderr.strip().splitlines()[-1:]}
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    return {"config": config_name, "doc": doc_name, **result}
+
+def get_environment():
+    def command_output(command):
+        try:
+            return subprocess.run(command, capture_output=True, text=True, timeout=10).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    try:
+        from importlib.metadata import version
+        docling_version = version("docling")
+    except Exception:
+        docling_version = None
+    return {
+        "git_commit": command_output(["git", "rev-parse", "--short", "HEAD"]),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "docling": docling_version,
+    }
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["config"], r["doc"]): r for r in json.load(f)["results"]}
+    print(f"{'config':<16} {'doc':<10} {'pages/s':>9} {'baseline':>9} {'ratio':>7} {'rss MB':>8}")
+    for r in results:
+        base = baseline.get((r["config"], r["doc"]))
+        if "error" in r or not base or "error" in base:
+            print(f"{r['config']:<16} {r['doc']:<10} {'-':>9}")
+            continue
+        ratio = r["pages_per_second"] / base["pages_per_second"]
+        print(f"{r['config']:<16} {r['doc']:<10} {r['pages_per_second']:>9.2f} "
+              f"{base['pages_per_second']:>9.2f} {ratio:>6.2f}x {r['peak_rss_mb']:>8.0f}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', default="default,scale1,no_images,tables_fast",
+                        help=f"カンマ区切り ({', '.join(BENCH_CONFIGS)})")
+    parser.add_argument('--docs', default=",".join(CORPUS_KINDS), help="カンマ区切り (コーパス内のPDF名)")
+    parser.add_argument('--corpus_dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "bench_corpus"))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=2, help="1件あたりの変換回数 (1回目は cold)")
+    parser.add_argument('--timeout', type=float, default=1800)
+    parser.add_argument('--output', help="結果 JSON の出力先 (省略時は標準出力)")
+    parser.add_argument('--baseline', help="比較対象の結果 JSON")
+    parser.add_argument('--make_corpus', action='store_true', help="コーパスを生成して終了")
+    parser.add_argument('--worker', nargs=2, metavar=('CONFIG', 'PDF'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker[0], args.worker[1], args.repeat)
+        return
+
+    corpus = ensure_corpus(args.corpus_dir, args.seed)
+    if args.make_corpus:
+        for name, path in corpus.items():
+            print(f"{name:<10} {os.path.getsize(path):>10} bytes  {path}")
+        return
+
+    config_names = args.configs.split(",")
+    doc_names = args.docs.split(",")
+    unknown = [c for c in config_names if c not in BENCH_CONFIGS] + [d for d in doc_names if d not in corpus]
+    if unknown:
+        parser.error(f"unknown config/doc: {', '.join(unknown)}")
+
+    results = []
+    for config_name in config_names:
+        for doc_name in doc_names:
+            result = run_case(config_name, doc_name, corpus[doc_name], args.repeat, args.timeout)
+            print(f">>> {config_name} / {doc_name}: "
+                  + (f"{result['pages_per_second']:.2f} pages/s" if "error" not in result else str(result["error"])),
+                  file=sys.stderr)
+            results.append(result)
+
+    report = {
+        "environment": get_environment(),
+        "corpus": {name: {"sha256": file_sha256(path), "bytes": os.path.getsize(path)} for name, path in corpus.items()},
+        "configs": {name: BENCH_CONFIGS[name] for name in config_names},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        print_comparison(results, args.baseline)
+
+if __name__ == "__main__":
+    main()
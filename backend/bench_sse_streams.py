@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+# SSE ストリームの同時接続数を計測する負荷試験ツール
+#   ダミーモデルで起動したサーバーに対して、N 本の SSE を同時に張り、
+#   最初のイベントまでの時間・完走数・所要時間を表示する。
+#
+#   同時実行数の制限 (MAX_CONCURRENT_GENERATIONS / MAX_USER_GENERATIONS) は上げておく
+#
+#   MAX_CONCURRENT_GENERATIONS=1000 MAX_USER_GENERATIONS=1000 python server.py --fake_llm
+#   MAX_CONCURRENT_GENERATIONS=1000 MAX_USER_GENERATIONS=1000 python asgi.py --fake_llm --workers 1
+#   python bench_sse_streams.py --dir_name user/20240101000000_paper --n 200
+
+async def open_stream(session, url, payload, result):
+    start = time.perf_counter()
+    try:
+        async with session.post(url, json=payload) as response:
+            if response.status != 200:
+                result["error"] = f"HTTP {response.status}"
+                return
+            async for line in response.content:
+                if not line.startswith(b"data: "):
+                    continue
+                if "first_event" not in result:
+                    result["first_event"] = time.perf_counter() - start
+                data = json.loads(line[6:])
+                if "error" in data:
+                    result["error"] = data["error"]
+                    return
+                if data.get("llm_output") == "$=~=$end$=~=$":
+                    result["completed"] = True
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        result["elapsed"] = time.perf_counter() - start
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def run(args):
+    url = f"{args.url.rstrip('/')}/{args.endpoint.lstrip('/')}"
+    payload = {"dir_name": args.dir_name}
+    results = [{} for _ in range(args.n)]
+
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[open_stream(session, url, payload, r) for r in results])
+        total = time.perf_counter() - start
+
+    first_events = [r["first_event"] for r in results if "first_event" in r]
+    completed = sum(1 for r in results if r.get("completed"))
+    errors = [r["error"] for r in results if "error" in r]
+
+    print(f"streams        : {args.n}")
+    print(f"held (1st evt) : {len(first_events)}")
+    print(f"completed      : {completed}")
+    print(f"errors         : {len(errors)}" + (f"  (e.g. {errors[0]})" if errors else ""))
+    print(f"first event p50: {percentile(first_events, 0.5):.3f} s")
+    print(f"first event p95: {percentile(first_events, 0.95):.3f} s")
+    print(f"total          : {total:.3f} s")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default="http://localhost:5601")
+    parser.add_argument('--endpoint', default="/trans_markdown")
+    parser.add_argument('--dir_name', required=True, help="username/subdir (_origin.md があるディレクトリ)")
+    parser.add_argument('--n', type=int, default=100, help="同時ストリーム数")
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+# server.py の import 時間の内訳を表示する (python -X importtime を集計)
+#   起動時間が予算を超えた場合、または重いモジュールが起動時に読み込まれた場合は終了コード 1 を返す
+#
+#   python profile_startup.py --top 20 --budget 2.0
+
+HEAVY_MODULES = ("docling", "docling_core", "langchain_openai", "langgraph", "langchain_community")
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def profile_imports(module):
+    """
+    戻り値: (トップレベルパッケージごとの秒数, 読み込まれた全モジュール名, 全体の秒数)
+    """
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=backend_dir, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        raise SystemExit(result.returncode)
+
+    by_package = defaultdict(float)
+    modules = set()
+    total = 0.0
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, _cumulative_us, _indent, name = match.groups()
+        modules.add(name)
+        # 子モジュールの時間を二重に数えないよう、自身の時間 (self) をパッケージ単位で合計する
+        seconds = int(self_us) / 1e6
+        by_package[name.split(".")[0]] += seconds
+        total += seconds
+    return by_package, modules, total
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default="server", help="計測するモジュール (server / asgi)")
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--budget', type=float, default=float(os.getenv("STARTUP_BUDGET_SECONDS", "2.0")))
+    args = parser.parse_args()
+
+    by_package, modules, total = profile_imports(args.module)
+
+    print(f"{'package':<32} {'seconds':>10}")
+    for name, seconds in sorted(by_package.items(), key=lambda x: -x[1])[:args.top]:
+        print(f"{name:<32} {seconds:>9.3f}s")
+    print(f"{'total':<32} {total:>9.3f}s  (budget {args.budget:.2f}s)")
+
+    loaded = [name for name in HEAVY_MODULES if name in modules]
+    failed = False
+    if total > args.budget:
+        print(f"NG: import に {total:.2f}s かかっています (予算 {args.budget:.2f}s)")
+        failed = True
+    if loaded:
+        print(f"NG: 起動時に重いモジュールが読み込まれています: {', '.join(loaded)}")
+        failed = True
+    if not failed:
+        print("OK")
+    raise SystemExit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,343 @@
+import time
+# 起動時間の計測開始 (check_startup_budget で使用)
+BOOT_STARTED_AT = time.perf_counter()
+
 import argparse
 import shutil
 import glob
 import os
+import sys
 import json
-import time
-from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, send_file
+import re
+import contextvars
+import functools
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, send_file, g
 from flask_cors import CORS
 import requests
 from io import BytesIO
+from urllib.parse import quote as url_quote
 import traceback
+import threading
+import hashlib
+import secrets
+import gzip
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 from dotenv import load_dotenv
 import zipfile
 
 import sqlite3
 
-# ChatOpenAI と AzureChatOpenAI
-from langchain_openai import ChatOpenAI, AzureChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage
-from langchain_community.callbacks.manager import get_openai_callback
-
-from typing import Annotated
-from typing_extensions import TypedDict
-from langgraph.graph import StateGraph
-from langgraph.graph.message import add_messages
-from langchain_core.prompts import PromptTemplate
-
-from docling.datamodel.base_models import InputFormat
-from docling.datamodel.pipeline_options import (
-    PdfPipelineOptions,
-    TableFormerMode,
-)
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling_core.types.doc import PictureItem, TableItem
+# docling / langchain_openai / langgraph / langchain_community は import が重いため、
+# 使う関数の中で import する (一覧・チャット履歴などの軽いリクエストや起動を速くする)
+
+# 任意の圧縮ライブラリ (無ければ gzip のみ)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # .envファイルから環境変数を読み込み
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app)
+# pdf.js の Range 読み込みで必要なヘッダーとリクエストIDをクロスオリジンでも参照できるようにする
+CORS(app, expose_headers=['Accept-Ranges', 'Content-Range', 'Content-Length', 'ETag', 'X-Request-ID'])
 
 # --- ここで Flask のグローバルな config に CHAT_MODEL 用のキーを用意しておく ---
 app.config["CHAT_MODEL"] = None
+# モデルは初回使用時に生成する (get_chat_model)。ASGI のワーカーは環境変数で指定を受け取る
+app.config["CHAT_MODEL_OPTIONS"] = {
+    "use_aoai": os.getenv("USE_AOAI") == "1",
+    "fake_llm": os.getenv("FAKE_LLM") == "1",
+}
 
 ########################################################################
 # ① CONTENT_DATA_DIR を /home/ubuntu/workspace/users に変更
 #    (ユーザー別ディレクトリ管理)
 ########################################################################
-CONTENT_DATA_DIR = "/home/ubuntu/workspace/users"
+CONTENT_DATA_DIR = os.getenv("CONTENT_DATA_DIR", "/home/ubuntu/workspace/users")
 os.makedirs(CONTENT_DATA_DIR, exist_ok=True)
 
+# 再生成可能なキャッシュ (zip など) の置き場。ユーザーディレクトリの外に置く
+CACHE_DIR = os.getenv("CACHE_DIR", "/home/ubuntu/workspace/cache")
+
+########################################################################
+# トレース (処理段階ごとの所要時間・バイト数・件数の記録)
+#   OpenTelemetry の OTLP/JSON 形式 (ファイルエクスポーターと同じ1行1レコード) で
+#   TRACE_LOG_PATH に追記する。otelcol の otlpjsonfile レシーバーなどでそのまま読み込める。
+#
+#   with trace_span("pdf.convert", pages=10) as span:
+#       ...
+#       span.set("bytes", n)
+########################################################################
+TRACING_ENABLED = os.getenv("TRACING", "1") == "1"
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", os.path.join(CACHE_DIR, "trace", "spans.jsonl"))
+# 超えたら spans.jsonl.1 へローテーションする
+TRACE_LOG_MAX_BYTES = int(os.getenv("TRACE_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_SERVICE_NAME = "survey-copilot-backend"
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_STATUS_OK = 1
+SPAN_STATUS_ERROR = 2
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_trace_log_lock = threading.Lock()
+_trace_log_file = None
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, kind=SPAN_KIND_INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self.request_id = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def add(self, key, value=1):
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def end(self, error=None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        write_span(self)
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+def to_otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def span_to_otlp(span):
+    record = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": k, "value": to_otlp_value(v)} for k, v in span.attributes.items()],
+        "status": {"code": SPAN_STATUS_ERROR, "message": span.error} if span.error else {"code": SPAN_STATUS_OK},
+    }
+    if span.parent_id:
+        record["parentSpanId"] = span.parent_id
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}},
+                {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+            ]},
+            "scopeSpans": [{"scope": {"name": "server"}, "spans": [record]}],
+        }]
+    }
+
+def write_span(span):
+    global _trace_log_file
+    if not TRACING_ENABLED:
+        return
+    line = json.dumps(span_to_otlp(span), ensure_ascii=False) + "\n"
+    try:
+        with _trace_log_lock:
+            if _trace_log_file is None:
+                os.makedirs(os.path.dirname(TRACE_LOG_PATH), exist_ok=True)
+                _trace_log_file = open(TRACE_LOG_PATH, "a", encoding="utf-8")
+            _trace_log_file.write(line)
+            _trace_log_file.flush()
+            if _trace_log_file.tell() > TRACE_LOG_MAX_BYTES:
+                _trace_log_file.close()
+                os.replace(TRACE_LOG_PATH, TRACE_LOG_PATH + ".1")
+                _trace_log_file = None
+    except OSError:
+        traceback.print_exc()
+
+def start_span(name, parent=None, **attributes):
+    """
+    span を開始する (終了は span.end())。parent を省略した場合は現在の span の子になる
+    """
+    parent = parent or _current_span.get()
+    if parent is None:
+        return Span(name, os.urandom(16).hex(), attributes=attributes)
+    span = Span(name, parent.trace_id, parent.span_id, attributes=attributes)
+    span.request_id = parent.request_id
+    return span
+
+@contextmanager
+def trace_span(name, parent=None, **attributes):
+    """
+    with の範囲を span として記録する。例外は span にエラーとして記録してから再送出する
+    """
+    span = start_span(name, parent=parent, **attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        # クライアント切断によるキャンセルはエラー扱いにしない
+        if isinstance(e, GeneratorExit) or type(e).__name__ == "CancelledError":
+            span.set("cancelled", True)
+        else:
+            span.end(error=e)
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # ジェネレータが別のコンテキストで閉じられた場合
+            pass
+        span.end()
+
+def set_current_span(span):
+    """
+    以降に開始する span の親を span にする (リクエスト処理の先頭で root span を設定する)
+    """
+    _current_span.set(span)
+
+def current_request_id():
+    span = _current_span.get()
+    return span.request_id if span else None
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+TRACEPARENT_PATTERN = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+def start_request_span(name, headers, **attributes):
+    """
+    リクエスト全体の root span を開始する。
+    W3C traceparent があればそのトレースに参加し、X-Request-ID があればそれをリクエストIDにする
+    """
+    trace_id = parent_id = None
+    match = TRACEPARENT_PATTERN.match(headers.get("traceparent", "") or "")
+    if match:
+        trace_id, parent_id = match.groups()
+    # 同じスレッドで前のリクエストの span が残っていても親にしない
+    span = Span(name, trace_id or os.urandom(16).hex(), parent_id, SPAN_KIND_SERVER, attributes)
+    request_id = headers.get("X-Request-ID", "") or ""
+    span.request_id = request_id if REQUEST_ID_PATTERN.match(request_id) else span.trace_id
+    span.set("request.id", span.request_id)
+    return span
+
+########################################################################
+# SQLite コネクションプール
+#   DBファイルごとに接続を使い回し、WAL + synchronous=NORMAL で書き込みを軽くする
+########################################################################
+DB_POOL_SIZE = 4
+
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+# DBごとの初期化 (init_schema) 用のロック。初期化中も他のDBの接続は取り出せるようにする
+_db_init_locks = {}
+
+def open_sqlite_connection(db_path: str):
+    """
+    WALモードでSQLiteに接続する
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        conn.execute('PRAGMA foreign_keys=ON')
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+def take_pooled_connection(db_path: str, init_schema=None):
+    """
+    プールから接続を1つ取り出す (空なら None)。
+    そのDBをプロセス内で初めて開く場合は、DBごとのロックの下で init_schema を呼んでプールを作り、その接続を返す。
+    init_schema が失敗した場合は接続を閉じ、プールは作らない (次の呼び出しでやり直す)
+    """
+    with _db_pools_lock:
+        pool = _db_pools.get(db_path)
+        if pool is not None:
+            return pool.pop() if pool else None
+        init_lock = _db_init_locks.setdefault(db_path, threading.Lock())
+
+    with init_lock:
+        with _db_pools_lock:
+            pool = _db_pools.get(db_path)
+            if pool is not None:
+                # 待っている間に他のスレッドが初期化した
+                return pool.pop() if pool else None
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = open_sqlite_connection(db_path)
+        try:
+            if init_schema:
+                init_schema(conn)
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        with _db_pools_lock:
+            _db_pools[db_path] = []
+        return conn
+
+@contextmanager
+def pooled_connection(db_path: str, init_schema=None, immediate=False):
+    """
+    プールから接続を取り出して返すコンテキストマネージャ。
+    正常終了でcommit、例外時はrollbackし、接続はプールに戻す。
+    init_schema は、そのDBをプロセス内で初めて開いたときに1回だけ呼ばれる。
+    immediate=True の場合は最初に書き込みロックを取る (読んでから書く処理を他のプロセスと直列にする)
+    """
+    conn = take_pooled_connection(db_path, init_schema)
+    if conn is None:
+        conn = open_sqlite_connection(db_path)
+
+    try:
+        if immediate:
+            conn.execute('BEGIN IMMEDIATE')
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        with _db_pools_lock:
+            pool = _db_pools.get(db_path)
+            if pool is not None and len(pool) < DB_POOL_SIZE:
+                pool.append(conn)
+            else:
+                conn.close()
+
+def close_db_pool(db_path: str):
+    """
+    指定DBの接続をすべて閉じてプールから外す (DBファイル削除前などに使用)
+    """
+    with _db_pools_lock:
+        pool = _db_pools.pop(db_path, [])
+    for conn in pool:
+        conn.close()
+
+def user_db(username: str, immediate=False):
+    """
+    ユーザーのチャット履歴DBへのプール済み接続を返す
+    """
+    return pooled_connection(get_user_db_path(username), init_user_db_schema, immediate)
+
 ########################################################################
 # ② ユーザーごとに chat_history.db を作るためのヘルパー
 ########################################################################
@@ -65,25 +353,18 @@ def get_user_db_path(username: str):
     """
     return os.path.join(get_user_dir(username), 'chat_history.db')
 
-def ensure_user_db_exists(username: str):
+def _migrate_chat_v1(conn):
     """
-    指定ユーザーのDBがなければ作成、必要なテーブルを初期化
+    v1: 初期テーブル (旧バージョンで作成済みのDBはそのまま)
     """
-    user_dir = get_user_dir(username)
-    os.makedirs(user_dir, exist_ok=True)
-
-    db_path = get_user_db_path(username)
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS chat_sessions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             dir_name TEXT NOT NULL,
             created_at TEXT NOT NULL DEFAULT (datetime('now','+9 hours'))
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS chat_messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             session_id INTEGER NOT NULL,
@@ -93,8 +374,153 @@ def ensure_user_db_exists(username: str):
             FOREIGN KEY(session_id) REFERENCES chat_sessions(id)
         )
     ''')
+
+def _migrate_chat_v2(conn):
+    """
+    v2: chat_messages を ON DELETE CASCADE 付きで作り直し、検索用インデックスを追加。
+    既に孤立しているメッセージはこのタイミングで捨てる。
+    """
+    conn.execute('''
+        CREATE TABLE chat_messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO chat_messages_new (id, session_id, role, content, created_at)
+        SELECT id, session_id, role, content, created_at
+        FROM chat_messages
+        WHERE session_id IN (SELECT id FROM chat_sessions)
+    ''')
+    conn.execute('DROP TABLE chat_messages')
+    conn.execute('ALTER TABLE chat_messages_new RENAME TO chat_messages')
+
+    # list_chat_sessions / 保持数チェック用 (id は rowid なのでこの索引だけで完結する)
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_dir_created
+        ON chat_sessions (dir_name, created_at)
+    ''')
+    # 期間による一括削除用
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_created
+        ON chat_sessions (created_at)
+    ''')
+    # get_chat_history / セッション削除時のカスケード用
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_session
+        ON chat_messages (session_id, id)
+    ''')
+
+def _migrate_chat_v3(conn):
+    """
+    v3: 削除後の空きページを少しずつ返せるよう auto_vacuum を INCREMENTAL にする
+    (反映には VACUUM が必要なので、True を返してマイグレーション完了後に実行させる)
+    """
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    return True
+
+def _migrate_chat_v4(conn):
+    """
+    v4: 論文カタログ (ディレクトリ走査の代わりに一覧・ファイル検索で使う)
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS papers (
+            dir_name TEXT PRIMARY KEY,
+            display_name TEXT NOT NULL,
+            base_name TEXT,
+            pdf_name TEXT,
+            pdf_count INTEGER NOT NULL DEFAULT 0,
+            pdf_size INTEGER,
+            page_count INTEGER,
+            markdown_files TEXT NOT NULL DEFAULT '[]',
+            image_files TEXT NOT NULL DEFAULT '[]',
+            has_origin INTEGER NOT NULL DEFAULT 0,
+            has_trans INTEGER NOT NULL DEFAULT 0,
+            has_explain INTEGER NOT NULL DEFAULT 0,
+            has_thread INTEGER NOT NULL DEFAULT 0,
+            markdown_size INTEGER NOT NULL DEFAULT 0,
+            image_size INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_papers_updated
+        ON papers (updated_at DESC, dir_name, display_name)
+    ''')
+
+def _migrate_chat_v5(conn):
+    """
+    v5: カタログの同期状態 (行があれば作成済み。最後に同期したときのユーザーディレクトリの更新時刻を持つ)
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            user_dir_mtime INTEGER NOT NULL
+        )
+    ''')
+
+CHAT_DB_MIGRATIONS = [
+    (1, _migrate_chat_v1),
+    (2, _migrate_chat_v2),
+    (3, _migrate_chat_v3),
+    (4, _migrate_chat_v4),
+    (5, _migrate_chat_v5),
+]
+
+def migrate_db(conn, migrations):
+    """
+    schema_version テーブルを見て、未適用のマイグレーションを順に適用する。
+    各マイグレーションは1トランザクションで実行し、True を返したものがあれば最後に VACUUM する。
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    current = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+    pending = [(v, fn) for v, fn in migrations if v > current]
+    if not pending:
+        return
+
+    # テーブル作り直しの間は外部キー制約を止める (トランザクション外でしか切り替えられない)
     conn.commit()
-    conn.close()
+    conn.execute('PRAGMA foreign_keys = OFF')
+    needs_vacuum = False
+    try:
+        for version, migrate in pending:
+            # 他のプロセスが同時に適用していないか、書き込みロックを取ってから確かめる
+            conn.execute('BEGIN IMMEDIATE')
+            if (conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0) >= version:
+                conn.rollback()
+                continue
+            try:
+                needs_vacuum = migrate(conn) or needs_vacuum
+                conn.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            print(f">>> DBマイグレーション v{version} を適用しました。")
+    finally:
+        conn.execute('PRAGMA foreign_keys = ON')
+
+    if needs_vacuum:
+        conn.execute('VACUUM')
+
+def init_user_db_schema(conn):
+    """
+    チャット履歴DBのスキーマを最新版にする (プロセス内でユーザーごとに1回だけ呼ばれる)
+    """
+    migrate_db(conn, CHAT_DB_MIGRATIONS)
+
+def ensure_user_db_exists(username: str):
+    """
+    指定ユーザーのDBがなければ作成、必要なテーブルを初期化
+    (初期化済みの場合はプールを参照するだけで何もしない)
+    """
+    with user_db(username):
+        pass
 
 ########################################################################
 # ③ ユーザー新規/既存を確認するエンドポイント
@@ -165,20 +591,87 @@ def create_user():
 ########################################################################
 # チャットセッション系のテーブル操作
 ########################################################################
+# 保持ポリシー (環境変数で変更可能)
+#   CHAT_RETENTION_MAX_SESSIONS : 1論文あたりに残すセッション数
+#   CHAT_RETENTION_DAYS         : この日数より古いセッションを削除 (0 で無効)
+CHAT_RETENTION_MAX_SESSIONS = int(os.getenv("CHAT_RETENTION_MAX_SESSIONS", "30"))
+CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "0"))
+
+# バックグラウンドで incremental_vacuum を行う間隔 (秒)
+DB_MAINTENANCE_INTERVAL = int(os.getenv("DB_MAINTENANCE_INTERVAL", "600"))
+
+_dirty_db_paths = set()
+_db_maintenance_thread = None
+
 def remove_oldest_session_if_needed(db_cursor, dir_name):
     """
-    指定ディレクトリのセッションが30件を超えた場合は最古のセッションを削除。
+    指定ディレクトリのセッションが上限を超えないよう、古いセッションをまとめて削除。
+    (新規セッション作成前に呼ぶため、上限 - 1 件だけ残す。メッセージはカスケード削除)
     """
     db_cursor.execute('''
-        SELECT id FROM chat_sessions
+        DELETE FROM chat_sessions
         WHERE dir_name = ?
-        ORDER BY created_at ASC
-    ''', (dir_name,))
-    sessions = db_cursor.fetchall()
-    if len(sessions) > 30:
-        oldest_id = sessions[0][0]
-        db_cursor.execute('DELETE FROM chat_messages WHERE session_id = ?', (oldest_id,))
-        db_cursor.execute('DELETE FROM chat_sessions WHERE id = ?', (oldest_id,))
+          AND id NOT IN (
+            SELECT id FROM chat_sessions
+            WHERE dir_name = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+          )
+    ''', (dir_name, dir_name, max(CHAT_RETENTION_MAX_SESSIONS - 1, 0)))
+    return db_cursor.rowcount
+
+def remove_expired_sessions(db_cursor):
+    """
+    保持期間を過ぎたセッションを一括削除
+    """
+    if CHAT_RETENTION_DAYS <= 0:
+        return 0
+    db_cursor.execute('''
+        DELETE FROM chat_sessions
+        WHERE created_at < datetime('now', '+9 hours', ?)
+    ''', (f'-{CHAT_RETENTION_DAYS} days',))
+    return db_cursor.rowcount
+
+def delete_sessions_for_dir(username, dir_name):
+    """
+    論文ディレクトリ削除時に、そのディレクトリのセッションを削除 (dir_name は "username/subdir")
+    """
+    with user_db(username) as conn:
+        deleted = conn.execute('DELETE FROM chat_sessions WHERE dir_name = ?', (dir_name,)).rowcount
+    if deleted:
+        schedule_db_maintenance(get_user_db_path(username))
+    return deleted
+
+def schedule_db_maintenance(db_path):
+    """
+    削除が発生したDBを記録し、バックグラウンドの保守スレッドを起動する
+    """
+    global _db_maintenance_thread
+    with _db_pools_lock:
+        _dirty_db_paths.add(db_path)
+        if _db_maintenance_thread is None:
+            _db_maintenance_thread = threading.Thread(target=run_db_maintenance, daemon=True)
+            _db_maintenance_thread.start()
+
+def run_db_maintenance():
+    """
+    一定間隔で、削除のあったDBに対して期限切れセッションの削除と incremental_vacuum を行う
+    """
+    while True:
+        time.sleep(DB_MAINTENANCE_INTERVAL)
+        with _db_pools_lock:
+            db_paths = list(_dirty_db_paths)
+            _dirty_db_paths.clear()
+        for db_path in db_paths:
+            if not os.path.exists(db_path):
+                continue
+            try:
+                with pooled_connection(db_path, init_user_db_schema) as conn:
+                    remove_expired_sessions(conn.cursor())
+                    conn.commit()
+                    conn.execute('PRAGMA incremental_vacuum')
+            except Exception:
+                traceback.print_exc()
 
 @app.route('/create_chat_session', methods=['POST'])
 def create_chat_session():
@@ -190,47 +683,127 @@ def create_chat_session():
     if not username or not dir_name:
         return jsonify({'error': 'username and dir_name are required'}), 400
 
-    # ユーザーDB用意
-    ensure_user_db_exists(username)
-    db_path = get_user_db_path(username)
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
+    # 古いセッションの削除と作成の間に、他のワーカーが割り込まないようにする
+    with user_db(username, immediate=True) as conn:
+        cursor = conn.cursor()
 
-    remove_oldest_session_if_needed(cursor, dir_name)
+        pruned = remove_oldest_session_if_needed(cursor, dir_name)
+        pruned += remove_expired_sessions(cursor)
 
-    cursor.execute(
-        'INSERT INTO chat_sessions (dir_name) VALUES (?)',
-        (dir_name,)
-    )
-    new_session_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+        cursor.execute(
+            'INSERT INTO chat_sessions (dir_name) VALUES (?)',
+            (dir_name,)
+        )
+        new_session_id = cursor.lastrowid
+
+    if pruned:
+        schedule_db_maintenance(get_user_db_path(username))
 
     return jsonify({'session_id': new_session_id}), 200
 
+# ページング時の1ページあたりの最大件数
+CHAT_PAGE_MAX_LIMIT = 200
+
+def parse_page_args():
+    """
+    before_id / limit クエリパラメータを取得する。
+    limit 未指定の場合は None (全件取得・従来互換) を返す。
+    """
+    before_id = request.args.get('before_id')
+    limit = request.args.get('limit')
+    try:
+        before_id = int(before_id) if before_id else None
+        limit = min(max(int(limit), 1), CHAT_PAGE_MAX_LIMIT) if limit else None
+    except ValueError:
+        raise ValueError('before_id and limit must be integers')
+    return before_id, limit
+
+def expand_chat_message(message_id, role, raw_content):
+    """
+    DBに保存された1メッセージ (JSON配列 or プレーンテキスト) を表示用の要素リストに展開する
+    """
+    items = []
+    try:
+        data = json.loads(raw_content)  # JSONパース
+        if isinstance(data, list):
+            for item in data:
+                if item.get("type") == "text":
+                    items.append({
+                        "id": message_id,
+                        "role": role,
+                        "type": "text",
+                        "content": item.get("text", "")
+                    })
+                elif item.get("type") == "image_url":
+                    items.append({
+                        "id": message_id,
+                        "role": role,
+                        "type": "image",
+                        "content": item["image_url"]["url"]
+                    })
+        else:
+            items.append({
+                "id": message_id,
+                "role": role,
+                "type": "text",
+                "content": str(data)
+            })
+    except:
+        items.append({
+            "id": message_id,
+            "role": role,
+            "type": "text",
+            "content": raw_content
+        })
+    return items
+
+def make_message_preview(raw_content, length=100):
+    """
+    メッセージ一覧用の短いプレビュー文字列を作る (画像は [画像] と表示)
+    """
+    items = expand_chat_message(None, None, raw_content)
+    texts = [i["content"] for i in items if i["type"] == "text" and i["content"]]
+    preview = " ".join(texts).strip() if texts else ("[画像]" if items else "")
+    return preview[:length] + ("…" if len(preview) > length else "")
+
 @app.route('/list_chat_sessions', methods=['GET'])
 def list_chat_sessions():
     """
     指定された dir_name のチャットセッション一覧を新しい順に返す。
+    limit を指定するとページング (before_id より古いセッションを limit 件) になる。
     """
     username = request.args.get('username', None)
     dir_name = request.args.get('dir_name', None)
     if not username or not dir_name:
         return jsonify({'error': 'username and dir_name are required'}), 400
 
-    ensure_user_db_exists(username)
-    db_path = get_user_db_path(username)
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-
-    cursor.execute('''
+    try:
+        before_id, limit = parse_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    where = 'dir_name = ?'
+    params = [dir_name]
+    if before_id is not None:
+        # (created_at, id) の組でキーセットページング
+        where += ' AND (created_at, id) < (SELECT created_at, id FROM chat_sessions WHERE id = ?)'
+        params.append(before_id)
+
+    sql = f'''
         SELECT id, created_at
         FROM chat_sessions
-        WHERE dir_name = ?
-        ORDER BY created_at DESC
-    ''', (dir_name,))
-    rows = cursor.fetchall()
-    conn.close()
+        WHERE {where}
+        ORDER BY created_at DESC, id DESC
+    '''
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit + 1)
+
+    with user_db(username) as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    has_more = limit is not None and len(rows) > limit
+    rows = rows[:limit] if limit is not None else rows
 
     sessions = []
     for r in rows:
@@ -239,64 +812,119 @@ def list_chat_sessions():
             'created_at': str(r[1])
         })
 
-    return jsonify({'sessions': sessions}), 200
+    return jsonify({
+        'sessions': sessions,
+        'has_more': has_more,
+        'next_before_id': sessions[-1]['id'] if has_more else None
+    }), 200
 
 @app.route('/get_chat_history', methods=['GET'])
 def get_chat_history():
     """
     セッションIDを指定し、DBに保存されたメッセージを取得。
+    limit を指定すると、before_id より前の最新 limit 件だけを古い順で返す。
     """
     username = request.args.get('username', None)
     session_id = request.args.get('session_id', None)
     if not username or not session_id:
         return jsonify({'error': 'username and session_id are required'}), 400
 
-    ensure_user_db_exists(username)
-    db_path = get_user_db_path(username)
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
+    try:
+        before_id, limit = parse_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    where = 'session_id = ?'
+    params = [session_id]
+    if before_id is not None:
+        where += ' AND id < ?'
+        params.append(before_id)
+
+    if limit is None:
+        sql = f'SELECT id, role, content FROM chat_messages WHERE {where} ORDER BY id ASC'
+    else:
+        sql = f'SELECT id, role, content FROM chat_messages WHERE {where} ORDER BY id DESC LIMIT ?'
+        params.append(limit + 1)
 
-    cursor.execute('''
-        SELECT role, content
-        FROM chat_messages
-        WHERE session_id = ?
-        ORDER BY id ASC
-    ''', (session_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    with user_db(username) as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    has_more = False
+    if limit is not None:
+        has_more = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
 
     all_messages = []
-    for (role, raw_content) in rows:
-        try:
-            data = json.loads(raw_content)  # JSONパース
-            if isinstance(data, list):
-                for item in data:
-                    if item.get("type") == "text":
-                        all_messages.append({
-                            "role": role,
-                            "type": "text",
-                            "content": item.get("text", "")
-                        })
-                    elif item.get("type") == "image_url":
-                        all_messages.append({
-                            "role": role,
-                            "type": "image",
-                            "content": item["image_url"]["url"]
-                        })
-            else:
-                all_messages.append({
-                    "role": role,
-                    "type": "text",
-                    "content": str(data)
-                })
-        except:
-            all_messages.append({
-                "role": role,
-                "type": "text",
-                "content": raw_content
-            })
+    for (message_id, role, raw_content) in rows:
+        all_messages.extend(expand_chat_message(message_id, role, raw_content))
+
+    return jsonify({
+        'messages': all_messages,
+        'has_more': has_more,
+        'next_before_id': rows[0][0] if has_more else None
+    }), 200
+
+@app.route('/chat_sessions_summary', methods=['GET'])
+def chat_sessions_summary():
+    """
+    指定 dir_name のセッションごとのメッセージ数と最終メッセージのプレビューを返す。
+    before_id / limit でのページングにも対応。
+    """
+    username = request.args.get('username', None)
+    dir_name = request.args.get('dir_name', None)
+    if not username or not dir_name:
+        return jsonify({'error': 'username and dir_name are required'}), 400
+
+    try:
+        before_id, limit = parse_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = limit or 20
+
+    where = 's.dir_name = ?'
+    params = [dir_name]
+    if before_id is not None:
+        where += ' AND (s.created_at, s.id) < (SELECT created_at, id FROM chat_sessions WHERE id = ?)'
+        params.append(before_id)
+    params.append(limit + 1)
+
+    with user_db(username) as conn:
+        total = conn.execute(
+            'SELECT COUNT(*) FROM chat_sessions WHERE dir_name = ?', (dir_name,)
+        ).fetchone()[0]
+        rows = conn.execute(f'''
+            SELECT s.id, s.created_at,
+                   (SELECT COUNT(*) FROM chat_messages m WHERE m.session_id = s.id),
+                   last.role, last.content, last.created_at
+            FROM chat_sessions s
+            LEFT JOIN chat_messages last ON last.id = (
+                SELECT MAX(id) FROM chat_messages m WHERE m.session_id = s.id
+            )
+            WHERE {where}
+            ORDER BY s.created_at DESC, s.id DESC
+            LIMIT ?
+        ''', params).fetchall()
+
+    has_more = len(rows) > limit
+    sessions = []
+    for session_id, created_at, message_count, role, content, last_at in rows[:limit]:
+        sessions.append({
+            'id': session_id,
+            'created_at': str(created_at),
+            'message_count': message_count,
+            'last_message': {
+                'role': role,
+                'preview': make_message_preview(content),
+                'created_at': str(last_at)
+            } if content is not None else None
+        })
 
-    return jsonify({'messages': all_messages}), 200
+    return jsonify({
+        'session_count': total,
+        'sessions': sessions,
+        'has_more': has_more,
+        'next_before_id': sessions[-1]['id'] if has_more else None
+    }), 200
 
 @app.route('/delete_chat_session', methods=['POST'])
 def delete_chat_session():
@@ -307,15 +935,9 @@ def delete_chat_session():
     session_id = data['session_id']
     username = data['username']
 
-    ensure_user_db_exists(username)
-    db_path = get_user_db_path(username)
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-
-    cursor.execute('DELETE FROM chat_messages WHERE session_id = ?', (session_id,))
-    cursor.execute('DELETE FROM chat_sessions WHERE id = ?', (session_id,))
-    conn.commit()
-    conn.close()
+    with user_db(username) as conn:
+        conn.execute('DELETE FROM chat_sessions WHERE id = ?', (session_id,))
+    schedule_db_maintenance(get_user_db_path(username))
 
     return jsonify({'message': f'Session {session_id} deleted.'}), 200
 
@@ -334,21 +956,18 @@ def bulk_save_chat():
     if not isinstance(messages, list) or len(messages) == 0:
         return jsonify({'error': 'No messages to save or invalid format'}), 400
 
-    ensure_user_db_exists(username)
-    db_path = get_user_db_path(username)
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-
-    for m in messages:
-        role = m.get('role')
-        content = m.get('content')
-        if role and content:
-            cursor.execute('''
-                INSERT INTO chat_messages (session_id, role, content)
-                VALUES (?, ?, ?)
-            ''', (session_id, role, content))
-    conn.commit()
-    conn.close()
+    rows = [
+        (session_id, m.get('role'), m.get('content'))
+        for m in messages
+        if m.get('role') and m.get('content')
+    ]
+
+    # 1トランザクションでまとめて書き込む
+    with user_db(username) as conn:
+        conn.executemany('''
+            INSERT INTO chat_messages (session_id, role, content)
+            VALUES (?, ?, ?)
+        ''', rows)
 
     return jsonify({'message': 'Bulk save complete'}), 200
 
@@ -357,344 +976,4123 @@ def save_chat_message(username, session_id, role, content):
     1件のメッセージをDBに保存。
     content は JSON文字列でも、プレーンテキストでもよい。
     """
-    ensure_user_db_exists(username)
-    db_path = get_user_db_path(username)
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        INSERT INTO chat_messages (session_id, role, content)
-        VALUES (?, ?, ?)
-    ''', (session_id, role, content))
-    conn.commit()
-    conn.close()
+    with user_db(username) as conn:
+        conn.execute('''
+            INSERT INTO chat_messages (session_id, role, content)
+            VALUES (?, ?, ?)
+        ''', (session_id, role, content))
 
 ########################################################################
-# コンテンツファイル閲覧
+# 全文検索インデックス (SQLite FTS5)
+#   ユーザーごとに search_index.db を持ち、マークダウンを見出し単位で登録する
 ########################################################################
-@app.route('/contents/<path:filename>', methods=['GET'])
-def serve_content_files(filename):
+SEARCH_INDEXED_SUFFIXES = ('_origin.md', '_trans.md', '_explain.md', '_thread.md')
+
+# trigram トークナイザは SQLite 3.34 以降。使えない環境では unicode61 にフォールバック
+_search_tokenizer = None
+
+def get_search_tokenizer():
     """
-    contents ディレクトリからファイルを提供するエンドポイント。
-    ただし今回は /home/ubuntu/workspace/users/<username>/... を想定。
-    filename が "username/dir_name/xxx.pdf" などの形を許容。
+    FTS5 で使用するトークナイザ名を返す (日本語対応のため trigram を優先)
     """
-    try:
-        # 安全なパス判定
-        safe_path = os.path.join(CONTENT_DATA_DIR, filename)
-        if not os.path.abspath(safe_path).startswith(os.path.abspath(CONTENT_DATA_DIR)):
-            return jsonify({'error': 'Invalid file path'}), 400
-        return send_from_directory(CONTENT_DATA_DIR, filename)
-    except FileNotFoundError:
-        return jsonify({'error': 'File not found'}), 404
+    global _search_tokenizer
+    if _search_tokenizer is None:
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute("CREATE VIRTUAL TABLE t USING fts5(x, tokenize='trigram')")
+            _search_tokenizer = 'trigram'
+        except sqlite3.OperationalError:
+            _search_tokenizer = 'unicode61'
+        finally:
+            conn.close()
+    return _search_tokenizer
+
+def get_user_search_db_path(username: str):
+    """
+    ユーザー固有の search_index.db のパスを返す
+    """
+    return os.path.join(get_user_dir(username), 'search_index.db')
 
-@app.route('/list_files/<path:dir_name>', methods=['GET'])
-def list_files(dir_name):
+def split_user_dir_name(dir_name: str):
     """
-    指定ディレクトリ内のPDFとMarkdownを返す。
-    例: dir_name = "alice/20230701010101_myPaper"
+    "username/subdir" 形式の dir_name を (username, subdir) に分解する
     """
-    try:
-        dir_path = os.path.join(CONTENT_DATA_DIR, dir_name)
-        if not os.path.isdir(dir_path):
-            return jsonify({'error': 'Directory not found'}), 404
-        files = os.listdir(dir_path)
-        markdown_files = [f for f in files if f.lower().endswith('.md')]
-        pdf_files = [f for f in files if f.lower().endswith('.pdf')]
+    parts = dir_name.strip('/').split('/', 1)
+    if len(parts) != 2:
+        return None, None
+    return parts[0], parts[1]
 
-        if len(pdf_files) != 1:
-            return jsonify({'error': 'ディレクトリ内にPDFファイルが1つではありません'}), 400
+def search_db(username: str):
+    """
+    検索インデックスDBへのプール済み接続を返す。
+    新規作成時は既存のマークダウンをまとめて登録する。
+    """
+    def init_schema(conn):
+        is_new = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'indexed_files'"
+        ).fetchone() is None
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS paper_sections USING fts5(
+                heading,
+                body,
+                dir_name UNINDEXED,
+                file_name UNINDEXED,
+                kind UNINDEXED,
+                anchor UNINDEXED,
+                section_no UNINDEXED,
+                tokenize='{get_search_tokenizer()}'
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS indexed_files (
+                dir_name TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (dir_name, file_name)
+            )
+        ''')
+        if is_new:
+            sync_user_search_index(username, conn)
 
-        return jsonify({
-            'markdown_files': markdown_files,
-            'pdf_file': pdf_files[0]
-        }), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return pooled_connection(get_user_search_db_path(username), init_schema)
 
-@app.route('/list_contents', methods=['GET'])
-def list_contents():
+def make_heading_anchor(heading: str, used: dict):
     """
-    username ディレクトリ直下にあるサブディレクトリ一覧を返す。
-    新しい順（更新時刻が新しい順）にソート。
+    見出しからフロントエンドのアンカー (GitHub形式のslug) を生成する。
+    同名見出しには -1, -2 ... を付与する。
+    """
+    slug = heading.strip().lower()
+    slug = re.sub(r'[^\w\- ]', '', slug)
+    slug = slug.replace(' ', '-')
+    count = used.get(slug, 0)
+    used[slug] = count + 1
+    return slug if count == 0 else f"{slug}-{count}"
+
+def split_markdown_sections(md_text: str):
+    """
+    マークダウンを見出し単位のセクションに分割する。
+    戻り値: [{"heading", "anchor", "body"}, ...]
+    """
+    sections = []
+    used_anchors = {}
+    heading = ""
+    anchor = ""
+    body_lines = []
+    in_code_block = False
+
+    for line in md_text.splitlines():
+        if line.lstrip().startswith('```'):
+            in_code_block = not in_code_block
+        match = None if in_code_block else re.match(r'^#{1,6}\s+(.*?)\s*#*\s*$', line)
+        if match:
+            if heading or ''.join(body_lines).strip():
+                sections.append({"heading": heading, "anchor": anchor, "body": "\n".join(body_lines)})
+            heading = match.group(1)
+            anchor = make_heading_anchor(heading, used_anchors)
+            body_lines = []
+        else:
+            body_lines.append(line)
+
+    if heading or ''.join(body_lines).strip():
+        sections.append({"heading": heading, "anchor": anchor, "body": "\n".join(body_lines)})
+    return sections
+
+def get_markdown_kind(file_name: str):
+    """
+    ファイル名のサフィックスから種別 (origin / trans / explain / thread) を返す
+    """
+    for suffix in SEARCH_INDEXED_SUFFIXES:
+        if file_name.lower().endswith(suffix):
+            return suffix[1:-3]
+    return 'other'
+
+def index_markdown_file(conn, dir_name, file_name, md_text, mtime=None, size=None):
+    """
+    1ファイル分のセクションを登録し直す (既存行は削除してから登録)
+    """
+    conn.execute('DELETE FROM paper_sections WHERE dir_name = ? AND file_name = ?', (dir_name, file_name))
+    kind = get_markdown_kind(file_name)
+    conn.executemany('''
+        INSERT INTO paper_sections (heading, body, dir_name, file_name, kind, anchor, section_no)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (s["heading"], s["body"], dir_name, file_name, kind, s["anchor"], i)
+        for i, s in enumerate(split_markdown_sections(md_text))
+    ])
+    conn.execute('''
+        INSERT OR REPLACE INTO indexed_files (dir_name, file_name, mtime, size)
+        VALUES (?, ?, ?, ?)
+    ''', (dir_name, file_name, mtime or time.time(), size if size is not None else len(md_text)))
+
+def sync_user_search_index(username, conn):
+    """
+    ユーザーディレクトリを走査し、未登録・更新済みのマークダウンを登録、消えたものを削除する
+    """
+    user_dir = get_user_dir(username)
+    seen = set()
+    indexed = {
+        (d, f): (mtime, size)
+        for d, f, mtime, size in conn.execute('SELECT dir_name, file_name, mtime, size FROM indexed_files')
+    }
+    for d in os.listdir(user_dir):
+        dir_path = os.path.join(user_dir, d)
+        if not os.path.isdir(dir_path):
+            continue
+        for f in os.listdir(dir_path):
+            if not f.lower().endswith(SEARCH_INDEXED_SUFFIXES):
+                continue
+            key = (f"{username}/{d}", f)
+            seen.add(key)
+            st = os.stat(os.path.join(dir_path, f))
+            if indexed.get(key) == (st.st_mtime, st.st_size):
+                continue
+            with open(os.path.join(dir_path, f), 'r', encoding='utf-8') as fp:
+                index_markdown_file(conn, key[0], f, fp.read(), st.st_mtime, st.st_size)
+
+    for key in set(indexed) - seen:
+        conn.execute('DELETE FROM paper_sections WHERE dir_name = ? AND file_name = ?', key)
+        conn.execute('DELETE FROM indexed_files WHERE dir_name = ? AND file_name = ?', key)
+    conn.commit()
+
+def update_search_index(dir_name, file_path):
+    """
+    マークダウン書き込み後に呼び出し、該当ファイルのインデックスを更新する。
+    dir_name は "username/subdir" 形式。失敗しても本処理は止めない。
+    """
+    username, _ = split_user_dir_name(dir_name)
+    file_name = os.path.basename(file_path)
+    if not username or not file_name.lower().endswith(SEARCH_INDEXED_SUFFIXES):
+        return
+    try:
+        st = os.stat(file_path)
+        with open(file_path, 'r', encoding='utf-8') as f:
+            md_text = f.read()
+        with search_db(username) as conn:
+            index_markdown_file(conn, dir_name, file_name, md_text, st.st_mtime, st.st_size)
+    except Exception:
+        traceback.print_exc()
+
+def remove_from_search_index(dir_name, file_name=None):
+    """
+    ディレクトリ (またはその中の1ファイル) をインデックスから削除する
+    """
+    username, _ = split_user_dir_name(dir_name)
+    if not username or not os.path.exists(get_user_search_db_path(username)):
+        return
+    try:
+        with search_db(username) as conn:
+            if file_name:
+                conn.execute('DELETE FROM paper_sections WHERE dir_name = ? AND file_name = ?', (dir_name, file_name))
+                conn.execute('DELETE FROM indexed_files WHERE dir_name = ? AND file_name = ?', (dir_name, file_name))
+            else:
+                conn.execute('DELETE FROM paper_sections WHERE dir_name = ?', (dir_name,))
+                conn.execute('DELETE FROM indexed_files WHERE dir_name = ?', (dir_name,))
+    except Exception:
+        traceback.print_exc()
+
+def make_like_snippet(text, term, width=40):
+    """
+    LIKE 検索時用の簡易スニペット (FTS の snippet() が使えない場合)
+    """
+    pos = text.lower().find(term.lower())
+    if pos < 0:
+        return text[:width * 2]
+    start = max(0, pos - width)
+    end = min(len(text), pos + len(term) + width)
+    return ('…' if start > 0 else '') \
+        + text[start:pos] + '<mark>' + text[pos:pos + len(term)] + '</mark>' + text[pos + len(term):end] \
+        + ('…' if end < len(text) else '')
+
+@app.route('/search', methods=['GET'])
+def search_papers():
+    """
+    ユーザーの論文・生成マークダウンを全文検索し、セクション単位のスニペットを返す。
+    パラメータ: username, q, (任意) dir_name, kind, limit
     """
     username = request.args.get('username')
-    if not username:
-        return jsonify({'error': 'username is required'}), 400
+    query = request.args.get('q', '').strip()
+    if not username or not query:
+        return jsonify({'error': 'username and q are required'}), 400
 
     if '..' in username or '/' in username or '\\' in username:
         return jsonify({'error': 'Invalid username.'}), 400
 
-    # ユーザーのルートディレクトリ
-    user_dir = os.path.join(CONTENT_DATA_DIR, username)
-    if not os.path.isdir(user_dir):
+    if not os.path.isdir(get_user_dir(username)):
         return jsonify({'error': f'User directory not found: {username}'}), 404
 
     try:
-        # username ディレクトリ直下のサブディレクトリ一覧を取得
-        dir_paths = [
-            os.path.join(user_dir, d)
-            for d in os.listdir(user_dir)
-            if os.path.isdir(os.path.join(user_dir, d))
-        ]
-        # 更新時刻が新しい順にソート
-        dir_paths_sorted = sorted(dir_paths, key=os.path.getmtime, reverse=True)
-
-        directories = []
-        for dir_path in dir_paths_sorted:
-            d = os.path.basename(dir_path)
-            # 必要に応じて表示名の加工を行う (例: timestamp_XXXX → XXXX)
-            parts = d.split('_', 1)
-            if len(parts) == 2:
-                display_name = parts[1]
-            else:
-                display_name = d
+        limit = min(int(request.args.get('limit', 20)), 100)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
 
-            directories.append({
+    start_time = time.perf_counter()
+    try:
+        # trigram は3文字未満の語にマッチしないため、短い語は LIKE で絞り込む
+        terms = query.split()
+        min_len = 3 if get_search_tokenizer() == 'trigram' else 1
+        match_terms = [t for t in terms if len(t) >= min_len]
+        like_terms = [t for t in terms if len(t) < min_len]
+
+        where = []
+        params = []
+        if match_terms:
+            where.append('paper_sections MATCH ?')
+            params.append(' '.join('"' + t.replace('"', '""') + '"' for t in match_terms))
+        for t in like_terms:
+            where.append("(heading || ' ' || body) LIKE ?")
+            params.append(f"%{t}%")
+        if request.args.get('dir_name'):
+            where.append('dir_name = ?')
+            params.append(request.args.get('dir_name'))
+        if request.args.get('kind'):
+            where.append('kind = ?')
+            params.append(request.args.get('kind'))
+
+        if match_terms:
+            sql = f'''
+                SELECT dir_name, file_name, kind, heading, anchor,
+                       snippet(paper_sections, 1, '<mark>', '</mark>', '…', 24),
+                       bm25(paper_sections, 5.0, 1.0) AS score
+                FROM paper_sections
+                WHERE {' AND '.join(where)}
+                ORDER BY score
+                LIMIT ?
+            '''
+        else:
+            sql = f'''
+                SELECT dir_name, file_name, kind, heading, anchor, body, 0.0 AS score
+                FROM paper_sections
+                WHERE {' AND '.join(where)}
+                LIMIT ?
+            '''
+        params.append(limit)
+        with search_db(username) as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        results = []
+        for d, f, kind, heading, anchor, snippet, score in rows:
+            if not match_terms:
+                snippet = make_like_snippet(snippet, like_terms[0])
+            _, sub_dir = split_user_dir_name(d)
+            parts = sub_dir.split('_', 1)
+            results.append({
                 'dir_name': d,
-                'display_name': display_name
+                'display_name': parts[1] if len(parts) == 2 else sub_dir,
+                'file_name': f,
+                'kind': kind,
+                'heading': heading,
+                'anchor': anchor,
+                'snippet': snippet,
+                'score': score,
             })
 
-        return jsonify({'directories': directories}), 200
-
+        return jsonify({
+            'results': results,
+            'elapsed_ms': round((time.perf_counter() - start_time) * 1000, 2)
+        }), 200
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        error_traceback = traceback.format_exc()
+        print(error_traceback)
+        return jsonify({'error': f'Error during search: {str(e)}'}), 500
 
-########################################################################
+@app.route('/rebuild_search_index', methods=['POST'])
+def rebuild_search_index():
+    """
+    ユーザーの検索インデックスをディレクトリの内容と同期し直す
+    """
+    data = request.get_json()
+    if not data or 'username' not in data:
+        return jsonify({'error': 'username is required'}), 400
+
+    username = data['username']
+    if '..' in username or '/' in username or '\\' in username:
+        return jsonify({'error': 'Invalid username.'}), 400
+    if not os.path.isdir(get_user_dir(username)):
+        return jsonify({'error': f'User directory not found: {username}'}), 404
+
+    try:
+        with search_db(username) as conn:
+            sync_user_search_index(username, conn)
+            count = conn.execute('SELECT COUNT(*) FROM indexed_files').fetchone()[0]
+        return jsonify({'message': 'Search index rebuilt.', 'indexed_files': count}), 200
+    except Exception as e:
+        error_traceback = traceback.format_exc()
+        print(error_traceback)
+        return jsonify({'error': f'Error rebuilding search index: {str(e)}'}), 500
+
+########################################################################
+# 論文カタログ
+#   chat_history.db の papers テーブルに論文ディレクトリの情報を保持し、
+#   一覧表示や _origin.md の検索でディレクトリを走査しないようにする
+########################################################################
+ARTIFACT_KINDS = ('origin', 'trans', 'explain', 'thread')
+
+def get_display_name(sub_dir: str):
+    """
+    timestamp_XXXX → XXXX の表示名を返す
+    """
+    parts = sub_dir.split('_', 1)
+    return parts[1] if len(parts) == 2 else sub_dir
+
+def count_pdf_pages(pdf_path):
+    """
+    PDFのページ数を返す (取得できない場合は None)
+    """
+    try:
+        import pypdfium2
+        pdf = pypdfium2.PdfDocument(pdf_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    except Exception:
+        return None
+
+def scan_paper_dir(dir_path, previous=None):
+    """
+    論文ディレクトリを1回だけ走査してカタログ行を作る。
+    previous (既存行) の PDF サイズが変わっていなければページ数は再計算しない。
+    """
+    sub_dir = os.path.basename(dir_path)
+    pdf_files, md_files, image_files = [], [], []
+    pdf_size = markdown_size = image_size = 0
+
+    # ストレージ側にだけある (ローカルのキャッシュから消えた) 成果物も数える
+    files = list_stored_artifacts(dir_path)
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if entry.is_file():
+                files[entry.name] = entry.stat().st_size
+
+    for name, size in files.items():
+        lower = name.lower()
+        if lower.endswith('.pdf'):
+            pdf_files.append(name)
+            pdf_size = size
+        elif lower.endswith('.md'):
+            md_files.append(name)
+            markdown_size += size
+        elif (name.startswith('table') or name.startswith('picture')) and lower.endswith('.png'):
+            image_files.append(name)
+            image_size += size
+
+    md_files.sort()
+    image_files.sort()
+    origin = next((f for f in md_files if f.lower().endswith('_origin.md')), None)
+    if origin:
+        base_name = origin[:-len('_origin.md')]
+    elif pdf_files:
+        base_name = os.path.splitext(pdf_files[0])[0]
+    else:
+        base_name = None
+
+    pdf_name = pdf_files[0] if len(pdf_files) == 1 else None
+    if previous and previous.get('pdf_name') == pdf_name and previous.get('pdf_size') == pdf_size:
+        page_count = previous.get('page_count')
+    else:
+        pdf_path = os.path.join(dir_path, pdf_name) if pdf_name else None
+        page_count = count_pdf_pages(pdf_path) if pdf_path and ensure_local_artifact(pdf_path) else None
+
+    st = os.stat(dir_path)
+    entry = {
+        'dir_name': sub_dir,
+        'display_name': get_display_name(sub_dir),
+        'base_name': base_name,
+        'pdf_name': pdf_name,
+        'pdf_count': len(pdf_files),
+        'pdf_size': pdf_size if pdf_files else None,
+        'page_count': page_count,
+        'markdown_files': json.dumps(md_files, ensure_ascii=False),
+        'image_files': json.dumps(image_files, ensure_ascii=False),
+        'markdown_size': markdown_size,
+        'image_size': image_size,
+        'created_at': previous['created_at'] if previous else st.st_ctime,
+        'updated_at': st.st_mtime,
+    }
+    for kind in ARTIFACT_KINDS:
+        entry[f'has_{kind}'] = int(any(f.lower().endswith(f'_{kind}.md') for f in md_files))
+    return entry
+
+def row_to_catalog_entry(cursor, row):
+    """
+    papers テーブルの行を dict に変換する
+    """
+    entry = {col[0]: value for col, value in zip(cursor.description, row)}
+    for key in ('markdown_files', 'image_files'):
+        if key in entry:
+            entry[key] = json.loads(entry[key])
+    return entry
+
+def upsert_catalog_entry(conn, entry):
+    """
+    カタログ行を追加または更新する (created_at は初回の値を保持)
+    """
+    columns = list(entry.keys())
+    conn.execute(f'''
+        INSERT INTO papers ({', '.join(columns)})
+        VALUES ({', '.join('?' for _ in columns)})
+        ON CONFLICT(dir_name) DO UPDATE SET
+            {', '.join(f'{c} = excluded.{c}' for c in columns if c not in ('dir_name', 'created_at'))}
+    ''', [entry[c] for c in columns])
+
+def refresh_catalog_entry(username, sub_dir):
+    """
+    1ディレクトリ分のカタログ行を最新化する (ディレクトリが無ければ行を削除)
+    """
+    dir_path = os.path.join(get_user_dir(username), sub_dir)
+    with user_db(username) as conn:
+        cursor = conn.execute('SELECT * FROM papers WHERE dir_name = ?', (sub_dir,))
+        row = cursor.fetchone()
+        previous = row_to_catalog_entry(cursor, row) if row else None
+        if not os.path.isdir(dir_path):
+            conn.execute('DELETE FROM papers WHERE dir_name = ?', (sub_dir,))
+            return None
+        entry = scan_paper_dir(dir_path, previous)
+        upsert_catalog_entry(conn, entry)
+    return entry
+
+def record_catalog_synced(conn, user_dir_mtime):
+    """
+    カタログを同期したときのユーザーディレクトリの更新時刻 (ns) を記録する
+    """
+    conn.execute('''
+        INSERT INTO catalog_state (id, user_dir_mtime) VALUES (1, ?)
+        ON CONFLICT(id) DO UPDATE SET user_dir_mtime = excluded.user_dir_mtime
+    ''', (user_dir_mtime,))
+
+def rebuild_catalog(username):
+    """
+    ユーザーディレクトリ全体を走査してカタログを作り直す (初回・ずれの修正用)
+    """
+    user_dir = get_user_dir(username)
+    # 走査を始める前の時刻を記録する (走査中の変更は次の ensure_catalog で拾う)
+    user_dir_mtime = os.stat(user_dir).st_mtime_ns
+    with user_db(username) as conn:
+        cursor = conn.execute('SELECT * FROM papers')
+        previous = {r[0]: row_to_catalog_entry(cursor, r) for r in cursor.fetchall()}
+        seen = set()
+        for d in os.listdir(user_dir):
+            dir_path = os.path.join(user_dir, d)
+            if not os.path.isdir(dir_path):
+                continue
+            seen.add(d)
+            upsert_catalog_entry(conn, scan_paper_dir(dir_path, previous.get(d)))
+        conn.executemany(
+            'DELETE FROM papers WHERE dir_name = ?',
+            [(d,) for d in set(previous) - seen]
+        )
+        record_catalog_synced(conn, user_dir_mtime)
+    return len(seen)
+
+def ensure_catalog(username):
+    """
+    カタログを使う前に呼ぶ。未作成なら作り、ユーザーディレクトリの更新時刻が
+    前回の同期から変わっていれば、追加・削除された論文ディレクトリの行だけを更新する。
+    (user_db の接続を開く前に呼ぶこと)
+    """
+    user_dir = get_user_dir(username)
+    user_dir_mtime = os.stat(user_dir).st_mtime_ns
+    with user_db(username) as conn:
+        row = conn.execute('SELECT user_dir_mtime FROM catalog_state WHERE id = 1').fetchone()
+        known = {r[0] for r in conn.execute('SELECT dir_name FROM papers')} if row else None
+    if row is None:
+        rebuild_catalog(username)
+        return
+    if row[0] == user_dir_mtime:
+        return
+
+    current = {d for d in os.listdir(user_dir) if os.path.isdir(os.path.join(user_dir, d))}
+    for d in (current - known) | (known - current):
+        refresh_catalog_entry(username, d)
+    with user_db(username) as conn:
+        record_catalog_synced(conn, user_dir_mtime)
+
+def get_catalog_entry(dir_name):
+    """
+    "username/subdir" のカタログ行を返す。
+    未登録、またはディレクトリの更新時刻が記録と違う (ファイルが追加・削除・置き換えられた) 場合はその場で走査し直す。
+    """
+    username, sub_dir = split_user_dir_name(dir_name)
+    if not username:
+        return None
+    with user_db(username) as conn:
+        cursor = conn.execute('SELECT * FROM papers WHERE dir_name = ?', (sub_dir,))
+        row = cursor.fetchone()
+        entry = row_to_catalog_entry(cursor, row) if row else None
+
+    dir_path = os.path.join(get_user_dir(username), sub_dir)
+    try:
+        dir_mtime = os.stat(dir_path).st_mtime
+    except FileNotFoundError:
+        dir_mtime = None
+    if entry is None or entry['updated_at'] != dir_mtime:
+        entry = refresh_catalog_entry(username, sub_dir)
+        if entry:
+            entry['markdown_files'] = json.loads(entry['markdown_files'])
+            entry['image_files'] = json.loads(entry['image_files'])
+    return entry
+
+def find_origin_markdown(dir_name):
+    """
+    "username/subdir" 内の _origin.md のパスとベース名を返す (無ければ (None, None))
+    """
+    entry = get_catalog_entry(dir_name)
+    if not entry or not entry['has_origin']:
+        return None, None
+    origin_md_file = next(f for f in entry['markdown_files'] if f.lower().endswith('_origin.md'))
+    base_name = os.path.splitext(origin_md_file)[0].replace('_origin', '')
+    return os.path.join(CONTENT_DATA_DIR, dir_name, origin_md_file), base_name
+
+@app.route('/rebuild_catalog', methods=['POST'])
+def rebuild_catalog_endpoint():
+    """
+    ユーザーの論文カタログをディレクトリの内容から作り直す
+    """
+    data = request.get_json()
+    if not data or 'username' not in data:
+        return jsonify({'error': 'username is required'}), 400
+
+    username = data['username']
+    if '..' in username or '/' in username or '\\' in username:
+        return jsonify({'error': 'Invalid username.'}), 400
+    if not os.path.isdir(get_user_dir(username)):
+        return jsonify({'error': f'User directory not found: {username}'}), 404
+
+    try:
+        count = rebuild_catalog(username)
+        return jsonify({'message': 'Catalog rebuilt.', 'papers': count}), 200
+    except Exception as e:
+        error_traceback = traceback.format_exc()
+        print(error_traceback)
+        return jsonify({'error': f'Error rebuilding catalog: {str(e)}'}), 500
+
+########################################################################
+# 複数ワーカー・複数ホストでの排他
+#   同じボリューム (CONTENT_DATA_DIR) を共有するプロセス同士でも安全なように、
+#   ファイルは一時ファイルに書いてから置き換え、論文ディレクトリには読み書きロックを取る。
+#   論文を使う処理 (生成・取り込み・保存) は共有ロック、ディレクトリの削除は排他ロック
+########################################################################
+# ロックが取れるまで待つ最大秒数 (超えたら PaperBusy)
+PAPER_LOCK_TIMEOUT = float(os.getenv("PAPER_LOCK_TIMEOUT", "10"))
+
+class PaperBusy(Exception):
+    pass
+
+def unique_tmp_path(path):
+    """
+    複数のプロセス・スレッドが同じファイルを書いても衝突しない一時ファイル名
+    """
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """
+    一時ファイルに書き、最後まで書けたら置き換える (読み手が書きかけのファイルを見ないように)
+    """
+    tmp_path = unique_tmp_path(path)
+    try:
+        with open(tmp_path, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class PaperLock:
+    """
+    論文ディレクトリ ("username/subdir") 単位の読み書きロック (flock)。
+    ロックファイルはユーザーディレクトリ直下の .{subdir}.lock
+    """
+    def __init__(self, dir_name, exclusive=False):
+        username, sub_dir = split_user_dir_name(dir_name)
+        if not username:
+            raise ValueError(f"Invalid dir_name: {dir_name}")
+        # 論文内のサブディレクトリを指定された場合も、論文ごとロックする
+        sub_dir = sub_dir.split('/', 1)[0]
+        self.dir_path = os.path.join(get_user_dir(username), sub_dir)
+        self.path = os.path.join(get_user_dir(username), f".{sub_dir}.lock")
+        self.exclusive = exclusive
+        self._file = None
+
+    def acquire(self, timeout=None):
+        import fcntl
+
+        timeout = PAPER_LOCK_TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with trace_span("paper.lock", exclusive=self.exclusive) as span:
+            while True:
+                lock_file = open(self.path, 'a')
+                try:
+                    fcntl.flock(lock_file, (fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    if time.monotonic() >= deadline:
+                        raise PaperBusy("この論文は他の処理で使用中です。しばらくしてから再度お試しください。")
+                    span.add("retries")
+                    time.sleep(0.1)
+                    continue
+                # 削除した側がロックファイルを消した後に取れた場合は、作り直されたファイルで取り直す
+                try:
+                    if os.fstat(lock_file.fileno()).st_ino == os.stat(self.path).st_ino:
+                        break
+                except FileNotFoundError:
+                    pass
+                lock_file.close()
+        self._file = lock_file
+        if not os.path.isdir(self.dir_path):
+            self.release(remove=True)
+            raise FileNotFoundError(f"Directory not found: {os.path.basename(self.dir_path)}")
+        return self
+
+    def release(self, remove=False):
+        """
+        remove=True はディレクトリを削除した後に呼ぶ (ロックファイルも消す)
+        """
+        if self._file is None:
+            return
+        if remove:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+########################################################################
+# 成果物の作成・削除時のフック
+#   マークダウン等を書き込んだ/削除した後に必ず呼び、各種インデックスを追従させる
+########################################################################
+def on_artifact_written(dir_name, file_path):
+    """
+    "username/subdir" 内にファイルを書き込んだ後に呼ぶ
+    """
+    username, sub_dir = split_user_dir_name(dir_name)
+    if not username:
+        return
+    with trace_span("artifact.index", file=os.path.basename(file_path)):
+        try:
+            if file_path.lower().endswith('.md'):
+                write_precompressed_siblings(file_path)
+                write_markdown_outline(file_path)
+            refresh_catalog_entry(username, sub_dir)
+        except Exception:
+            traceback.print_exc()
+        update_search_index(dir_name, file_path)
+
+def on_artifact_removed(dir_name, file_name=None):
+    """
+    "username/subdir" 内のファイル (file_name 省略時はディレクトリごと) を削除した後に呼ぶ
+    """
+    username, sub_dir = split_user_dir_name(dir_name)
+    if not username:
+        return
+    try:
+        if file_name is None:
+            delete_sessions_for_dir(username, dir_name)
+        else:
+            remove_precompressed_siblings(os.path.join(CONTENT_DATA_DIR, dir_name, file_name))
+            remove_markdown_outline(os.path.join(CONTENT_DATA_DIR, dir_name, file_name))
+        remove_stored_artifacts(dir_name, file_name)
+        refresh_catalog_entry(username, sub_dir)
+    except Exception:
+        traceback.print_exc()
+    remove_from_search_index(dir_name, file_name)
+
+########################################################################
+# ストレージ (ローカル / S3 互換) と読み込みキャッシュ
+#   PDF・図表画像・DoclingDocument (大きく、取り込み後はほとんど書き換えない成果物) を STORAGE_BACKEND に保存する。
+#   s3 の場合、CONTENT_DATA_DIR はそれらの読み込みキャッシュを兼ね、合計が STORAGE_CACHE_MAX_GB を
+#   超えたら最近使っていないものからローカルのファイルを消す (必要になったら取り直す)。
+#   マークダウン・DB などはこれまでどおり CONTENT_DATA_DIR に置く。
+#   MinIO などの S3 互換ストレージは STORAGE_S3_ENDPOINT_URL で指定する (boto3 が必要)。
+########################################################################
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+STORAGE_S3_BUCKET = os.getenv("STORAGE_S3_BUCKET", "")
+STORAGE_S3_PREFIX = os.getenv("STORAGE_S3_PREFIX", "users/")
+STORAGE_S3_ENDPOINT_URL = os.getenv("STORAGE_S3_ENDPOINT_URL") or None
+STORAGE_CACHE_MAX_BYTES = int(float(os.getenv("STORAGE_CACHE_MAX_GB", "20")) * 1024 ** 3)
+# これより大きいファイルはマルチパートでアップロードする (バイト)
+STORAGE_MULTIPART_THRESHOLD = int(os.getenv("STORAGE_MULTIPART_THRESHOLD_MB", "8")) * 1024 * 1024
+STORAGE_PREFETCH_WORKERS = int(os.getenv("STORAGE_PREFETCH_WORKERS", "4"))
+STORAGE_CACHE_DB_PATH = os.path.join(CACHE_DIR, "storage_cache.db")
+# 最終アクセス時刻をこの秒数より細かくは更新しない (画像を読むたびに書き込まないため)
+STORAGE_TOUCH_INTERVAL = 60
+
+class LocalStorage:
+    """
+    CONTENT_DATA_DIR そのものを保存先とする (追加の処理は無い)
+    """
+    remote = False
+
+    def upload(self, key, local_path):
+        pass
+
+    def download(self, key, local_path):
+        return False
+
+    def list(self, prefix, recursive=True):
+        return {}
+
+    def delete(self, keys):
+        pass
+
+class S3Storage:
+    """
+    S3 互換のオブジェクトストレージ。キーは CONTENT_DATA_DIR からの相対パス ("username/subdir/file")
+    """
+    remote = True
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def upload(self, key, local_path):
+        from boto3.s3.transfer import TransferConfig
+        config = TransferConfig(
+            multipart_threshold=STORAGE_MULTIPART_THRESHOLD, multipart_chunksize=STORAGE_MULTIPART_THRESHOLD
+        )
+        self.client.upload_file(local_path, self.bucket, f"{self.prefix}{key}", Config=config)
+
+    def download(self, key, local_path):
+        """
+        戻り値: 取得できたか (オブジェクトが無ければ False)
+        """
+        from botocore.exceptions import ClientError
+        tmp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            self.client.download_file(self.bucket, f"{self.prefix}{key}", tmp_path)
+            os.replace(tmp_path, local_path)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return False
+            raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return True
+
+    def list(self, prefix, recursive=True):
+        """
+        戻り値: {キー: バイト数} (recursive=False のときは prefix 直下のものだけ)
+        """
+        objects = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        options = {} if recursive else {"Delimiter": "/"}
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}{prefix}", **options):
+            for obj in page.get("Contents", []):
+                objects[obj["Key"][len(self.prefix):]] = obj["Size"]
+        return objects
+
+    def delete(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": f"{self.prefix}{key}"} for key in keys[i:i + 1000]], "Quiet": True},
+            )
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == "s3":
+                    if not STORAGE_S3_BUCKET:
+                        raise ValueError("STORAGE_S3_BUCKET is required when STORAGE_BACKEND=s3")
+                    _storage = S3Storage(STORAGE_S3_BUCKET, STORAGE_S3_PREFIX, STORAGE_S3_ENDPOINT_URL)
+                else:
+                    _storage = LocalStorage()
+    return _storage
+
+def is_stored_artifact(file_name):
+    """
+    ストレージに置く成果物 (PDF・図表画像・DoclingDocument) か
+    """
+    name = os.path.basename(file_name)
+    return name.lower().endswith('.pdf') or is_element_image(name) or name.endswith(DOCLING_SUFFIX)
+
+def storage_key(file_path):
+    return os.path.relpath(file_path, CONTENT_DATA_DIR).replace(os.sep, '/')
+
+def init_storage_cache_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cached_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            accessed REAL NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cached_files_accessed ON cached_files (accessed)')
+
+def storage_cache_db():
+    """
+    ストレージに保存済みで、ローカルにも置いてあるファイルの一覧 (LRU の管理用)
+    """
+    return pooled_connection(STORAGE_CACHE_DB_PATH, init_storage_cache_schema)
+
+def remember_cached_file(file_path):
+    with storage_cache_db() as conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO cached_files (path, size, accessed) VALUES (?, ?, ?)',
+            (file_path, os.path.getsize(file_path), time.time())
+        )
+    evict_cached_files()
+
+def touch_cached_file(file_path):
+    now = time.time()
+    with storage_cache_db() as conn:
+        conn.execute(
+            'UPDATE cached_files SET accessed = ? WHERE path = ? AND accessed < ?',
+            (now, file_path, now - STORAGE_TOUCH_INTERVAL)
+        )
+
+def evict_cached_files():
+    """
+    ローカルのキャッシュが上限を超えていたら、最近使っていないファイルから上限の 9 割まで消す
+    """
+    with storage_cache_db() as conn:
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cached_files').fetchone()[0]
+        if total <= STORAGE_CACHE_MAX_BYTES:
+            return
+        with trace_span("storage.evict", bytes_before=total) as span:
+            for path, size in conn.execute('SELECT path, size FROM cached_files ORDER BY accessed').fetchall():
+                if total <= STORAGE_CACHE_MAX_BYTES * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                conn.execute('DELETE FROM cached_files WHERE path = ?', (path,))
+                total -= size
+                span.add("files")
+            span.set("bytes_after", total)
+
+def store_artifact(file_path):
+    """
+    成果物をストレージに保存する (s3 の場合、ローカルのファイルはキャッシュとして登録する)
+    """
+    storage = get_storage()
+    if not storage.remote or not is_stored_artifact(file_path):
+        return
+    with trace_span("storage.upload", file=os.path.basename(file_path), bytes=os.path.getsize(file_path)):
+        storage.upload(storage_key(file_path), file_path)
+    remember_cached_file(file_path)
+
+def store_paper_artifacts(dir_name):
+    """
+    "username/subdir" 内の成果物をまとめてストレージに保存する
+    """
+    if not get_storage().remote:
+        return
+    dir_path = os.path.join(CONTENT_DATA_DIR, dir_name)
+    for name in sorted(os.listdir(dir_path)):
+        file_path = os.path.join(dir_path, name)
+        if os.path.isfile(file_path) and is_stored_artifact(name):
+            store_artifact(file_path)
+
+def ensure_local_artifact(file_path):
+    """
+    ローカルに無ければストレージから取ってくる。戻り値: ローカルにあるか
+    """
+    storage = get_storage()
+    if os.path.isfile(file_path):
+        if storage.remote and is_stored_artifact(file_path):
+            touch_cached_file(file_path)
+        return True
+    if not storage.remote or not is_stored_artifact(file_path) or not os.path.isdir(os.path.dirname(file_path)):
+        return False
+    with trace_span("storage.fetch", file=os.path.basename(file_path)) as span:
+        if not storage.download(storage_key(file_path), file_path):
+            return False
+        span.set("bytes", os.path.getsize(file_path))
+    remember_cached_file(file_path)
+    return True
+
+def list_stored_artifacts(dir_path):
+    """
+    戻り値: {ファイル名: バイト数} (ストレージ側にあるもの。local の場合は空)
+    """
+    storage = get_storage()
+    if not storage.remote:
+        return {}
+    prefix = f"{storage_key(dir_path)}/"
+    return {key[len(prefix):]: size for key, size in storage.list(prefix, recursive=False).items()}
+
+def fetch_paper_artifacts(dir_path):
+    """
+    ストレージにあってローカルに無い成果物をすべて取ってくる (zip 作成・先読み用)
+    """
+    for name in list_stored_artifacts(dir_path):
+        if not os.path.exists(os.path.join(dir_path, name)):
+            ensure_local_artifact(os.path.join(dir_path, name))
+
+_prefetch_pool = None
+_prefetching = set()
+_prefetch_lock = threading.Lock()
+
+def prefetch_paper(dir_name):
+    """
+    論文を開いたときに、ローカルに無い PDF・画像を裏で取ってくる
+    """
+    global _prefetch_pool
+    if not get_storage().remote:
+        return
+    with _prefetch_lock:
+        if dir_name in _prefetching:
+            return
+        _prefetching.add(dir_name)
+        if _prefetch_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _prefetch_pool = ThreadPoolExecutor(max_workers=STORAGE_PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+    def run():
+        try:
+            fetch_paper_artifacts(os.path.join(CONTENT_DATA_DIR, dir_name))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with _prefetch_lock:
+                _prefetching.discard(dir_name)
+
+    _prefetch_pool.submit(contextvars.copy_context().run, run)
+
+def remove_stored_artifacts(dir_name, file_name=None):
+    """
+    ストレージ側の成果物 (file_name 省略時はディレクトリごと) とキャッシュの記録を削除する
+    """
+    storage = get_storage()
+    if not storage.remote:
+        return
+    dir_path = os.path.join(CONTENT_DATA_DIR, dir_name)
+    if file_name is None:
+        storage.delete(storage.list(f"{storage_key(dir_path)}/"))
+        with storage_cache_db() as conn:
+            prefix = dir_path + os.sep
+            conn.execute('DELETE FROM cached_files WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+    elif is_stored_artifact(file_name):
+        file_path = os.path.join(dir_path, file_name)
+        storage.delete([storage_key(file_path)])
+        with storage_cache_db() as conn:
+            conn.execute('DELETE FROM cached_files WHERE path = ?', (file_path,))
+
+########################################################################
+# レスポンス圧縮
+#   JSON / テキストはリクエストごとに圧縮、SSE はイベント単位で gzip、
+#   生成済みマークダウンは書き込み時に圧縮版 (.gz / .br) を作っておく
+########################################################################
+# この大きさ未満のレスポンス・ファイルは圧縮しない (バイト)
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# SSE の gzip 圧縮を行うか
+SSE_COMPRESSION = os.getenv("SSE_COMPRESSION", "1") == "1"
+
+COMPRESSIBLE_MIMETYPES = (
+    'application/json', 'text/markdown', 'text/plain', 'text/html', 'text/css', 'application/javascript'
+)
+
+# 優先度順 (拡張子, Content-Encoding)。brotli / zstandard は入っていれば使う
+PRECOMPRESSED_ENCODINGS = [('.br', 'br'), ('.gz', 'gzip')] if brotli else [('.gz', 'gzip')]
+
+def compress_bytes(data, encoding, static=False):
+    """
+    指定エンコーディングで圧縮する (static=True は保存用に高圧縮率で)
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if static else 5)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=19 if static else 3).compress(data)
+    return gzip.compress(data, compresslevel=9 if static else 6)
+
+def choose_content_encoding(candidates):
+    """
+    Accept-Encoding から、candidates (優先度順) のうちクライアントが受け付けるものを返す
+    """
+    for encoding in candidates:
+        if request.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+def gzip_event_stream(chunks):
+    """
+    SSE のイベントごとに SYNC_FLUSH して、即座にクライアントへ届くよう gzip 圧縮する
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        # 切断で閉じられたら元のストリームも閉じる (LLM のストリームや admission の枠を解放させる)
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+@app.after_request
+def compress_response(response):
+    """
+    JSON・テキストのレスポンスを Accept-Encoding に応じて圧縮する
+    """
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    if response.mimetype == 'text/event-stream':
+        if SSE_COMPRESSION and choose_content_encoding(['gzip']):
+            response.response = gzip_event_stream(response.response)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers.pop('Content-Length', None)
+        return response
+
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough or response.is_streamed:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+
+    encoding = choose_content_encoding(
+        (['br'] if brotli else []) + (['zstd'] if zstandard else []) + ['gzip']
+    )
+    if not encoding:
+        return response
+
+    response.set_data(compress_bytes(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+def write_precompressed_siblings(file_path):
+    """
+    マークダウンの圧縮版 (xxx.md.gz / xxx.md.br) を作成する。閾値未満なら古い圧縮版を消す。
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    for ext, encoding in PRECOMPRESSED_ENCODINGS:
+        sibling = file_path + ext
+        if len(data) < COMPRESSION_MIN_SIZE:
+            if os.path.exists(sibling):
+                os.remove(sibling)
+            continue
+        with atomic_write(sibling, 'wb') as f:
+            f.write(compress_bytes(data, encoding, static=True))
+
+def remove_precompressed_siblings(file_path):
+    """
+    圧縮版を削除する
+    """
+    for ext, _ in PRECOMPRESSED_ENCODINGS:
+        if os.path.exists(file_path + ext):
+            os.remove(file_path + ext)
+
+def find_precompressed_sibling(file_path, st):
+    """
+    元ファイル以降に作られた圧縮版があり、クライアントが受け付けるなら (パス, encoding) を返す
+    """
+    for ext, encoding in PRECOMPRESSED_ENCODINGS:
+        sibling = file_path + ext
+        try:
+            sibling_st = os.stat(sibling)
+        except FileNotFoundError:
+            continue
+        if sibling_st.st_mtime_ns >= st.st_mtime_ns and choose_content_encoding([encoding]):
+            return sibling, encoding
+    return None, None
+
+########################################################################
+# リクエスト単位のトレース
+#   全ルートを root span で囲み、X-Request-ID をレスポンスヘッダーに付ける。
+#   SSE では最初のイベントで request_id を送り、エラーイベントにも request_id を含める。
+#   compress_response より後に登録する (after_request は登録と逆順に呼ばれるため、圧縮前に実行される)
+#
+#   PROFILING=1 のとき、X-Profile: 1 ヘッダー付きのリクエストだけサンプリングプロファイラを動かし、
+#   PROFILE_DIR/<request_id>.folded (flamegraph.pl / speedscope で表示できる collapsed stack 形式) に保存する
+########################################################################
+PROFILING_ENABLED = os.getenv("PROFILING", "0") == "1"
+PROFILE_DIR = os.path.join(CACHE_DIR, "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+class SamplingProfiler:
+    """
+    指定スレッドのスタックを一定間隔で採取する
+    """
+    def __init__(self, thread_id, output_path, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.output_path = output_path
+        self.interval = interval
+        self.samples = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
+        with open(self.output_path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.samples.items(), key=lambda x: -x[1]):
+                f.write(f"{stack} {count}\n")
+        return self.output_path
+
+def finish_request_span(span, profiler=None, error=None):
+    if profiler is not None:
+        span.set("profile.path", profiler.stop())
+    span.end(error=error)
+
+def traced_stream(chunks, span, profiler=None, first=None):
+    """
+    ストリーミングレスポンスを送り終えた時点で root span を閉じる
+    """
+    error = None
+    try:
+        if first is not None:
+            span.add("http.response.body.size", len(first.encode("utf-8")))
+            yield first
+        for chunk in chunks:
+            span.add("http.response.body.size", len(chunk.encode("utf-8") if isinstance(chunk, str) else chunk))
+            yield chunk
+    except GeneratorExit:
+        span.set("cancelled", True)
+        raise
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+        finish_request_span(span, profiler, error)
+
+@app.before_request
+def start_request_trace():
+    route = request.url_rule.rule if request.url_rule else request.path
+    span = start_request_span(
+        f"{request.method} {route}", request.headers,
+        **{"http.method": request.method, "http.route": route}
+    )
+    g.trace_span = span
+    set_current_span(span)
+    if PROFILING_ENABLED and request.headers.get("X-Profile") == "1":
+        output_path = os.path.join(PROFILE_DIR, f"{span.request_id}.folded")
+        g.profiler = SamplingProfiler(threading.get_ident(), output_path).start()
+
+@app.after_request
+def finish_request_trace(response):
+    span = g.get("trace_span")
+    if span is None:
+        return response
+    response.headers["X-Request-ID"] = span.request_id
+    span.set("http.status_code", response.status_code)
+    if response.is_streamed and not response.direct_passthrough:
+        first = sse_event({"request_id": span.request_id}) if response.mimetype == 'text/event-stream' else None
+        response.response = traced_stream(response.response, span, g.get("profiler"), first)
+        g.trace_deferred = True
+    elif response.content_length is not None:
+        span.set("http.response.body.size", response.content_length)
+    return response
+
+@app.teardown_request
+def end_request_trace(error=None):
+    span = g.get("trace_span")
+    if span is None or g.get("trace_deferred"):
+        return
+    finish_request_span(span, g.get("profiler"), error)
+
+########################################################################
+# コンテンツファイル閲覧
+########################################################################
+# ファイル内容のハッシュ (強いETag) を stat 情報と紐づけて保持するキャッシュ
+#   (inode, mtime, size) が変わらない限り、再ハッシュせずに同じETagを返す
+FINGERPRINT_CACHE_SIZE = 4096
+# /contents で配信する PDF のキャッシュ期間 (秒)
+PDF_CACHE_MAX_AGE = int(os.getenv("PDF_CACHE_MAX_AGE", str(365 * 24 * 3600)))
+
+_fingerprint_cache = OrderedDict()
+_fingerprint_cache_lock = threading.Lock()
+
+def get_file_fingerprint(file_path, st=None, file=None):
+    """
+    ファイルのETag用フィンガープリントを返す
+    (file に開いたファイルを渡すと、パスを開き直さずにその内容から求める)
+    """
+    st = st or (os.fstat(file.fileno()) if file else os.stat(file_path))
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _fingerprint_cache_lock:
+        cached = _fingerprint_cache.get(file_path)
+        if cached and cached[0] == key:
+            _fingerprint_cache.move_to_end(file_path)
+            return cached[1]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with (nullcontext(file) if file else open(file_path, 'rb')) as f:
+        f.seek(0)
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    fingerprint = digest.hexdigest()
+
+    with _fingerprint_cache_lock:
+        _fingerprint_cache[file_path] = (key, fingerprint)
+        _fingerprint_cache.move_to_end(file_path)
+        while len(_fingerprint_cache) > FINGERPRINT_CACHE_SIZE:
+            _fingerprint_cache.popitem(last=False)
+    return fingerprint
+
+def is_element_image(filename):
+    """
+    変換時に生成する図表の画像 (picture-N.png / table-N.png) か
+    (再エクスポートで同じ名前のまま作り直されることがある)
+    """
+    name = os.path.basename(filename)
+    return (name.startswith('picture-') or name.startswith('table-')) and name.endswith('.png')
+
+@app.route('/contents/<path:filename>', methods=['GET'])
+def serve_content_files(filename):
+    """
+    contents ディレクトリからファイルを提供するエンドポイント。
+    ただし今回は /home/ubuntu/workspace/users/<username>/... を想定。
+    filename が "username/dir_name/xxx.pdf" などの形を許容。
+    ETag / If-None-Match (304) と Range (206) に対応する。
+    """
+    try:
+        # 安全なパス判定 (ストレージから取り寄せる前に、CONTENT_DATA_DIR の外を指していないか確かめる)
+        safe_path = os.path.join(CONTENT_DATA_DIR, filename)
+        if not os.path.abspath(safe_path).startswith(os.path.abspath(CONTENT_DATA_DIR) + os.sep):
+            return jsonify({'error': 'Invalid file path'}), 400
+        if not ensure_local_artifact(safe_path):
+            return jsonify({'error': 'File not found'}), 404
+
+        etag = get_file_fingerprint(safe_path)
+
+        # 圧縮版があればそれを返す (Range 指定時は元ファイル)
+        if filename.lower().endswith('.md') and 'Range' not in request.headers:
+            sibling, encoding = find_precompressed_sibling(safe_path, os.stat(safe_path))
+            if sibling:
+                response = send_file(
+                    sibling, mimetype='text/markdown', etag=f"{etag}-{encoding}", max_age=0
+                )
+                response.headers['Content-Encoding'] = encoding
+                response.cache_control.no_cache = True
+                response.vary.add('Accept-Encoding')
+                return response
+
+        if filename.lower().endswith('.pdf'):
+            # PDF は取り込み後に書き換えないので長くキャッシュさせる (期限後は ETag で再検証)
+            return send_from_directory(CONTENT_DATA_DIR, filename, etag=etag, max_age=PDF_CACHE_MAX_AGE)
+
+        # マークダウンは編集、図表の画像は再エクスポートで同じ名前のまま書き換わり得るので、毎回ETagで再検証させる
+        # (変わっていなければ 304 で本文は送らない)
+        response = send_from_directory(CONTENT_DATA_DIR, filename, etag=etag, max_age=0)
+        response.cache_control.no_cache = True
+        return response
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
+
+@app.route('/list_files/<path:dir_name>', methods=['GET'])
+def list_files(dir_name):
+    """
+    指定ディレクトリ内のPDFとMarkdownを返す。
+    例: dir_name = "alice/20230701010101_myPaper"
+    """
+    try:
+        entry = get_catalog_entry(dir_name)
+        if entry is None:
+            return jsonify({'error': 'Directory not found'}), 404
+
+        if entry['pdf_count'] != 1:
+            return jsonify({'error': 'ディレクトリ内にPDFファイルが1つではありません'}), 400
+
+        # 論文を開いたので、ローカルに無い PDF・画像を先に取ってきておく
+        prefetch_paper(dir_name)
+        return jsonify({
+            'markdown_files': entry['markdown_files'],
+            'pdf_file': entry['pdf_name']
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/list_contents', methods=['GET'])
+def list_contents():
+    """
+    username ディレクトリ直下にあるサブディレクトリ一覧を返す。
+    新しい順（更新時刻が新しい順）にソート。
+    """
+    username = request.args.get('username')
+    if not username:
+        return jsonify({'error': 'username is required'}), 400
+
+    if '..' in username or '/' in username or '\\' in username:
+        return jsonify({'error': 'Invalid username.'}), 400
+
+    # ユーザーのルートディレクトリ
+    user_dir = os.path.join(CONTENT_DATA_DIR, username)
+    if not os.path.isdir(user_dir):
+        return jsonify({'error': f'User directory not found: {username}'}), 404
+
+    try:
+        # カタログから更新時刻が新しい順に取得 (初回はディレクトリを走査して作成)
+        ensure_catalog(username)
+        with user_db(username) as conn:
+            rows = conn.execute('''
+                SELECT dir_name, display_name
+                FROM papers
+                ORDER BY updated_at DESC
+            ''').fetchall()
+
+        directories = [
+            {'dir_name': d, 'display_name': display_name}
+            for d, display_name in rows
+        ]
+
+        return jsonify({'directories': directories}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+########################################################################
+# 同時実行数の制限 (アドミッション制御)
+#   PDF変換 (convert) と LLM によるマークダウン生成 (generate) の同時実行数を
+#   全体・ユーザーごとに制限する。上限を超えたリクエストは 429 + Retry-After を返す
+#   (queue=1 を付けた場合は SSE で順番待ちの位置を送りながら待つ)。
+#   空きメモリが少ないときは PDF変換を 503 で断る。
+#   カウントはプロセスごと (ワーカー数だけ上限も増える)。
+########################################################################
+ADMISSION_LIMITS = {
+    "convert": {
+        "global": int(os.getenv("MAX_CONCURRENT_CONVERSIONS", "2")),
+        "per_user": int(os.getenv("MAX_USER_CONVERSIONS", "1")),
+        "retry_after": 30,
+        "shed_on_memory_pressure": True,
+    },
+    "generate": {
+        "global": int(os.getenv("MAX_CONCURRENT_GENERATIONS", "16")),
+        "per_user": int(os.getenv("MAX_USER_GENERATIONS", "3")),
+        "retry_after": 10,
+        "shed_on_memory_pressure": False,
+    },
+}
+# 空きメモリ (MemAvailable / MemTotal) がこの割合を下回ったら重い処理を受け付けない
+ADMISSION_MIN_FREE_MEMORY = float(os.getenv("ADMISSION_MIN_FREE_MEMORY", "0.1"))
+# 順番待ちの確認間隔・最大待ち時間 (秒)
+ADMISSION_QUEUE_POLL_INTERVAL = 1.0
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "600"))
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        self.reason = reason
+        self.retry_after = retry_after
+        # メモリ不足はサーバー側の事情なので 503、同時実行数の超過は 429
+        self.status = 503 if reason == "memory_pressure" else 429
+        super().__init__({
+            "busy": "混み合っています。しばらくしてから再度お試しください。",
+            "user_limit": "同時に実行できる処理数の上限に達しています。",
+            "memory_pressure": "サーバーのメモリが不足しています。しばらくしてから再度お試しください。",
+            "queue_timeout": "順番待ちがタイムアウトしました。",
+        }[reason])
+
+_memory_status = {"checked_at": 0.0, "free_ratio": None}
+
+def get_free_memory_ratio():
+    """
+    MemAvailable / MemTotal を返す (/proc/meminfo が無い環境では None)。1秒間は前回の値を使う
+    """
+    now = time.monotonic()
+    if now - _memory_status["checked_at"] < 1.0:
+        return _memory_status["free_ratio"]
+    free_ratio = None
+    try:
+        meminfo = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+        free_ratio = meminfo['MemAvailable'] / meminfo['MemTotal']
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        pass
+    _memory_status.update(checked_at=now, free_ratio=free_ratio)
+    return free_ratio
+
+class AdmissionController:
+    """
+    実行中・順番待ちの処理 (チケット) を管理する。
+    順番待ちは種類ごとに先着順で、ユーザー上限に達しているチケットは後続に追い越される
+    """
+    def __init__(self, limits):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._tickets = {}
+        self._seq = 0
+        # 種類ごとの所要時間の移動平均 (Retry-After の目安)
+        self._avg_seconds = {}
+
+    def _check(self, ticket):
+        limits = self.limits[ticket["kind"]]
+        if limits["shed_on_memory_pressure"]:
+            free_ratio = get_free_memory_ratio()
+            if free_ratio is not None and free_ratio < ADMISSION_MIN_FREE_MEMORY:
+                return "memory_pressure"
+        same_kind = [t for t in self._tickets.values() if t["kind"] == ticket["kind"] and t is not ticket]
+        running = [t for t in same_kind if t["state"] == "running"]
+        if sum(t["username"] == ticket["username"] for t in running) >= limits["per_user"]:
+            return "user_limit"
+        if len(running) >= limits["global"]:
+            return "busy"
+        # 先に並んでいて、実行できるチケットがあればそちらを優先する
+        for other in same_kind:
+            if other["state"] == "queued" and other["seq"] < ticket["seq"] and \
+                    sum(t["username"] == other["username"] for t in running) < limits["per_user"]:
+                return "busy"
+        return None
+
+    def retry_after(self, kind):
+        return max(1, round(self._avg_seconds.get(kind, self.limits[kind]["retry_after"])))
+
+    def admit(self, kind, username, endpoint, queue=False):
+        """
+        戻り値: チケット (state が "queued" の場合は poll() で順番を待つ)
+        上限を超えていて queue=False の場合は AdmissionRejected
+        """
+        with self._lock:
+            self._seq += 1
+            ticket = {
+                "id": self._seq, "seq": self._seq, "kind": kind, "username": username or "",
+                "endpoint": endpoint, "request_id": current_request_id(),
+                "state": "queued", "queued_at": time.time(), "started_at": None,
+            }
+            reason = self._check(ticket)
+            if reason is None:
+                ticket.update(state="running", started_at=time.time())
+            elif not queue or reason == "memory_pressure":
+                raise AdmissionRejected(reason, self.retry_after(kind))
+            self._tickets[ticket["id"]] = ticket
+            return ticket
+
+    def poll(self, ticket):
+        """
+        順番が来ていれば実行中にして None、まだなら順番待ちの位置 (1〜) を返す
+        """
+        with self._lock:
+            if ticket["state"] == "running":
+                return None
+            if self._check(ticket) is None:
+                ticket.update(state="running", started_at=time.time())
+                return None
+            return 1 + sum(
+                1 for t in self._tickets.values()
+                if t["kind"] == ticket["kind"] and t["state"] == "queued" and t["seq"] < ticket["seq"]
+            )
+
+    def detach(self, ticket):
+        """
+        リクエストの終了後もバックグラウンドで処理を続ける場合に呼ぶ (release(ticket, detached=True) で解放する)
+        """
+        ticket["detached"] = True
+
+    def release(self, ticket, detached=False):
+        if ticket.get("detached") and not detached:
+            return
+        with self._lock:
+            if self._tickets.pop(ticket["id"], None) is None:
+                return
+            if ticket["state"] == "running":
+                elapsed = time.time() - ticket["started_at"]
+                previous = self._avg_seconds.get(ticket["kind"])
+                self._avg_seconds[ticket["kind"]] = elapsed if previous is None else previous * 0.8 + elapsed * 0.2
+
+    def snapshot(self):
+        with self._lock:
+            tickets = [dict(t) for t in self._tickets.values()]
+            avg_seconds = dict(self._avg_seconds)
+        now = time.time()
+        users = {}
+        for t in sorted(tickets, key=lambda t: t["seq"]):
+            t["waiting_seconds"] = round((t["started_at"] or now) - t["queued_at"], 1)
+            t["running_seconds"] = round(now - t["started_at"], 1) if t["started_at"] else None
+            users.setdefault(t["username"], []).append(t)
+        return {
+            "limits": self.limits,
+            "running": {kind: sum(t["kind"] == kind and t["state"] == "running" for t in tickets) for kind in self.limits},
+            "queued": {kind: sum(t["kind"] == kind and t["state"] == "queued" for t in tickets) for kind in self.limits},
+            "avg_seconds": {kind: round(v, 1) for kind, v in avg_seconds.items()},
+            "free_memory_ratio": get_free_memory_ratio(),
+            "min_free_memory_ratio": ADMISSION_MIN_FREE_MEMORY,
+            "users": users,
+        }
+
+admission = AdmissionController(ADMISSION_LIMITS)
+
+def admission_rejected_response(error):
+    response = jsonify({"error": str(error), "reason": error.reason, "retry_after": error.retry_after})
+    response.status_code = error.status
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+def stream_with_admission(kind, username, generate):
+    """
+    同時実行数の上限内で generate() の SSE を返す Response を作る。
+    上限を超えていれば 429 / 503、queue=1 の場合は {"queue_position": N} を送りながら順番を待つ
+    """
+    try:
+        ticket = admission.admit(kind, username, request.path, queue=request.args.get('queue') == '1')
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+
+    g.admission_ticket = ticket
+
+    @stream_with_context
+    def stream():
+        try:
+            deadline = time.monotonic() + ADMISSION_QUEUE_TIMEOUT
+            last_position = None
+            while True:
+                position = admission.poll(ticket)
+                if position is None:
+                    break
+                if time.monotonic() > deadline:
+                    error = AdmissionRejected("queue_timeout", admission.retry_after(kind))
+                    yield sse_event({"error": str(error), "reason": error.reason})
+                    return
+                if position != last_position:
+                    yield sse_event({"queue_position": position})
+                    last_position = position
+                time.sleep(ADMISSION_QUEUE_POLL_INTERVAL)
+            yield from generate()
+        finally:
+            admission.release(ticket)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    # ジェネレータが始まる前にレスポンスが閉じられた場合も枠を返す (release は2回呼んでも問題ない)
+    response.call_on_close(lambda: admission.release(ticket))
+    return response
+
+@app.route('/admission', methods=['GET'])
+def admission_status():
+    """
+    実行中・順番待ちの重い処理をユーザーごとに返す (管理者用)
+    """
+    if not is_admin(request.args.get('username')):
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(admission.snapshot()), 200
+
+########################################################################
+# チャットモデルの初期化 (初回使用時に生成)
+########################################################################
+FAKE_LLM_RESPONSE = "これは負荷試験用のダミー応答です。" * 20
+FAKE_LLM_SLEEP = float(os.getenv("FAKE_LLM_SLEEP", "0.02"))
+
+def init_chat_model(use_aoai=False, fake_llm=False):
+    from langchain_openai import ChatOpenAI, AzureChatOpenAI
+    if fake_llm:
+        from langchain_core.language_models import FakeListChatModel
+        print(">>> ダミーのチャットモデルを使用します。")
+        return FakeListChatModel(responses=[FAKE_LLM_RESPONSE], sleep=FAKE_LLM_SLEEP)
+    if use_aoai:
+        print(">>> AzureOpenAI を使用します。")
+        return AzureChatOpenAI(
+            openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+            azure_deployment=os.getenv("AZURE_CHAT_DEPLOYMENT"),
+            temperature=0
+        )
+    print(">>> ChatOpenAI を使用します。")
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=1
+    )
+
+_chat_model_lock = threading.Lock()
+
+def get_chat_model():
+    """
+    チャットモデルを初回使用時に生成する (langchain_openai の import もここで行う)
+    """
+    if app.config["CHAT_MODEL"] is None:
+        with _chat_model_lock:
+            if app.config["CHAT_MODEL"] is None:
+                app.config["CHAT_MODEL"] = init_chat_model(**app.config["CHAT_MODEL_OPTIONS"])
+    return app.config["CHAT_MODEL"]
+
+########################################################################
+# モデルルーティング
+#   処理 (ingest / translate / explain / thread / chat) ごとに使うモデル・タイムアウト・
+#   最大トークン数・フォールバック先を MODEL_ROUTES_PATH (JSON) で指定する。
+#   ファイルを書き換えるか PUT /model_routes で、再起動せずに切り替えられる。
+#   ファイルが無ければ全処理で default モデル (--aoai / --fake_llm の指定に従う) を使う。
+#   書式は model_routes_template.json を参照。
+########################################################################
+MODEL_ROUTES_PATH = os.getenv("MODEL_ROUTES_PATH", "model_routes.json")
+LLM_ROUTES = ("ingest", "translate", "explain", "thread", "chat")
+DEFAULT_MODEL_NAME = "default"
+# 設定ファイルの更新確認の間隔 (秒)
+MODEL_ROUTES_RELOAD_INTERVAL = 2.0
+# 統計に残す直近の呼び出し数 (レイテンシのパーセンタイル計算用)
+LLM_ROUTE_STATS_WINDOW = 200
+
+# 管理用エンドポイント (/model_routes など) を使えるユーザー (カンマ区切り)
+ADMIN_USERS = set(u for u in os.getenv("ADMIN_USERS", "").split(",") if u)
+
+_model_routes = {"config": None, "mtime": None, "checked_at": 0.0}
+_model_routes_lock = threading.Lock()
+_route_models = {}
+_llm_route_stats = {}
+_llm_route_stats_lock = threading.Lock()
+
+def is_admin(username):
+    return bool(username) and username in ADMIN_USERS
+
+def default_model_routes():
+    return {"models": {}, "routes": {route: {"model": DEFAULT_MODEL_NAME} for route in LLM_ROUTES}}
+
+def validate_model_routes(config):
+    """
+    設定の形式をチェックする。問題があれば ValueError
+    """
+    if not isinstance(config, dict):
+        raise ValueError("config must be an object")
+    models = config.get("models", {})
+    routes = config.get("routes", {})
+    if not isinstance(models, dict) or not isinstance(routes, dict):
+        raise ValueError("models / routes must be objects")
+    for name, definition in models.items():
+        provider = definition.get("provider", "openai")
+        if provider not in ("openai", "azure", "fake"):
+            raise ValueError(f"models.{name}: unknown provider {provider}")
+        if provider == "openai" and not definition.get("model"):
+            raise ValueError(f"models.{name}: model is required")
+        if provider == "azure" and not definition.get("deployment"):
+            raise ValueError(f"models.{name}: deployment is required")
+    for route, spec in routes.items():
+        if route not in LLM_ROUTES:
+            raise ValueError(f"routes.{route}: unknown route (expected one of {', '.join(LLM_ROUTES)})")
+        for name in [spec.get("model", DEFAULT_MODEL_NAME)] + list(spec.get("fallbacks", [])):
+            if name != DEFAULT_MODEL_NAME and name not in models:
+                raise ValueError(f"routes.{route}: unknown model {name}")
+        for key in ("timeout", "max_tokens"):
+            if spec.get(key) is not None and not (isinstance(spec[key], (int, float)) and spec[key] > 0):
+                raise ValueError(f"routes.{route}.{key} must be a positive number")
+
+def load_model_routes():
+    """
+    ルーティング設定を返す。ファイルが更新されていれば読み直す (不正な内容なら前の設定を使い続ける)
+    """
+    now = time.monotonic()
+    cached = _model_routes["config"]
+    if cached is not None and now - _model_routes["checked_at"] < MODEL_ROUTES_RELOAD_INTERVAL:
+        return cached
+
+    with _model_routes_lock:
+        _model_routes["checked_at"] = now
+        try:
+            mtime = os.stat(MODEL_ROUTES_PATH).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if _model_routes["config"] is not None and mtime == _model_routes["mtime"]:
+            return _model_routes["config"]
+
+        config = default_model_routes()
+        if mtime is not None:
+            try:
+                with open(MODEL_ROUTES_PATH, 'r', encoding='utf-8') as f:
+                    loaded = json.load(f)
+                validate_model_routes(loaded)
+                config["models"] = loaded.get("models", {})
+                config["routes"].update(loaded.get("routes", {}))
+                print(f">>> モデルルーティング設定を読み込みました ({MODEL_ROUTES_PATH})")
+            except (OSError, ValueError) as e:
+                print(f">>> モデルルーティング設定の読み込みに失敗しました: {e}")
+                if _model_routes["config"] is not None:
+                    return _model_routes["config"]
+        _model_routes.update(config=config, mtime=mtime)
+        return config
+
+def save_model_routes(config):
+    validate_model_routes(config)
+    with atomic_write(MODEL_ROUTES_PATH) as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    _model_routes["checked_at"] = 0.0
+    return load_model_routes()
+
+def create_chat_model(definition, timeout=None, max_tokens=None):
+    provider = definition.get("provider", "openai")
+    if provider == "fake":
+        from langchain_core.language_models import FakeListChatModel
+        return FakeListChatModel(
+            responses=[definition.get("response", FAKE_LLM_RESPONSE)],
+            sleep=definition.get("sleep", FAKE_LLM_SLEEP),
+        )
+    from langchain_openai import ChatOpenAI, AzureChatOpenAI
+    options = {"max_retries": definition.get("max_retries", 2)}
+    if timeout:
+        options["timeout"] = timeout
+    if max_tokens:
+        options["max_tokens"] = int(max_tokens)
+    if provider == "azure":
+        return AzureChatOpenAI(
+            openai_api_version=definition.get("api_version") or os.getenv("AZURE_OPENAI_API_VERSION"),
+            azure_deployment=definition["deployment"],
+            **options
+        )
+    return ChatOpenAI(model=definition["model"], **options)
+
+def get_route_model(config, name, timeout=None, max_tokens=None):
+    """
+    モデル名と route の設定からモデルを返す (同じ設定のモデルは使い回す)
+    """
+    definition = config["models"].get(name)
+    if definition is None:
+        # default は起動オプションで決まるモデル。タイムアウト等の指定が無ければ共有モデルを使う
+        if not timeout and not max_tokens:
+            return get_chat_model()
+        options = app.config["CHAT_MODEL_OPTIONS"]
+        if options.get("fake_llm"):
+            definition = {"provider": "fake"}
+        elif options.get("use_aoai"):
+            definition = {"provider": "azure", "deployment": os.getenv("AZURE_CHAT_DEPLOYMENT")}
+        else:
+            definition = {"provider": "openai", "model": "gpt-4o-mini"}
+
+    key = (name, json.dumps(definition, sort_keys=True), timeout, max_tokens)
+    model = _route_models.get(key)
+    if model is None:
+        with _chat_model_lock:
+            model = _route_models.get(key)
+            if model is None:
+                model = create_chat_model(definition, timeout, max_tokens)
+                _route_models[key] = model
+    return model
+
+def resolve_route(route):
+    """
+    戻り値: [(モデル名, モデル), ...] (先頭が第一候補、以降はフォールバック)
+    """
+    config = load_model_routes()
+    spec = config["routes"].get(route) or {"model": DEFAULT_MODEL_NAME}
+    names = [spec.get("model", DEFAULT_MODEL_NAME)] + list(spec.get("fallbacks", []))
+    return [
+        (name, get_route_model(config, name, spec.get("timeout"), spec.get("max_tokens")))
+        for name in names
+    ]
+
+def record_route_call(route, model_name, started, span, cb=None, error=None, fallbacks=0):
+    """
+    route ごとの呼び出し回数・エラー・レイテンシ・トークン数・コストを集計する
+    """
+    latency_ms = (time.perf_counter() - started) * 1000
+    with _llm_route_stats_lock:
+        stats = _llm_route_stats.get(route)
+        if stats is None:
+            stats = _llm_route_stats[route] = {
+                "calls": 0, "errors": 0, "fallbacks": 0, "total_tokens": 0, "cost_usd": 0.0,
+                "latency_ms": deque(maxlen=LLM_ROUTE_STATS_WINDOW),
+                "first_chunk_ms": deque(maxlen=LLM_ROUTE_STATS_WINDOW),
+                "models": {},
+            }
+        stats["calls"] += 1
+        stats["fallbacks"] += fallbacks
+        stats["models"][model_name] = stats["models"].get(model_name, 0) + 1
+        if error is not None:
+            stats["errors"] += 1
+            return
+        stats["latency_ms"].append(latency_ms)
+        if "llm.first_chunk_ms" in span.attributes:
+            stats["first_chunk_ms"].append(span.attributes["llm.first_chunk_ms"])
+        if cb is not None:
+            stats["total_tokens"] += cb.total_tokens
+            stats["cost_usd"] += float(cb.total_cost)
+
+def get_route_stats():
+    def percentile(values, p):
+        if not values:
+            return None
+        values = sorted(values)
+        return round(values[min(len(values) - 1, int(len(values) * p))], 1)
+
+    with _llm_route_stats_lock:
+        return {
+            route: {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "fallbacks": stats["fallbacks"],
+                "models": dict(stats["models"]),
+                "total_tokens": stats["total_tokens"],
+                "cost_usd": round(stats["cost_usd"], 6),
+                "latency_ms_p50": percentile(stats["latency_ms"], 0.5),
+                "latency_ms_p95": percentile(stats["latency_ms"], 0.95),
+                "first_chunk_ms_p50": percentile(stats["first_chunk_ms"], 0.5),
+            }
+            for route, stats in _llm_route_stats.items()
+        }
+
+@app.route('/model_routes', methods=['GET', 'PUT'])
+def model_routes():
+    """
+    GET: 現在のルーティング設定と route ごとの統計 (このプロセス分)
+    PUT: ルーティング設定を置き換える (全ワーカーにファイル経由で反映される)
+    """
+    username = request.args.get('username')
+    if not is_admin(username):
+        return jsonify({"error": "Forbidden"}), 403
+
+    if request.method == 'PUT':
+        try:
+            config = save_model_routes(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        config = load_model_routes()
+    return jsonify({"config": config, "stats": get_route_stats()})
+
+########################################################################
+# LLM呼び出し (共通処理)
+########################################################################
+LLM_OUTPUT_START = "$=~=$start$=~=$"
+LLM_OUTPUT_END = "$=~=$end$=~=$"
+
+def sse_event(data):
+    """
+    SSE の1イベント分の文字列を作る (エラーには問い合わせ用の request_id を付ける)
+    """
+    if "error" in data:
+        request_id = current_request_id()
+        if request_id:
+            data = {**data, "request_id": request_id}
+    return f'data: {json.dumps(data)}\n\n'
+
+def get_openai_callback():
+    from langchain_community.callbacks.manager import get_openai_callback as openai_callback
+    return openai_callback()
+
+def build_chat_messages(system_prompt, human_text):
+    from langchain_core.messages import SystemMessage, HumanMessage
+    return [SystemMessage(content=system_prompt), HumanMessage(content=human_text)]
+
+def print_token_usage(cb, span=None):
+    print(f"\nTotal Tokens: {cb.total_tokens}")
+    print(f"Prompt Tokens: {cb.prompt_tokens}")
+    print(f"Completion Tokens: {cb.completion_tokens}")
+    print(f"Total Cost (USD): ${cb.total_cost}\n")
+    if span is not None:
+        span.set("llm.prompt_tokens", cb.prompt_tokens)
+        span.set("llm.completion_tokens", cb.completion_tokens)
+        span.set("llm.cost_usd", float(cb.total_cost))
+
+def record_llm_chunk(span, content):
+    if "llm.first_chunk_ms" not in span.attributes:
+        span.set("llm.first_chunk_ms", span.duration_ms)
+    span.add("llm.chunks")
+    span.add("llm.output_chars", len(content))
+
+def prepare_chat_model(chat_model, temperature, streaming=True):
+    """
+    共有モデルを書き換えると並行リクエスト間で温度が混ざるため、設定済みのコピーを返す
+    """
+    return chat_model.model_copy(
+        update={"temperature": temperature, "streaming": streaming}
+    )
+
+def stream_llm(route, messages, temperature, usage=None):
+    """
+    LLMの出力をストリーミングで返すジェネレータ (空のチャンクは返さない)
+    最初のチャンクを返す前に失敗した場合は route のフォールバック先で再試行する。
+    usage (dict) を渡すと、終了後にトークン数とコストを書き込む
+    """
+    with get_openai_callback() as cb, trace_span("llm.stream", **{"llm.route": route, "llm.temperature": temperature}) as span:
+        started = time.perf_counter()
+        candidates = resolve_route(route)
+        for attempt, (model_name, chat_model) in enumerate(candidates):
+            span.set("llm.model", model_name)
+            emitted = False
+            try:
+                for result in prepare_chat_model(chat_model, temperature).stream(messages):
+                    if result.content:
+                        emitted = True
+                        record_llm_chunk(span, result.content)
+                        yield result.content
+                break
+            except Exception as e:
+                if emitted or attempt == len(candidates) - 1:
+                    record_route_call(route, model_name, started, span, error=e, fallbacks=attempt)
+                    raise
+                print(f">>> [{route}] {model_name} の呼び出しに失敗したため {candidates[attempt + 1][0]} で再試行します: {e}")
+                span.add("llm.fallbacks")
+        print_token_usage(cb, span)
+        record_route_call(route, model_name, started, span, cb, fallbacks=attempt)
+        if usage is not None:
+            usage.update(total_tokens=cb.total_tokens, cost_usd=float(cb.total_cost))
+
+async def astream_llm(route, messages, temperature):
+    """
+    stream_llm の非同期版 (ASGIモードで使用)
+    """
+    with get_openai_callback() as cb, trace_span("llm.stream", **{"llm.route": route, "llm.temperature": temperature}) as span:
+        started = time.perf_counter()
+        candidates = resolve_route(route)
+        for attempt, (model_name, chat_model) in enumerate(candidates):
+            span.set("llm.model", model_name)
+            emitted = False
+            try:
+                async for result in prepare_chat_model(chat_model, temperature).astream(messages):
+                    if result.content:
+                        emitted = True
+                        record_llm_chunk(span, result.content)
+                        yield result.content
+                break
+            except Exception as e:
+                if emitted or attempt == len(candidates) - 1:
+                    record_route_call(route, model_name, started, span, error=e, fallbacks=attempt)
+                    raise
+                print(f">>> [{route}] {model_name} の呼び出しに失敗したため {candidates[attempt + 1][0]} で再試行します: {e}")
+                span.add("llm.fallbacks")
+        print_token_usage(cb, span)
+        record_route_call(route, model_name, started, span, cb, fallbacks=attempt)
+
+def invoke_llm(route, messages, temperature):
+    """
+    ストリーミングせずに応答を1つ返す (失敗時は route のフォールバック先で再試行する)
+    """
+    with get_openai_callback() as cb, trace_span("llm.invoke", **{"llm.route": route, "llm.temperature": temperature}) as span:
+        started = time.perf_counter()
+        candidates = resolve_route(route)
+        for attempt, (model_name, chat_model) in enumerate(candidates):
+            span.set("llm.model", model_name)
+            try:
+                answer = prepare_chat_model(chat_model, temperature, streaming=False).invoke(messages)
+                break
+            except Exception as e:
+                if attempt == len(candidates) - 1:
+                    record_route_call(route, model_name, started, span, error=e, fallbacks=attempt)
+                    raise
+                print(f">>> [{route}] {model_name} の呼び出しに失敗したため {candidates[attempt + 1][0]} で再試行します: {e}")
+                span.add("llm.fallbacks")
+        print_token_usage(cb, span)
+        record_route_call(route, model_name, started, span, cb, fallbacks=attempt)
+        return answer
+
+def strip_code_fence(text):
+    return text.replace("```markdown", "").replace("```", "")
+
+########################################################################
+# 取り込み・生成の手順 (Flask / ASGI 共通)
+#   手順はジェネレータで1つだけ書き、送るイベントやブロッキング処理・LLM の呼び出しを
+#   下の命令として yield する。Flask は iter_step_events で命令をその場で実行し、
+#   ASGI (asgi.send_step_events) はブロッキング処理をスレッドで、LLM を astream で実行する。
+#   命令の戻り値は send で、例外は throw で手順に返す。
+########################################################################
+class Emit:
+    """
+    イベントを送る
+    """
+    def __init__(self, data):
+        self.data = data
+
+class Call:
+    """
+    ブロッキング処理を実行する (戻り値: func の戻り値)
+    """
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+class OpenLLMStream:
+    """
+    LLM のストリーミングを始める (戻り値: NextChunk に渡すストリーム)
+    """
+    def __init__(self, route, messages, temperature):
+        self.route = route
+        self.messages = messages
+        self.temperature = temperature
+
+class NextChunk:
+    """
+    LLM の出力を1チャンク読む (戻り値: チャンク。終わりなら None)
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+class Sleep:
+    """
+    seconds 秒待つ (ASGI ではスレッドを使わずに待つ)
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+def iter_step_events(steps):
+    """
+    手順をこのスレッドで実行し、SSE の文字列を順に返すジェネレータ (Flask 用)。
+    途中で閉じられたら手順も閉じる (手順側には GeneratorExit が届く)
+    """
+    streams = []
+    value = error = None
+    try:
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration:
+                return
+            value = error = None
+            try:
+                if isinstance(step, Emit):
+                    yield sse_event(step.data)
+                elif isinstance(step, Call):
+                    value = step.func(*step.args)
+                elif isinstance(step, OpenLLMStream):
+                    value = stream_llm(step.route, step.messages, step.temperature)
+                    streams.append(value)
+                elif isinstance(step, NextChunk):
+                    value = next(step.stream, None)
+                elif isinstance(step, Sleep):
+                    time.sleep(step.seconds)
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+        for stream in streams:
+            stream.close()
+
+########################################################################
 # PDFアップロードまたはURL読み込み → マークダウン化
 ########################################################################
-@app.route('/pdf2markdown', methods=['POST'])
-def pdf2markdown():
+IMAGE_RESOLUTION_SCALE = 2.0
+
+# 図表の位置に画像リンクを挿入させるためのプロンプト
+PLACEHOLDER_SYSTEM_PROMPT = \
+"""
+                与えられたマークダウン文章に以下の処理を行い、追記後のマークダウン文章を出力してください。
+
+                ・文章中における図の部分に、`![Local Image](picture-$.png)\n`($は図番号)を追記してください。
+                ・文章中における表の部分に、`![Local Image](table-$.png)\n`($は表番号)を追記してください。
+
+                出力は、必ずマークダウン文章のみで、余計な文章は含めないでください。
+                """
+
+@app.route('/pdf2markdown', methods=['POST'])
+def pdf2markdown():
+    """
+    PDFファイルを受け取り（またはURL）、Markdownへ変換。
+    SSE (Server-Sent Events)で進捗を返す。
+    """
+    username = request.args.get('username')
+    if not username:
+        return jsonify({"error": "username is required"}), 400
+
+    def generate():
+        yield from iter_step_events(pdf2markdown_steps(request, username, g.admission_ticket))
+
+    return stream_with_admission("convert", username, generate)
+
+def read_pdf_request(req):
+    """
+    リクエストからアップロードされたPDF、またはURL指定のPDFを取り出す。
+    戻り値: (ファイル名, ストリーム)
+    """
+    if 'file' in req.files:
+        pdf_file = req.files['file']
+        return pdf_file.filename, pdf_file.stream
+    elif req.is_json and 'url' in req.json:
+        pdf_url = req.json['url']
+        file_name = os.path.basename(pdf_url)
+        if not file_name.lower().endswith('.pdf'):
+            file_name += '.pdf'
+        with trace_span("pdf.download") as span:
+            response = requests.get(pdf_url)
+            response.raise_for_status()
+            span.set("bytes", len(response.content))
+        # --- ここで Content-Type が "pdf" かどうか簡易チェック ---
+        ctype = response.headers.get("Content-Type", "").lower()
+        if "pdf" not in ctype:
+            raise ValueError("指定されたURLはPDFを返しませんでした。")
+
+        return file_name, BytesIO(response.content)
+    else:
+        raise ValueError("No valid PDF file or URL provided")
+
+def create_paper_dir(file_name, username):
+    """
+    論文用ディレクトリ (timestamp_ベース名) を作成する。
+    戻り値: (ベース名, ディレクトリ名, ディレクトリのパス)
+    """
+    base_name = os.path.splitext(file_name)[0]
+
+    user_dir = os.path.join(CONTENT_DATA_DIR, username)
+    os.makedirs(user_dir, exist_ok=True)
+
+    # 同じ秒に別のワーカー・ホストで取り込んでも衝突しないよう乱数を付け、既にあれば作り直す
+    while True:
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        dir_name = f"{timestamp}-{secrets.token_hex(3)}_{base_name}"
+        output_dir = os.path.join(user_dir, dir_name)
+        try:
+            os.mkdir(output_dir)
+            return base_name, dir_name, output_dir
+        except FileExistsError:
+            continue
+
+def save_pdf_file(pdf_stream, output_dir, file_name):
+    pdf_file_path = os.path.join(output_dir, file_name)
+    with trace_span("pdf.save") as span, atomic_write(pdf_file_path, "wb") as f:
+        span.set("bytes", f.write(pdf_stream.read()))
+    return pdf_file_path
+
+# PDF解析 (docling) の設定。bench_pdf_convert.py で設定ごとの性能を比較できる
+#   table_policy: auto = 表のあるページだけ後から FAST / ACCURATE を選んで表構造を解析 / off = 表は画像のみ
+#   ocr_mode: auto = テキスト層の無いページだけ OCR / off = OCR しない / full = 全ページ OCR
+PDF_PIPELINE_DEFAULTS = {
+    "do_ocr": False,
+    "do_table_structure": False,
+    "table_mode": "accurate",
+    "images_scale": IMAGE_RESOLUTION_SCALE,
+    "generate_picture_images": True,
+    "generate_table_images": True,
+    "table_policy": os.getenv("PDF_TABLE_POLICY", "auto"),
+    "ocr_mode": os.getenv("PDF_OCR_MODE", "auto"),
+    "ocr_lang": os.getenv("PDF_OCR_LANG", "en").split(","),
+    "force_full_page_ocr": False,
+}
+# 空白以外の文字がこの数未満のページはテキスト層が無いとみなす
+OCR_MIN_PAGE_CHARS = 20
+# OCR を並列に実行するスレッド数 (ページをこの数に分けて変換する)
+PDF_OCR_WORKERS = int(os.getenv("PDF_OCR_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) // 2)))))
+
+def build_pipeline_options(**overrides):
+    """
+    PDF_PIPELINE_DEFAULTS に overrides を上書きした docling の PdfPipelineOptions を作る
+    """
+    from docling.datamodel.pipeline_options import (
+        EasyOcrOptions,
+        PdfPipelineOptions,
+        TableFormerMode,
+    )
+    settings = {**PDF_PIPELINE_DEFAULTS, **overrides}
+
+    pipeline_options = PdfPipelineOptions()
+    pipeline_options.do_ocr = settings["do_ocr"]
+    pipeline_options.do_table_structure = settings["do_table_structure"]
+    pipeline_options.table_structure_options.do_cell_matching = False
+    pipeline_options.table_structure_options.mode = (
+        TableFormerMode.FAST if settings["table_mode"] == "fast" else TableFormerMode.ACCURATE
+    )
+    pipeline_options.images_scale = settings["images_scale"]
+    pipeline_options.generate_page_images = False
+    pipeline_options.generate_table_images = settings["generate_table_images"]
+    pipeline_options.generate_picture_images = settings["generate_picture_images"]
+    if settings["do_ocr"]:
+        pipeline_options.ocr_options = EasyOcrOptions(
+            lang=settings["ocr_lang"],
+            use_gpu=False,
+            force_full_page_ocr=settings["force_full_page_ocr"],
+        )
+    return pipeline_options
+
+def convert_pdf(pdf_file_path, pipeline_options=None, converter=None):
+    """
+    docling で PDF を解析する (converter を渡すと読み込み済みのモデルを使い回す)
+    """
+    from docling.datamodel.base_models import InputFormat
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+
+    if converter is None:
+        converter = DocumentConverter(
+            format_options={
+                InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options or build_pipeline_options())
+            }
+        )
+
+    with trace_span("pdf.convert", bytes=os.path.getsize(pdf_file_path)) as span:
+        conv_res = converter.convert(pdf_file_path)
+        span.set("pages", len(conv_res.pages))
+    return conv_res
+
+class ConverterPool:
+    """
+    1回の取り込みの間、同じ設定の DocumentConverter を使い回す (モデルの読み込みをページのまとまりごとにしない)。
+    同時に使う分 (OCR のワーカー) は設定ごとに必要な数だけ作る
+    """
+    def __init__(self):
+        self._idle = {}
+        self._created = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(overrides):
+        return json.dumps({**PDF_PIPELINE_DEFAULTS, **overrides}, sort_keys=True)
+
+    def loaded(self, **overrides):
+        """
+        この設定の converter を既に作ったか (モデル読み込み済みか)
+        """
+        with self._lock:
+            return self._key(overrides) in self._created
+
+    @contextmanager
+    def converter(self, **overrides):
+        from docling.datamodel.base_models import InputFormat
+        from docling.document_converter import DocumentConverter, PdfFormatOption
+
+        key = self._key(overrides)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            converter = idle.pop() if idle else None
+            self._created.add(key)
+        if converter is None:
+            converter = DocumentConverter(
+                format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=build_pipeline_options(**overrides))}
+            )
+        try:
+            yield converter
+        finally:
+            with self._lock:
+                self._idle[key].append(converter)
+
+def detect_page_sources(pdf_file_path, ocr_mode=None):
+    """
+    ページごとにテキストの取り方を決める。
+    戻り値: ["text_layer" | "ocr" | "empty", ...] (ページ順)
+    """
+    import pypdfium2
+    import pypdfium2.raw as pdfium_c
+
+    ocr_mode = ocr_mode or PDF_PIPELINE_DEFAULTS["ocr_mode"]
+    pdf = pypdfium2.PdfDocument(pdf_file_path)
+    try:
+        if ocr_mode != "auto":
+            return ["ocr" if ocr_mode == "full" else "text_layer"] * len(pdf)
+        sources = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            chars = len(re.sub(r'\s', '', textpage.get_text_range()))
+            textpage.close()
+            if chars >= OCR_MIN_PAGE_CHARS:
+                sources.append("text_layer")
+            elif any(True for _ in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,), max_depth=2)):
+                sources.append("ocr")
+            else:
+                sources.append("empty")
+            page.close()
+        return sources
+    finally:
+        pdf.close()
+
+def describe_page_sources(page_sources):
+    """
+    進捗イベント (ページごとのテキストの取り方) を作る
+    """
+    ocr_count = page_sources.count("ocr")
+    status = "PDFファイルの解析中..." + (f" (OCR: {ocr_count}/{len(page_sources)}ページ)" if ocr_count else "")
+    return {
+        "status": status,
+        "pages": [{"page": i + 1, "source": source} for i, source in enumerate(page_sources)],
+    }
+
+def extract_pdf_pages(pdf_file_path, page_numbers, output_path):
+    """
+    指定ページ (1〜) だけを抜き出した PDF を作る
+    """
+    import pypdfium2
+    src = pypdfium2.PdfDocument(pdf_file_path)
+    dst = pypdfium2.PdfDocument.new()
+    try:
+        dst.import_pages(src, [n - 1 for n in page_numbers])
+        dst.save(output_path)
+    finally:
+        dst.close()
+        src.close()
+
+class MergedDocument:
+    """
+    テキスト層で変換したページと OCR したページの DoclingDocument をページ順につないだもの。
+    parts: [(元のページ番号, DoclingDocument, その文書内のページ番号), ...]
+    """
+    def __init__(self, parts):
+        self.parts = parts
+
+    def iterate_items(self):
+        for _page_no, document, page_no in self.parts:
+            yield from document.iterate_items(page_no=page_no)
+
+    def export_to_markdown(self):
+        pages = (document.export_to_markdown(page_no=page_no) for _page_no, document, page_no in self.parts)
+        return "\n\n".join(md for md in pages if md.strip())
+
+class MergedConversion:
+    def __init__(self, parts, page_sources):
+        self.document = MergedDocument(parts)
+        self.pages = page_sources
+        self.page_sources = page_sources
+
+def convert_pdf_adaptive(pdf_file_path, page_sources, converters=None, table_budget=None, **overrides):
+    """
+    テキスト層のあるページはそのまま、無いページは OCR して変換し、1つの文書にまとめる。
+    OCR するページは PDF_OCR_WORKERS 個に分け、テキスト層のページの変換と並列に処理する。
+    table_policy が auto なら、表のあるページだけ表構造を解析し直す (structure_tables)。
+    ページのまとまりごとに呼ぶ場合は、文書全体で converters (ConverterPool) と table_budget (TableTimeBudget) を共有する
+    """
+    converters = converters or ConverterPool()
+    ocr_pages = [i + 1 for i, source in enumerate(page_sources) if source == "ocr"]
+    if not ocr_pages:
+        with converters.converter(**overrides) as converter:
+            conv_res = convert_pdf(pdf_file_path, converter=converter)
+    else:
+        conv_res = convert_pdf_with_ocr(pdf_file_path, page_sources, ocr_pages, overrides, converters)
+
+    settings = {**PDF_PIPELINE_DEFAULTS, **overrides}
+    if settings["table_policy"] == "auto" and not settings["do_table_structure"]:
+        conv_res = structure_tables(pdf_file_path, conv_res, page_sources, overrides, converters, table_budget)
+    return conv_res
+
+def convert_pdf_with_ocr(pdf_file_path, page_sources, ocr_pages, overrides, converters):
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    text_pages = [i + 1 for i, source in enumerate(page_sources) if source != "ocr"]
+    workers = min(PDF_OCR_WORKERS, len(ocr_pages))
+    groups = [ocr_pages[i::workers] for i in range(workers)]
+    ocr_overrides = {**overrides, "do_ocr": True, "force_full_page_ocr": True}
+
+    def convert_part(part_path, part_overrides):
+        with converters.converter(**part_overrides) as converter:
+            return convert_pdf(part_path, converter=converter)
+
+    with trace_span("pdf.convert_adaptive", pages=len(page_sources), ocr_pages=len(ocr_pages)), \
+            tempfile.TemporaryDirectory() as tmp_dir, \
+            ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix="pdf-ocr") as pool:
+        jobs = []
+        for index, pages in enumerate(([text_pages] if text_pages else []) + groups):
+            part_path = os.path.join(tmp_dir, f"part-{index}.pdf")
+            extract_pdf_pages(pdf_file_path, pages, part_path)
+            part_overrides = overrides if pages is text_pages else ocr_overrides
+            future = pool.submit(contextvars.copy_context().run, convert_part, part_path, part_overrides)
+            jobs.append((pages, future))
+
+        parts = []
+        for pages, future in jobs:
+            document = future.result().document
+            parts.extend((page_no, document, i + 1) for i, page_no in enumerate(pages))
+    return MergedConversion(sorted(parts, key=lambda part: part[0]), page_sources)
+
+def preload_docling():
+    """
+    docling を先に import しておく (ASGI の変換ワーカーで初回変換の待ち時間を減らす)
+    """
+    started = time.perf_counter()
+    import docling.document_converter  # noqa: F401
+    import docling_core.types.doc  # noqa: F401
+    print(f">>> docling を読み込みました ({time.perf_counter() - started:.2f}s)")
+
+def save_element_images(conv_res, output_dir, table_offset=0, picture_offset=0):
+    """
+    表・図を table-N.png / picture-N.png として保存する (N は offset + 1 から)。
+    戻り値: (保存した表の数, 図の数)
+    """
+    from docling_core.types.doc import PictureItem, TableItem
+    table_counter = table_offset
+    picture_counter = picture_offset
+    with trace_span("pdf.save_images") as span:
+        for element, _level in conv_res.document.iterate_items():
+            if isinstance(element, TableItem):
+                table_counter += 1
+                element_image_filename = os.path.join(output_dir, f"table-{table_counter}.png")
+                with atomic_write(element_image_filename, "wb") as fp:
+                    element.image.pil_image.save(fp, "PNG")
+                    span.add("bytes", fp.tell())
+
+            if isinstance(element, PictureItem):
+                picture_counter += 1
+                element_image_filename = os.path.join(output_dir, f"picture-{picture_counter}.png")
+                with atomic_write(element_image_filename, "wb") as fp:
+                    element.image.pil_image.save(fp, "PNG")
+                    span.add("bytes", fp.tell())
+        span.set("tables", table_counter - table_offset)
+        span.set("pictures", picture_counter - picture_offset)
+    return table_counter - table_offset, picture_counter - picture_offset
+
+def export_markdown(conv_res):
+    with trace_span("pdf.export_markdown") as span:
+        md_text = conv_res.document.export_to_markdown()
+        span.set("chars", len(md_text))
+    return md_text
+
+def build_placeholder_messages(md_text, first_table=1, first_picture=1):
+    """
+    途中のページから変換する場合は、図・表の番号を first_picture / first_table から数えさせる
+    """
+    system_prompt = PLACEHOLDER_SYSTEM_PROMPT
+    if first_table != 1 or first_picture != 1:
+        system_prompt += f"\n・図番号は {first_picture} から、表番号は {first_table} から数えてください。\n"
+    return build_chat_messages(system_prompt, md_text)
+
+def save_origin_markdown(username, dir_name, output_dir, base_name, result_text):
+    """
+    LLMの出力を _origin.md として保存する
+    """
+    result_text = strip_code_fence(result_text)
+
+    md_filename = os.path.join(output_dir, f"{base_name}_origin.md")
+    with trace_span("markdown.save", chars=len(result_text)):
+        # プレビューを読んでいる最中に差し替わるので、一時ファイルに書いてから置き換える
+        with atomic_write(md_filename) as f:
+            f.write(result_text)
+        record_origin_export(output_dir, base_name, md_filename)
+        on_artifact_written(f"{username}/{dir_name}", md_filename)
+
+def pdf2markdown_steps(req, username, ticket=None, executor=None):
+    """
+    PDFを解析し、Markdownに変換（+ 画像を保存）する手順 (Flask / ASGI 共通)。
+    テキスト層から作ったプレビューを先に _origin.md として保存・送信し、
+    docling による変換はバックグラウンド (IngestJob) で続ける (切断しても止めない)。
+    プレビューを送ったらストリームを閉じる (クライアントはすぐに論文を開き、本変換は ingest_events で追う)。
+    """
+    try:
+        # URL 指定の場合はダウンロードが発生する
+        file_name, pdf_stream = yield Call(read_pdf_request, req)
+    except Exception as e:
+        yield Emit({"error": str(e)})
+        return
+
+    base_name, dir_name, output_dir = yield Call(create_paper_dir, file_name, username)
+    job = None
+    try:
+        yield Emit({"status": "PDFファイルの保存中..."})
+        pdf_file_path = yield Call(save_pdf_file, pdf_stream, output_dir, file_name)
+
+        # 本変換はプレビューを送る前に始める (送信中に切断されても変換は続く)
+        preview_events = yield Call(build_preview_events, pdf_file_path, username, dir_name, output_dir, base_name)
+        job = start_ingest_job(
+            pdf_file_path, username, dir_name, output_dir, base_name, bool(preview_events), ticket, executor
+        )
+    except Exception as e:
+        traceback.print_exc()
+        yield Emit({"error": f"Error extracting text: {str(e)}"})
+    finally:
+        # ★本変換を始める前に失敗・切断した場合は、作りかけのディレクトリを削除する
+        if job is None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    if job is None:
+        return
+
+    for event in preview_events:
+        yield Emit(event)
+    if not preview_events:
+        yield from ingest_event_steps(job)
+
+def ingest_event_steps(job):
+    """
+    バックグラウンド変換の進捗を最初から送る手順 (Flask / ASGI 共通)
+    """
+    index = 0
+    while True:
+        events, done = yield Call(job.wait, index, 1.0)
+        for event in events:
+            yield Emit(event)
+        index += len(events)
+        if done:
+            return
+
+########################################################################
+# 取り込みの高速プレビューとバックグラウンド変換
+#   PDF のテキスト層だけで簡易マークダウンを作って先に表示・チャットできるようにし、
+#   docling + LLM による本変換が終わったら _origin.md を置き換える。
+#   本変換の進捗は IngestJob (と論文ディレクトリの状態ファイル) に溜め、SSE (pdf2markdown / ingest_events) で送る。
+########################################################################
+PREVIEW_INGEST = os.getenv("PREVIEW_INGEST", "1") == "1"
+# プレビューに必要な最低文字数 (これ未満ならスキャンPDFとみなしてプレビューを作らない)
+PREVIEW_MIN_CHARS = 200
+# 終了したジョブの進捗を ingest_events で再送できる時間 (秒)
+INGEST_JOB_RETENTION = 600
+
+# 番号付きの見出しは大文字始まりのみ (「10 times faster than ...」のような本文の行を見出しにしない)
+PREVIEW_HEADING = re.compile(
+    r'^(?:(?:\d+(?:\.\d+)*\.?|[IVX]+\.)\s+[A-Z][^.!?]{1,80}'
+    r'|(?i:abstract|introduction|related work|conclusions?|references|acknowledg(?:e)?ments?))$'
+)
+
+def build_preview_markdown(pdf_file_path):
     """
-    PDFファイルを受け取り（またはURL）、Markdownへ変換。
-    SSE (Server-Sent Events)で進捗を返す。
+    テキスト層から簡易マークダウンを作る (1行目をタイトル、番号付きの短い行などを見出しとみなす)。
+    テキスト層がほとんど無ければ None
     """
-    username = request.args.get('username')
-    if not username:
-        return jsonify({"error": "username is required"}), 400
+    import pypdfium2
+    pdf = pypdfium2.PdfDocument(pdf_file_path)
+    lines = []
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            lines.extend(textpage.get_text_range().splitlines())
+            textpage.close()
+            page.close()
+            lines.append("")
+    finally:
+        pdf.close()
+
+    blocks = []
+    paragraph = ""
+    for line in (line.strip() for line in lines):
+        if not line or PREVIEW_HEADING.match(line):
+            if paragraph:
+                blocks.append(paragraph)
+                paragraph = ""
+            if line:
+                blocks.append(("# " if not blocks else "## ") + line)
+            continue
+        if not blocks and not paragraph:
+            blocks.append("# " + line)
+        elif paragraph.endswith("-"):
+            paragraph = paragraph[:-1] + line
+        else:
+            paragraph = f"{paragraph} {line}" if paragraph else line
+    if paragraph:
+        blocks.append(paragraph)
+
+    md_text = "\n\n".join(blocks)
+    if len(re.sub(r'\s', '', md_text)) < PREVIEW_MIN_CHARS:
+        return None
+    return md_text
+
+def build_preview_events(pdf_file_path, username, dir_name, output_dir, base_name):
+    """
+    プレビューを _origin.md に保存し、送るイベントのリストを返す (作れなかった場合は空)
+    """
+    if not PREVIEW_INGEST:
+        return []
+    with trace_span("pdf.preview") as span:
+        try:
+            md_text = build_preview_markdown(pdf_file_path)
+        except Exception as e:
+            # プレビューは補助なので、失敗しても本変換に任せる
+            span.set("error", str(e))
+            md_text = None
+        span.set("chars", len(md_text or ""))
+    if not md_text:
+        return []
+    save_origin_markdown(username, dir_name, output_dir, base_name, md_text)
+    return [
+        {"llm_output": LLM_OUTPUT_START},
+        {"llm_output": md_text},
+        {"llm_output": LLM_OUTPUT_END},
+        {
+            "status": "プレビューを表示しています (PDFの解析を続けています...)",
+            "preview": True,
+            "dir_name": f"{username}/{dir_name}",
+            "base_file_name": base_name,
+        },
+    ]
+
+class IngestJob:
+    """
+    バックグラウンドの本変換。進捗イベントを溜めておき、複数の SSE から読めるようにする。
+    状態 (実行中・完了・失敗と最新の進捗) は論文ディレクトリの INGEST_STATE_FILE にも書く
+    """
+    def __init__(self, dir_name, base_name=None, preview_saved=False):
+        self.dir_name = dir_name
+        self.events = []
+        self.done = False
+        self.finished_at = None
+        self.lock = None
+        self.state = {"state": "running", "base_name": base_name, "preview_saved": preview_saved}
+        self._cond = threading.Condition()
+        self._state_lock = threading.Lock()
+
+    def emit(self, data):
+        if "status" in data:
+            self.save_state(status=data["status"])
+        with self._cond:
+            self.events.append(data)
+            self._cond.notify_all()
+
+    def save_state(self, **fields):
+        with self._state_lock:
+            self.state.update(fields)
+            write_ingest_state(self.dir_name, self.state)
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def wait(self, start, timeout=None):
+        """
+        戻り値: (start 以降のイベント, 終了したか)。新しいイベントが無ければ timeout 秒まで待つ
+        """
+        with self._cond:
+            if len(self.events) <= start and not self.done:
+                self._cond.wait(timeout)
+            return self.events[start:], self.done
+
+_ingest_jobs = {}
+_ingest_jobs_lock = threading.Lock()
+
+def get_ingest_job(dir_name):
+    with _ingest_jobs_lock:
+        return _ingest_jobs.get(dir_name)
+
+def start_ingest_job(pdf_file_path, username, dir_name, output_dir, base_name, preview_saved, ticket=None, executor=None):
+    """
+    本変換をバックグラウンドで開始する。ticket (同時実行数の枠) は変換が終わるまで保持する。
+    論文のロックは状態ファイルに "running" を書く前に取り、変換が終わるまで持つ
+    (ロックが取れるのに "running" のままなら、変換したプロセスはもういない)
+    """
+    job = IngestJob(f"{username}/{dir_name}", base_name, preview_saved)
+    job.lock = PaperLock(job.dir_name).acquire()
+    try:
+        job.save_state()
+    except BaseException:
+        job.lock.release()
+        raise
+    with _ingest_jobs_lock:
+        now = time.time()
+        for key in [k for k, j in _ingest_jobs.items() if j.done and now - j.finished_at > INGEST_JOB_RETENTION]:
+            del _ingest_jobs[key]
+        _ingest_jobs[job.dir_name] = job
+    if ticket is not None:
+        admission.detach(ticket)
+
+    def run():
+        try:
+            run_full_ingest(job, pdf_file_path, username, dir_name, output_dir, base_name, preview_saved)
+        finally:
+            job.lock.release()
+            if ticket is not None:
+                admission.release(ticket, detached=True)
+            job.finish()
+
+    # トレースは元のリクエストの子スパンとして記録する
+    target = functools.partial(contextvars.copy_context().run, run)
+    if executor is not None:
+        executor.submit(target)
+    else:
+        threading.Thread(target=target, name=f"ingest-{dir_name}", daemon=True).start()
+    return job
+
+def run_full_ingest(job, pdf_file_path, username, dir_name, output_dir, base_name, preview_saved):
+    """
+    job.lock を持った状態で呼ぶ
+    """
+    try:
+        page_sources = detect_page_sources(pdf_file_path)
+        job.emit(describe_page_sources(page_sources))
+        export_pipelined(pdf_file_path, page_sources, username, dir_name, output_dir, base_name, job.emit)
+        store_paper_artifacts(f"{username}/{dir_name}")
+        job.save_state(state="done")
+        job.emit({"dir_name": f"{username}/{dir_name}", "base_file_name": base_name})
+    except Exception as e:
+        traceback.print_exc()
+        if preview_saved:
+            # プレビューは残す (本変換だけ失敗)
+            error = f"Error extracting text (preview kept): {str(e)}"
+            job.save_state(state="failed", error=error)
+            job.emit({"error": error})
+        else:
+            # ★失敗時、作りかけのディレクトリを削除する
+            shutil.rmtree(output_dir, ignore_errors=True)
+            job.lock.release(remove=True)
+            on_artifact_removed(f"{username}/{dir_name}")
+            job.emit({"error": f"Error extracting text: {str(e)}"})
+
+########################################################################
+# 本変換の状態ファイル
+#   ジョブ (IngestJob) は変換したプロセスにしか無いので、別のワーカー・別のホストの
+#   ingest_events は状態ファイルを読み直して進捗を送る。再起動で中断された変換は
+#   起動時 (と読んだ時) に片付ける。
+########################################################################
+INGEST_STATE_FILE = ".ingest.json"
+# 別のワーカーの変換を追うときに状態ファイルを読み直す間隔 (秒)
+INGEST_STATE_POLL_INTERVAL = float(os.getenv("INGEST_STATE_POLL_INTERVAL", "1.0"))
+
+def get_ingest_state_path(dir_name):
+    """
+    "username/subdir" の状態ファイルのパス。CONTENT_DATA_DIR の外を指す dir_name は None
+    """
+    username, sub_dir = split_user_dir_name(dir_name or "")
+    if not username or '/' in sub_dir or '..' in dir_name or '\\' in dir_name:
+        return None
+    state_path = os.path.join(CONTENT_DATA_DIR, username, sub_dir, INGEST_STATE_FILE)
+    if not os.path.abspath(state_path).startswith(os.path.abspath(CONTENT_DATA_DIR) + os.sep):
+        return None
+    return state_path
+
+def read_ingest_state(dir_name):
+    """
+    戻り値: 状態の dict。状態ファイルが無い・読めない場合は None
+    """
+    state_path = get_ingest_state_path(dir_name)
+    if state_path is None:
+        return None
+    try:
+        with open(state_path, encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) else None
+
+def write_ingest_state(dir_name, state):
+    """
+    状態ファイルを書く。書けなくても変換は続ける
+    """
+    state_path = get_ingest_state_path(dir_name)
+    if state_path is None:
+        return
+    try:
+        with atomic_write(state_path) as f:
+            json.dump(dict(state, updated_at=time.time()), f, ensure_ascii=False)
+    except OSError:
+        traceback.print_exc()
+
+def reconcile_ingest_state(dir_name, state):
+    """
+    "running" のまま変換したプロセスがいない (再起動・異常終了した) 状態を片付ける。
+    flock はプロセスが終わると外れるので、排他ロックがすぐ取れれば変換は動いていない。
+    プレビューがあれば失敗として残し、無ければ作りかけのディレクトリを削除する。
+    戻り値: 片付けた後の状態 (ディレクトリを削除した場合は None)
+    """
+    if state.get("state") != "running":
+        return state
+    lock = PaperLock(dir_name, exclusive=True)
+    try:
+        lock.acquire(timeout=0)
+    except PaperBusy:
+        return state
+    except FileNotFoundError:
+        return None
+    try:
+        state = read_ingest_state(dir_name)
+        if state is None or state.get("state") != "running":
+            return state
+        if state.get("preview_saved"):
+            state = dict(state, state="failed", error="Error extracting text (preview kept): the conversion was interrupted")
+            write_ingest_state(dir_name, state)
+            return state
+        shutil.rmtree(lock.dir_path, ignore_errors=True)
+        lock.release(remove=True)
+        on_artifact_removed(dir_name)
+        return None
+    finally:
+        lock.release()
+
+def load_ingest_state(dir_name):
+    state = read_ingest_state(dir_name)
+    return state and reconcile_ingest_state(dir_name, state)
+
+def reconcile_ingest_jobs():
+    """
+    起動時に、前回のプロセスで中断された本変換を全ユーザー分片付ける。戻り値: 片付けた件数
+    """
+    count = 0
+    if not os.path.isdir(CONTENT_DATA_DIR):
+        return count
+    for username in sorted(os.listdir(CONTENT_DATA_DIR)):
+        if not os.path.isdir(get_user_dir(username)):
+            continue
+        for sub_dir in sorted(os.listdir(get_user_dir(username))):
+            dir_name = f"{username}/{sub_dir}"
+            state = read_ingest_state(dir_name)
+            if state is None or state.get("state") != "running":
+                continue
+            try:
+                if reconcile_ingest_state(dir_name, state) is not state:
+                    count += 1
+            except Exception:
+                traceback.print_exc()
+    return count
+
+def ingest_state_steps(dir_name, state):
+    """
+    状態ファイルを読み直して進捗を送る手順 (ジョブが別のワーカーにある場合)
+    """
+    last_status = None
+    while True:
+        if state is None:
+            yield Emit({"error": "Error extracting text: the paper was removed"})
+            return
+        if state.get("status") and state["status"] != last_status:
+            last_status = state["status"]
+            yield Emit({"status": last_status})
+        if state.get("state") == "done":
+            yield Emit({"dir_name": dir_name, "base_file_name": state.get("base_name")})
+            return
+        if state.get("state") == "failed":
+            yield Emit({"error": state.get("error")})
+            return
+        yield Sleep(INGEST_STATE_POLL_INTERVAL)
+        state = yield Call(load_ingest_state, dir_name)
+
+def open_ingest_steps(dir_name):
+    """
+    ingest_events で送る手順。このプロセスのジョブがあればそのイベントを、
+    無ければ状態ファイルを追う。どちらも無ければ None
+    """
+    job = get_ingest_job(dir_name)
+    if job is not None:
+        return ingest_event_steps(job)
+    state = load_ingest_state(dir_name)
+    if state is None:
+        return None
+    return ingest_state_steps(dir_name, state)
+
+@app.route('/ingest_events', methods=['GET'])
+def ingest_events():
+    """
+    バックグラウンド変換の進捗を最初から SSE で送る (プレビューの後や、pdf2markdown の接続が切れた後の再接続用)
+    """
+    dir_name = request.args.get('dir_name')
+    if not dir_name:
+        return jsonify({"error": "dir_name is required"}), 400
+    steps = open_ingest_steps(dir_name)
+    if steps is None:
+        return jsonify({"error": "No ingest job for this directory"}), 404
 
     @stream_with_context
     def generate():
-        pdf_stream = None
-        file_name = ""
+        yield from iter_step_events(steps)
+
+    return Response(generate(), mimetype='text/event-stream')
+
+########################################################################
+# 取り込みのパイプライン化
+#   PDF を INGEST_BATCH_PAGES ページずつ docling で変換し、変換の済んだ分から
+#   画像保存・マークダウン出力・LLM (図表の挿入) に回す。段の間は INGEST_PIPELINE_DEPTH 個までの
+#   キューでつなぎ、LLM が詰まったら変換も待つ。全体の時間は各段の合計ではなく一番遅い段に近づく。
+########################################################################
+INGEST_BATCH_PAGES = int(os.getenv("INGEST_BATCH_PAGES", "8"))
+INGEST_PIPELINE_DEPTH = int(os.getenv("INGEST_PIPELINE_DEPTH", "2"))
+
+def split_page_batches(page_count, batch_pages=None):
+    """
+    戻り値: [[ページ番号, ...], ...] (1始まり)
+    """
+    batch_pages = max(1, batch_pages or INGEST_BATCH_PAGES)
+    return [list(range(start, min(start + batch_pages, page_count + 1))) for start in range(1, page_count + 1, batch_pages)]
+
+def iter_converted_batches(pdf_file_path, page_sources, batch_pages=None):
+    """
+    ページのまとまりごとに変換し、(ページ番号のリスト, 変換結果) を順に返す。
+    ページが1まとまりに収まる場合は PDF をそのまま変換する
+    """
+    import tempfile
+
+    batches = split_page_batches(len(page_sources), batch_pages)
+    if len(batches) <= 1:
+        yield batches[0] if batches else [], convert_pdf_adaptive(pdf_file_path, page_sources)
+        return
+
+    # converter (表構造・OCR 用を含む) と表構造の解析時間の上限は文書全体で共有する
+    converters = ConverterPool()
+    table_budget = TableTimeBudget()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for index, pages in enumerate(batches):
+            batch_path = os.path.join(tmp_dir, f"batch-{index}.pdf")
+            extract_pdf_pages(pdf_file_path, pages, batch_path)
+            batch_sources = [page_sources[page_no - 1] for page_no in pages]
+            with trace_span("pdf.convert_batch", first_page=pages[0], pages=len(pages)):
+                conv_res = convert_pdf_adaptive(batch_path, batch_sources, converters, table_budget)
+            yield pages, conv_res
+
+def iter_pipelined(items, maxsize):
+    """
+    items (ジェネレータ) を別スレッドで先に進め、maxsize 個までキューに溜めながら順に返す。
+    生成側の例外は受け取り側で送出し、受け取り側が途中でやめたら生成側も止める
+    """
+    import queue
+
+    buffer = queue.Queue(maxsize=max(1, maxsize))
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
         try:
-            if 'file' in request.files:
-                pdf_file = request.files['file']
-                file_name = pdf_file.filename
-                pdf_stream = pdf_file.stream
-            elif request.is_json and 'url' in request.json:
-                pdf_url = request.json['url']
-                file_name = os.path.basename(pdf_url)
-                if not file_name.lower().endswith('.pdf'):
-                    file_name += '.pdf'
-                response = requests.get(pdf_url)
-                response.raise_for_status()
-                # --- ここで Content-Type が "pdf" かどうか簡易チェック ---
-                ctype = response.headers.get("Content-Type", "").lower()
-                if "pdf" not in ctype:
-                    raise ValueError("指定されたURLはPDFを返しませんでした。")
-
-                pdf_stream = BytesIO(response.content)
-            else:
-                raise ValueError("No valid PDF file or URL provided")
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            items.close()
+
+    # トレースは呼び出し元のスパンの子として記録する
+    target = functools.partial(contextvars.copy_context().run, produce)
+    threading.Thread(target=target, name="ingest-convert", daemon=True).start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+def export_pipelined(pdf_file_path, page_sources, username, dir_name, output_dir, base_name, emit):
+    """
+    変換の済んだページのまとまりから順に画像保存・マークダウン出力・LLM を行い、
+    最後に _origin.md と DoclingDocument を保存する
+    """
+    table_count = picture_count = 0
+    parts, results, texts = [], [], []
+    with trace_span("pdf.pipeline", pages=len(page_sources)) as span:
+        batches = iter_pipelined(iter_converted_batches(pdf_file_path, page_sources), INGEST_PIPELINE_DEPTH)
+        for pages, conv_res in batches:
+            results.append(conv_res)
+            parts.extend((pages[page_no - 1], document, local_page_no)
+                         for page_no, document, local_page_no in conversion_parts(conv_res))
+
+            emit({"status": f"画像保存中... ({pages[0]}-{pages[-1]}/{len(page_sources)}ページ)"})
+            tables, pictures = save_element_images(conv_res, output_dir, table_count, picture_count)
+
+            emit({"status": f"マークダウン変換中... ({pages[0]}-{pages[-1]}/{len(page_sources)}ページ)"})
+            md_text = export_markdown(conv_res)
+            messages = build_placeholder_messages(md_text, table_count + 1, picture_count + 1)
+            table_count += tables
+            picture_count += pictures
+            if not md_text.strip():
+                continue
+
+            # 全まとまりで1つの llm_output ブロックにする (START でフロントエンドの表示が置き換わるため)
+            emit({"llm_output": LLM_OUTPUT_START if not texts else "\n\n"})
+            chunks = []
+            for content in stream_llm("ingest", messages, temperature=0):
+                chunks.append(content)
+                emit({"llm_output": content})
+            texts.append(strip_code_fence("".join(chunks)))
+            span.add("batches")
+        if not texts:
+            emit({"llm_output": LLM_OUTPUT_START})
+        emit({"llm_output": LLM_OUTPUT_END})
+
+    save_origin_markdown(username, dir_name, output_dir, base_name, "\n\n".join(texts))
+    if len(results) == 1:
+        save_docling_document(results[0], output_dir, base_name)
+    else:
+        save_docling_document(MergedConversion(sorted(parts, key=lambda part: part[0]), page_sources), output_dir, base_name)
+
+########################################################################
+# 解析結果 (DoclingDocument) の保存と再エクスポート
+#   変換後の文書を {base}_docling.json.gz として論文ディレクトリに保存しておき、
+#   画像の命名や表の出力方法などを変えたときに PDF を解析し直さずに
+#   画像と _origin.md を作り直せるようにする (POST /reexport_paper, --reexport)。
+#   取り込み後に編集された _origin.md は force を指定しない限り上書きせず、上書きする場合は .bak に退避する
+########################################################################
+DOCLING_SUFFIX = "_docling.json.gz"
+DOCLING_FORMAT_VERSION = 1
+# 取り込み・再エクスポートで書いた _origin.md のフィンガープリント (編集されたかの判定用)
+ORIGIN_EXPORT_SUFFIX = "_origin_export.json"
+BACKUP_SUFFIX = ".bak"
+ELEMENT_IMAGE_NAME = re.compile(r'^(table|picture)-(\d+)\.png$')
+
+class OriginEdited(Exception):
+    pass
+
+def get_origin_export_path(output_dir, base_name):
+    return os.path.join(output_dir, f"{base_name}{ORIGIN_EXPORT_SUFFIX}")
+
+def record_origin_export(output_dir, base_name, md_filename):
+    with atomic_write(get_origin_export_path(output_dir, base_name)) as f:
+        json.dump({"fingerprint": get_file_fingerprint(md_filename)}, f)
+
+def is_origin_edited(output_dir, base_name):
+    """
+    _origin.md が取り込み・再エクスポートの後に編集されているか
+    (記録の無い、この仕組みより前に取り込んだ論文は判定できないので編集ありとみなす)
+    """
+    md_filename = os.path.join(output_dir, f"{base_name}_origin.md")
+    if not os.path.exists(md_filename):
+        return False
+    try:
+        with open(get_origin_export_path(output_dir, base_name), 'r', encoding='utf-8') as f:
+            recorded = json.load(f)["fingerprint"]
+    except (OSError, ValueError, KeyError):
+        return True
+    return recorded != get_file_fingerprint(md_filename)
+
+class StoredConversion:
+    """
+    保存した DoclingDocument を変換結果 (conv_res) と同じように扱うためのもの
+    """
+    def __init__(self, document, page_sources):
+        self.document = document
+        self.pages = page_sources
+        self.page_sources = page_sources
+
+def get_docling_path(output_dir, base_name):
+    return os.path.join(output_dir, f"{base_name}{DOCLING_SUFFIX}")
+
+def save_docling_document(conv_res, output_dir, base_name):
+    """
+    変換結果を gzip 圧縮した JSON で保存する。
+    ページごとに別の文書をつないだもの (MergedConversion) は、文書の一覧とページの対応を保存する
+    """
+    page_sources = getattr(conv_res, "page_sources", None)
+    if isinstance(conv_res, MergedConversion):
+        documents, parts = [], []
+        for page_no, document, local_page_no in conv_res.document.parts:
+            index = next((i for i, d in enumerate(documents) if d is document), None)
+            if index is None:
+                index = len(documents)
+                documents.append(document)
+            parts.append([page_no, index, local_page_no])
+    else:
+        documents, parts = [conv_res.document], None
+        page_sources = page_sources or ["text_layer"] * len(conv_res.pages)
+
+    docling_path = get_docling_path(output_dir, base_name)
+    tmp_path = unique_tmp_path(docling_path)
+    try:
+        with trace_span("pdf.save_document", documents=len(documents)) as span:
+            payload = {
+                "version": DOCLING_FORMAT_VERSION,
+                "page_sources": page_sources,
+                "documents": [document.export_to_dict() for document in documents],
+                "parts": parts,
+            }
+            data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+                f.write(data)
+            os.replace(tmp_path, docling_path)
+            span.set("bytes", os.path.getsize(docling_path))
+    except Exception:
+        # 保存できなくても取り込み自体は続ける (再エクスポートできないだけ)
+        traceback.print_exc()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_docling_document(output_dir, base_name):
+    """
+    save_docling_document で保存した変換結果を読み込む。無ければ None
+    """
+    from docling_core.types.doc import DoclingDocument
+
+    docling_path = get_docling_path(output_dir, base_name)
+    if not ensure_local_artifact(docling_path):
+        return None
+    with trace_span("pdf.load_document") as span, gzip.open(docling_path, "rb") as f:
+        payload = json.loads(f.read())
+        span.set("documents", len(payload["documents"]))
+    if payload.get("version") != DOCLING_FORMAT_VERSION:
+        raise ValueError(f"Unsupported docling document version: {payload.get('version')}")
+
+    documents = [DoclingDocument.model_validate(d) for d in payload["documents"]]
+    if payload["parts"] is None:
+        return StoredConversion(documents[0], payload["page_sources"])
+    parts = [(page_no, documents[index], local_page_no) for page_no, index, local_page_no in payload["parts"]]
+    return MergedConversion(parts, payload["page_sources"])
+
+def remove_element_images(output_dir, keep_tables=0, keep_pictures=0):
+    """
+    table-N.png (N > keep_tables) と picture-N.png (N > keep_pictures) を削除する
+    (作り直した画像を書き終えてから、余った古い画像だけを消すために使う)
+    """
+    keep = {"table": keep_tables, "picture": keep_pictures}
+
+    def is_stale(name):
+        match = ELEMENT_IMAGE_NAME.match(name)
+        return bool(match) and int(match.group(2)) > keep[match.group(1)]
+
+    for name in os.listdir(output_dir):
+        if is_stale(name):
+            os.remove(os.path.join(output_dir, name))
+    stored = [os.path.join(output_dir, name) for name in list_stored_artifacts(output_dir) if is_stale(name)]
+    if stored:
+        get_storage().delete(storage_key(path) for path in stored)
+
+def backup_artifact(file_path, keep_original=False):
+    """
+    {ファイル名}.bak に退避する (keep_original ならコピー)。戻り値: 退避先のファイル名
+    """
+    backup_path = f"{file_path}{BACKUP_SUFFIX}"
+    if keep_original:
+        shutil.copy2(file_path, backup_path)
+    else:
+        os.replace(file_path, backup_path)
+    return os.path.basename(backup_path)
+
+def export_conversion(conv_res, username, dir_name, output_dir, base_name, emit=None):
+    """
+    変換結果から画像と _origin.md を作る (取り込み・再エクスポート共通)。
+    emit を渡すと進捗と LLM の出力をイベントとして送る
+    """
+    emit = emit or (lambda data: None)
+
+    emit({"status": "画像保存中..."})
+    table_count, picture_count = save_element_images(conv_res, output_dir)
+
+    emit({"status": "マークダウン変換中..."})
+    md_text = export_markdown(conv_res)
+
+    emit({"llm_output": LLM_OUTPUT_START})
+    chunks = []
+    for content in stream_llm("ingest", build_placeholder_messages(md_text), temperature=0):
+        chunks.append(content)
+        emit({"llm_output": content})
+
+    save_origin_markdown(username, dir_name, output_dir, base_name, "".join(chunks))
+    emit({"llm_output": LLM_OUTPUT_END})
+    return {"tables": table_count, "pictures": picture_count, "chars": len("".join(chunks))}
+
+def reexport_paper(username, sub_dir, images_only=False, force=False):
+    """
+    保存した DoclingDocument から画像と _origin.md を作り直す (images_only なら画像のみ)。
+    _origin.md が編集されていれば force を指定しない限り OriginEdited (指定時は .bak にコピーしてから上書き)。
+    _origin.md が変わった場合、それから作った翻訳・解説・スレ形式は古くなるので .bak に退避する。
+    戻り値: {"tables": 表の数, "pictures": 図の数, "chars": _origin.md の文字数, "backed_up": 退避したファイル名}
+    """
+    output_dir = os.path.join(get_user_dir(username), sub_dir)
+    entry = scan_paper_dir(output_dir)
+    if not entry["base_name"]:
+        raise FileNotFoundError(f"No paper in {username}/{sub_dir}")
+    base_name = entry["base_name"]
+
+    conv_res = load_docling_document(output_dir, base_name)
+    if conv_res is None:
+        raise FileNotFoundError(f"{base_name}{DOCLING_SUFFIX} not found (converted before it was saved)")
+
+    dir_name = f"{username}/{sub_dir}"
+    with trace_span("pdf.reexport", dir_name=dir_name, images_only=images_only), PaperLock(dir_name):
+        backed_up = []
+        if images_only:
+            table_count, picture_count = save_element_images(conv_res, output_dir)
+            result = {"tables": table_count, "pictures": picture_count, "chars": None}
+        else:
+            origin_path = os.path.join(output_dir, f"{base_name}_origin.md")
+            if is_origin_edited(output_dir, base_name):
+                if not force:
+                    raise OriginEdited(
+                        f"{base_name}_origin.md は取り込み後に編集されています。"
+                        "上書きする場合は force を指定してください (編集版は .bak に退避します)。"
+                    )
+                backed_up.append(backup_artifact(origin_path, keep_original=True))
+            previous = get_file_fingerprint(origin_path) if os.path.exists(origin_path) else None
+
+            result = export_conversion(conv_res, username, sub_dir, output_dir, base_name)
+
+            if get_file_fingerprint(origin_path) != previous:
+                for spec in (TRANS_SPEC, EXPLAIN_SPEC, THREAD_SPEC):
+                    generated_path = os.path.join(output_dir, f"{base_name}{spec['suffix']}")
+                    if os.path.exists(generated_path):
+                        backed_up.append(backup_artifact(generated_path))
+                        on_artifact_removed(dir_name, os.path.basename(generated_path))
+        # 新しい画像を書き終えてから、余った古い画像を消す (途中で失敗しても画像が無くならないように)
+        remove_element_images(output_dir, result["tables"], result["pictures"])
+        result["backed_up"] = backed_up
+        store_paper_artifacts(dir_name)
+        refresh_catalog_entry(username, sub_dir)
+        return result
+
+def reexport_library(username, images_only=False, force=False):
+    """
+    ユーザーの全論文を再エクスポートする。戻り値: (成功数, 対象外・失敗した論文のリスト)
+    """
+    done, skipped = 0, []
+    for sub_dir in sorted(os.listdir(get_user_dir(username))):
+        output_dir = os.path.join(get_user_dir(username), sub_dir)
+        if not os.path.isdir(output_dir):
+            continue
+        try:
+            result = reexport_paper(username, sub_dir, images_only, force)
+            done += 1
+            print(f">>> {username}/{sub_dir}: 表 {result['tables']} / 図 {result['pictures']}")
+        except (FileNotFoundError, OriginEdited) as e:
+            skipped.append(sub_dir)
+            print(f">>> {username}/{sub_dir}: スキップ ({e})")
         except Exception as e:
-            yield f'data: {json.dumps({"error": str(e)})}\n\n'
-            return
+            traceback.print_exc()
+            skipped.append(sub_dir)
+            print(f">>> {username}/{sub_dir}: 失敗 ({e})")
+    return done, skipped
+
+@app.route('/reexport_paper', methods=['POST'])
+def reexport_paper_endpoint():
+    """
+    保存した DoclingDocument から画像と _origin.md を作り直す (PDF は解析し直さない)。
+    LLM を呼ぶので同時実行数の制限 (admission) を通し、結果は SSE で返す
+    """
+    data = request.get_json()
+    if not data or 'dir_name' not in data:
+        return jsonify({'error': 'dir_name is required'}), 400
+    dir_name = data['dir_name']
+    username, sub_dir = split_user_dir_name(dir_name)
+    if not username or '..' in dir_name or '\\' in dir_name or '/' in sub_dir:
+        return jsonify({'error': 'Invalid directory name.'}), 400
+    if not os.path.isdir(os.path.join(get_user_dir(username), sub_dir)):
+        return jsonify({'error': 'Directory not found'}), 404
 
-        # PDF -> Markdown (SSE)
+    images_only = bool(data.get('images_only'))
+    force = bool(data.get('force'))
+
+    def generate():
+        yield sse_event({"status": "画像を作り直しています..." if images_only else "再エクスポート中..."})
         try:
-            for message in extract_text_from_pdf(pdf_stream, file_name, username):
-                yield f'data: {message}\n\n'
+            result = reexport_paper(username, sub_dir, images_only, force)
+            yield sse_event({"message": "Re-exported.", **result})
+        except (FileNotFoundError, PaperBusy, OriginEdited) as e:
+            yield sse_event({"error": str(e)})
         except Exception as e:
             traceback.print_exc()
-            yield f'data: {json.dumps({"error": f"Error extracting text: {str(e)}"})}\n\n'
+            yield sse_event({"error": f"Error re-exporting: {str(e)}"})
 
-    return Response(generate(), mimetype='text/event-stream')
+    return stream_with_admission("convert" if images_only else "generate", username, generate)
+
+########################################################################
+# 表構造の解析 (表のあるページのみ)
+#   最初の変換は表構造なしで行い、見つかった表の数・大きさから FAST / ACCURATE を選んで
+#   表のあるページだけ変換し直す。1文書あたり TABLE_STRUCTURE_TIME_CAP 秒を超えたら
+#   残りのページは表を画像のままにする。ページごとの所要時間は TABLE_TIMINGS_LOG に記録する。
+########################################################################
+TABLE_STRUCTURE_TIME_CAP = float(os.getenv("TABLE_STRUCTURE_TIME_CAP", "60"))
+# 表がこれより多い文書は FAST にする
+TABLE_ACCURATE_MAX_TABLES = int(os.getenv("TABLE_ACCURATE_MAX_TABLES", "12"))
+TABLE_TIMINGS_LOG = os.path.join(CACHE_DIR, "table_timings.jsonl")
+
+# 表1つ (ページ全体の大きさの表は 2つ分) あたりの所要時間の見積もり (秒)。実測の移動平均で更新する
+_table_seconds = {"fast": 1.0, "accurate": 3.0}
+_table_seconds_lock = threading.Lock()
+
+class TableTimeBudget:
+    """
+    1文書の表構造の解析に使える残り時間 (秒)。ページのまとまりごとに解析する場合も文書全体で1つを使う
+    """
+    def __init__(self, seconds=None):
+        self.remaining = TABLE_STRUCTURE_TIME_CAP if seconds is None else seconds
+
+    def spend(self, seconds):
+        self.remaining -= seconds
+
+    @property
+    def exhausted(self):
+        return self.remaining <= 0
+
+def find_tables(conv_res, page_sources):
+    """
+    戻り値: {ページ番号: [表の面積 / ページの面積, ...]} (OCR したページは対象外)
+    """
+    from docling_core.types.doc import TableItem
+    tables = {}
+    for page_no, document, local_page_no in conversion_parts(conv_res):
+        if page_sources[page_no - 1] != "text_layer":
+            continue
+        page = document.pages.get(local_page_no)
+        page_area = page.size.width * page.size.height if page else 0
+        for item, _level in document.iterate_items(page_no=local_page_no):
+            if isinstance(item, TableItem) and item.prov:
+                area = item.prov[0].bbox.area() / page_area if page_area else 0.0
+                tables.setdefault(page_no, []).append(min(1.0, area))
+    return tables
+
+def conversion_parts(conv_res):
+    """
+    変換結果を [(ページ番号, DoclingDocument, その文書内のページ番号), ...] の形にする
+    """
+    if isinstance(conv_res, MergedConversion):
+        return list(conv_res.document.parts)
+    return [(i + 1, conv_res.document, i + 1) for i in range(len(conv_res.pages))]
+
+def table_weight(areas):
+    return sum(1.0 + area for area in areas)
+
+def choose_table_mode(tables, remaining=None):
+    """
+    表の数と大きさから、残り時間 (既定 TABLE_STRUCTURE_TIME_CAP) に収まりそうなら ACCURATE、そうでなければ FAST を選ぶ
+    """
+    remaining = TABLE_STRUCTURE_TIME_CAP if remaining is None else remaining
+    weight = sum(table_weight(areas) for areas in tables.values())
+    count = sum(len(areas) for areas in tables.values())
+    if count <= TABLE_ACCURATE_MAX_TABLES and weight * _table_seconds["accurate"] <= remaining:
+        return "accurate"
+    return "fast"
+
+def record_table_timing(pdf_file_path, mode, page_no, areas, seconds, cold):
+    entry = {
+        "time": time.time(),
+        "file": os.path.basename(pdf_file_path),
+        "mode": mode,
+        "page": page_no,
+        "tables": len(areas),
+        "areas": [round(a, 3) for a in areas],
+        "seconds": round(seconds, 3),
+        "cold": cold,
+    }
+    if not cold:
+        # モデル読み込みを含む最初のページは見積もりに使わない
+        with _table_seconds_lock:
+            _table_seconds[mode] = _table_seconds[mode] * 0.8 + seconds / table_weight(areas) * 0.2
+    try:
+        os.makedirs(os.path.dirname(TABLE_TIMINGS_LOG), exist_ok=True)
+        with open(TABLE_TIMINGS_LOG, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError:
+        traceback.print_exc()
+
+def structure_tables(pdf_file_path, conv_res, page_sources, overrides, converters=None, budget=None):
+    """
+    表のあるページを表構造ありで変換し直し、そのページの内容を差し替える。
+    budget (TableTimeBudget) を使い切ったら残りのページの表は画像のままにする
+    """
+    import tempfile
+
+    tables = find_tables(conv_res, page_sources)
+    if not tables:
+        return conv_res
+
+    converters = converters or ConverterPool()
+    budget = budget or TableTimeBudget()
+    mode = choose_table_mode(tables, budget.remaining)
+    table_overrides = {**overrides, "do_table_structure": True, "table_mode": mode}
+    parts = {page_no: part for page_no, *part in conversion_parts(conv_res)}
+
+    with trace_span("pdf.tables", mode=mode, pages=len(tables),
+                    tables=sum(len(areas) for areas in tables.values())) as span, \
+            tempfile.TemporaryDirectory() as tmp_dir:
+        for page_no, areas in sorted(tables.items()):
+            if budget.exhausted:
+                span.set("capped", True)
+                print(f">>> 表構造の解析が {TABLE_STRUCTURE_TIME_CAP:.0f}s を超えたため、残りの表は画像のままにします")
+                break
+            page_started = time.perf_counter()
+            page_path = os.path.join(tmp_dir, f"page-{page_no}.pdf")
+            extract_pdf_pages(pdf_file_path, [page_no], page_path)
+            cold = not converters.loaded(**table_overrides)
+            with converters.converter(**table_overrides) as converter:
+                parts[page_no] = (convert_pdf(page_path, converter=converter).document, 1)
+            seconds = time.perf_counter() - page_started
+            budget.spend(seconds)
+            record_table_timing(pdf_file_path, mode, page_no, areas, seconds, cold=cold)
+            span.add("structured_pages")
+
+    merged = [(page_no, document, local_page_no) for page_no, (document, local_page_no) in sorted(parts.items())]
+    return MergedConversion(merged, page_sources)
+
+########################################################################
+# 論文ダイジェスト
+#   _origin.md から参考文献・付録・重複したキャプションを除き、セクション本文・図表一覧・
+#   主要な数式を長さ上限付きでまとめたもの。解説・スレ形式・チャットの入力に使える (既定では使わず全文を渡す)。
+#   論文ディレクトリに {base}_digest.json として保存し、_origin.md が変わったら作り直す。
+########################################################################
+DIGEST_SUFFIX = "_digest.json"
+DIGEST_VERSION = 2
+# ダイジェスト本文の最大文字数 (図表一覧・数式を含む)
+DIGEST_MAX_CHARS = int(os.getenv("DIGEST_MAX_CHARS", "24000"))
+DIGEST_MAX_EQUATIONS = 20
+DIGEST_MAX_CAPTION_CHARS = 200
+# 1セクションあたり最低限残す文字数
+DIGEST_MIN_SECTION_CHARS = 400
+# チャット / 解説・スレ形式の論文内容にダイジェストを使うか (既定は全文)
+CHAT_USE_DIGEST = os.getenv("CHAT_USE_DIGEST", "0") == "1"
+GENERATION_USE_DIGEST = os.getenv("GENERATION_USE_DIGEST", "0") == "1"
+
+# この見出し以降 (参考文献・付録) は読み飛ばす。
+# 番号・記号 ("3.", "A.1") の後には空白を必須にする ("Preferences" を P + references と読まないため)
+DIGEST_TAIL_HEADING = re.compile(
+    r'^(?:(?:\d+(?:\.\d+)*\.?|[A-Z](?:\.\d+)*\.?)\s+)?'
+    r'((?:references|bibliography|appendix|appendices|supplementary)\b|参考文献|付録)', re.I
+)
+# この見出しのセクションだけ読み飛ばす
+DIGEST_SKIP_HEADING = re.compile(r'^(?:\d+(?:\.\d+)*\.?)?\s*(acknowledg|謝辞)', re.I)
+DIGEST_CAPTION = re.compile(r'^\**((?:figure|fig\.|table|図|表)\s*\d+)\**[.:：]?\s*', re.I)
+DIGEST_EQUATION = re.compile(r'\$\$(.+?)\$\$', re.S)
+DIGEST_NOISE = re.compile(r'^(<!--.*?-->|!\[[^\]]*\]\([^)]*\))$')
+
+def split_paragraphs(text):
+    return [p.strip() for p in re.split(r'\n\s*\n', text) if p.strip()]
+
+def clip_paragraphs(paragraphs, limit):
+    """
+    段落の区切りで limit 文字以内に切り詰める (最初の段落は途中で切る)
+    """
+    out, used = [], 0
+    for p in paragraphs:
+        if used + len(p) > limit:
+            if not out:
+                out.append(p[:limit].rstrip() + "…")
+            else:
+                out.append("…")
+            break
+        out.append(p)
+        used += len(p) + 2
+    return "\n\n".join(out)
+
+def allocate_section_budget(lengths, budget):
+    """
+    短いセクションは全文、残りを長いセクションで等分する (合計が budget 以内になるように)
+    """
+    limits = [0] * len(lengths)
+    remaining = list(range(len(lengths)))
+    while remaining:
+        share = max(DIGEST_MIN_SECTION_CHARS, budget // len(remaining))
+        fits = [i for i in remaining if lengths[i] <= share]
+        if not fits:
+            for i in remaining:
+                limits[i] = share
+            break
+        for i in fits:
+            limits[i] = lengths[i]
+            budget -= lengths[i]
+        remaining = [i for i in remaining if i not in fits]
+    return limits
+
+def build_paper_digest(md_text, max_chars=DIGEST_MAX_CHARS):
+    """
+    戻り値: {"sections": [{"heading", "anchor", "text", "source_chars"}], "figures": [{"label", "caption"}],
+             "equations": [{"section", "tex"}], "text": プロンプト用に整形した文字列, "source_chars", "chars"}
+    """
+    sections, figures, equations = [], [], []
+    seen_paragraphs = set()
+    seen_labels = set()
+
+    for section in split_markdown_sections(md_text):
+        heading = section["heading"]
+        if DIGEST_TAIL_HEADING.match(heading):
+            break
+        if DIGEST_SKIP_HEADING.match(heading):
+            continue
+
+        body = section["body"]
+        for match in DIGEST_EQUATION.finditer(body):
+            if len(equations) < DIGEST_MAX_EQUATIONS:
+                equations.append({"section": heading, "tex": match.group(1).strip()})
+        body = DIGEST_EQUATION.sub("", body)
+
+        paragraphs = []
+        for p in split_paragraphs(body):
+            if DIGEST_NOISE.match(p):
+                continue
+            key = re.sub(r'\s+', ' ', p).lower()
+            if key in seen_paragraphs:
+                continue
+            seen_paragraphs.add(key)
+            caption = DIGEST_CAPTION.match(p)
+            if caption:
+                label = re.sub(r'\s+', ' ', caption.group(1)).title()
+                if label not in seen_labels:
+                    seen_labels.add(label)
+                    figures.append({"label": label, "caption": p[caption.end():][:DIGEST_MAX_CAPTION_CHARS]})
+                continue
+            paragraphs.append(p)
+
+        if heading or paragraphs:
+            sections.append({"heading": heading, "anchor": section["anchor"], "paragraphs": paragraphs})
+
+    appendix = ""
+    if figures:
+        appendix += "\n\n## 図表一覧\n" + "\n".join(f"- {f['label']}: {f['caption']}" for f in figures)
+    if equations:
+        appendix += "\n\n## 主要な数式\n" + "\n".join(f"$${e['tex']}$$" for e in equations)
+    appendix = appendix[:max_chars // 4]
+
+    headings_chars = sum(len(s["heading"]) + 5 for s in sections)
+    budget = max(0, max_chars - len(appendix) - headings_chars)
+    lengths = [sum(len(p) + 2 for p in s["paragraphs"]) for s in sections]
+    limits = allocate_section_budget(lengths, budget)
+
+    parts = []
+    for section, length, limit in zip(sections, lengths, limits):
+        section["text"] = clip_paragraphs(section.pop("paragraphs"), limit)
+        section["source_chars"] = length
+        parts.append(f"## {section['heading']}\n{section['text']}" if section["heading"] else section["text"])
+    text = ("\n\n".join(parts) + appendix).strip()
+
+    return {
+        "sections": sections,
+        "figures": figures,
+        "equations": equations,
+        "text": text,
+        "source_chars": len(md_text),
+        "chars": len(text),
+    }
+
+def load_paper_digest(origin_md_path, base_name):
+    """
+    保存済みのダイジェストを返す。無いか _origin.md より古ければ作り直して保存する
+    """
+    digest_path = os.path.join(os.path.dirname(origin_md_path), f"{base_name}{DIGEST_SUFFIX}")
+    fingerprint = get_file_fingerprint(origin_md_path)
+    try:
+        with open(digest_path, 'r', encoding='utf-8') as f:
+            digest = json.load(f)
+        if digest.get("version") == DIGEST_VERSION and digest.get("source_fingerprint") == fingerprint \
+                and digest.get("max_chars") == DIGEST_MAX_CHARS:
+            return digest
+    except (OSError, ValueError):
+        pass
+
+    with trace_span("digest.build") as span:
+        with open(origin_md_path, 'r', encoding='utf-8') as f:
+            md_text = f.read()
+        digest = build_paper_digest(md_text, DIGEST_MAX_CHARS)
+        digest.update(version=DIGEST_VERSION, source_fingerprint=fingerprint, max_chars=DIGEST_MAX_CHARS)
+        span.set("source_chars", digest["source_chars"])
+        span.set("chars", digest["chars"])
+
+        with atomic_write(digest_path) as f:
+            json.dump(digest, f, ensure_ascii=False)
+    print(f">>> ダイジェストを作成しました: {digest['source_chars']} → {digest['chars']} 文字")
+    return digest
+
+@app.route('/paper_digest', methods=['GET'])
+def paper_digest():
+    """
+    論文ダイジェストを返す (無ければ作る)
+    """
+    dir_name = request.args.get('dir_name')
+    if not dir_name:
+        return jsonify({"error": "dir_name is required"}), 400
+    if '..' in dir_name or '\\' in dir_name:
+        return jsonify({'error': 'Invalid directory name.'}), 400
+
+    origin_md_path, base_name = find_origin_markdown(dir_name)
+    if not origin_md_path:
+        return jsonify({"error": "Origin markdown file not found"}), 404
+    try:
+        return jsonify(load_paper_digest(origin_md_path, base_name)), 200
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+########################################################################
+# マークダウンのアウトラインとセクション単位の取得
+#   長い論文を一度に描画しないよう、見出しごとのバイト位置・画像参照を {ファイル名}.outline.json に
+#   保存しておき (書き込み時に作成)、ビューアは表示中のセクションから順に取得する
+########################################################################
+OUTLINE_SUFFIX = ".outline.json"
+OUTLINE_VERSION = 1
+# 1回のリクエストで返すセクション数の上限
+OUTLINE_MAX_SECTIONS_PER_REQUEST = 50
+MARKDOWN_IMAGE_REF = re.compile(r'!\[[^\]]*\]\(\s*<?([^)\s>]+)>?[^)]*\)|<img\s[^>]*src=["\']([^"\']+)["\']', re.I)
+
+def build_markdown_outline(data: bytes):
+    """
+    見出し単位のセクション一覧を返す (分け方・アンカーは split_markdown_sections と同じ)。
+    戻り値: [{"id", "heading", "level", "anchor", "start", "end", "images"}, ...]
+    start / end は UTF-8 のバイト位置 (見出しの行から次の見出しの手前まで)
+    """
+    sections = []
+    used_anchors = {}
+    current = {"heading": "", "level": 0, "anchor": "", "start": 0, "images": []}
+    has_body = False
+    in_code_block = False
+    offset = 0
+
+    def close(end):
+        if current["heading"] or has_body:
+            sections.append({"id": len(sections), **current, "end": end})
+
+    for raw_line in data.splitlines(keepends=True):
+        line = raw_line.decode('utf-8', errors='replace').rstrip('\r\n')
+        if line.lstrip().startswith('```'):
+            in_code_block = not in_code_block
+        match = None if in_code_block else re.match(r'^(#{1,6})\s+(.*?)\s*#*\s*$', line)
+        if match:
+            close(offset)
+            heading = match.group(2)
+            current = {
+                "heading": heading,
+                "level": len(match.group(1)),
+                "anchor": make_heading_anchor(heading, used_anchors),
+                "start": offset,
+                "images": [],
+            }
+            has_body = False
+        else:
+            has_body = has_body or bool(line.strip())
+            for ref in MARKDOWN_IMAGE_REF.finditer(line):
+                current["images"].append(ref.group(1) or ref.group(2))
+        offset += len(raw_line)
+    close(offset)
+    return sections
+
+def get_outline_path(md_path):
+    return f"{md_path}{OUTLINE_SUFFIX}"
+
+def write_markdown_outline(md_path, data=None):
+    """
+    アウトラインを作って保存する (data を渡した場合はその内容から)。etag は /contents の ETag と同じ (内容のハッシュ)
+    """
+    with trace_span("markdown.outline") as span:
+        if data is None:
+            with open(md_path, 'rb') as f:
+                data = f.read()
+        outline = {
+            "version": OUTLINE_VERSION,
+            "etag": hashlib.blake2b(data, digest_size=16).hexdigest(),
+            "size": len(data),
+            "sections": build_markdown_outline(data),
+        }
+        span.set("sections", len(outline["sections"]))
+        with atomic_write(get_outline_path(md_path)) as f:
+            json.dump(outline, f, ensure_ascii=False)
+    return outline
+
+def load_markdown_outline(md_path, md_file):
+    """
+    開いたマークダウン (md_file, バイナリ) に合うアウトラインを返す。保存済みのものが合わなければ、
+    md_file の内容から作り直す (パスを開き直さないので、途中で置き換えられてもずれない)
+    """
+    fingerprint = get_file_fingerprint(md_path, file=md_file)
+    try:
+        with open(get_outline_path(md_path), 'r', encoding='utf-8') as f:
+            outline = json.load(f)
+        if outline.get("version") == OUTLINE_VERSION and outline.get("etag") == fingerprint:
+            return outline
+    except (OSError, ValueError):
+        pass
+    md_file.seek(0)
+    return write_markdown_outline(md_path, md_file.read())
+
+def remove_markdown_outline(md_path):
+    if os.path.exists(get_outline_path(md_path)):
+        os.remove(get_outline_path(md_path))
+
+def resolve_markdown_path(dir_name, file_name):
+    """
+    クエリの dir_name ("username/subdir") と file_name からマークダウンのパスを返す (不正なら None)
+    """
+    if not dir_name or not file_name or dir_name.startswith('/'):
+        return None
+    if '..' in dir_name or '\\' in dir_name or '..' in file_name or '/' in file_name or '\\' in file_name:
+        return None
+    if not file_name.lower().endswith('.md'):
+        return None
+    username, sub_dir = split_user_dir_name(dir_name)
+    if not username:
+        return None
+    md_path = os.path.join(CONTENT_DATA_DIR, username, sub_dir, file_name)
+    # /contents と同じく、CONTENT_DATA_DIR の外を指していないか確かめる
+    if not os.path.abspath(md_path).startswith(os.path.abspath(CONTENT_DATA_DIR) + os.sep):
+        return None
+    return md_path
+
+@app.route('/markdown_outline', methods=['GET'])
+def markdown_outline():
+    """
+    マークダウンのアウトライン (見出し・バイト位置・画像参照) を返す。ETag / If-None-Match (304) に対応する
+    """
+    md_path = resolve_markdown_path(request.args.get('dir_name'), request.args.get('file_name'))
+    if md_path is None:
+        return jsonify({'error': 'Valid dir_name and file_name (.md) are required.'}), 400
+    try:
+        with open(md_path, 'rb') as f:
+            outline = load_markdown_outline(md_path, f)
+        response = jsonify(outline)
+        response.set_etag(outline["etag"])
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
 
-def extract_text_from_pdf(pdf_stream, file_name, username):
+@app.route('/markdown_section', methods=['GET'])
+def markdown_section():
     """
-    PDFを解析し、Markdownに変換（+ 画像を保存）する処理。
-    SSE進捗を返すため、ジェネレータを使う。
+    セクションの本文を返す。id (または anchor) から count 個 (既定 1)。
+    返す etag がアウトラインのものと違えばファイルが更新されているので、アウトラインを取り直す
     """
-    base_name = os.path.splitext(file_name)[0]
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    dir_name = f"{timestamp}_{base_name}"
-
-    user_dir = os.path.join(CONTENT_DATA_DIR, username)
-    os.makedirs(user_dir, exist_ok=True)
-
-    output_dir = os.path.join(user_dir, dir_name)
-    os.makedirs(output_dir, exist_ok=True)
+    md_path = resolve_markdown_path(request.args.get('dir_name'), request.args.get('file_name'))
+    if md_path is None:
+        return jsonify({'error': 'Valid dir_name and file_name (.md) are required.'}), 400
     try:
-        yield json.dumps({"status": "PDFファイルの保存中..."})
-
-        pdf_file_path = os.path.join(output_dir, file_name)
-        with open(pdf_file_path, mode="wb") as f:
-            f.write(pdf_stream.read())
-
-        yield json.dumps({"status": "PDFファイルの解析中..."})
-        IMAGE_RESOLUTION_SCALE = 2.0
-        pipeline_options = PdfPipelineOptions()
-        pipeline_options.do_ocr = False
-        pipeline_options.do_table_structure = False
-        pipeline_options.table_structure_options.do_cell_matching = False
-        pipeline_options.table_structure_options.mode = TableFormerMode.ACCURATE
-        pipeline_options.images_scale = IMAGE_RESOLUTION_SCALE
-        pipeline_options.generate_page_images = False
-        pipeline_options.generate_table_images = True
-        pipeline_options.generate_picture_images = True
+        count = min(max(int(request.args.get('count', 1)), 1), OUTLINE_MAX_SECTIONS_PER_REQUEST)
+        section_id = request.args.get('id')
+        section_id = int(section_id) if section_id is not None else None
+    except ValueError:
+        return jsonify({'error': 'id and count must be integers.'}), 400
+    anchor = request.args.get('anchor')
+    if section_id is None and anchor is None:
+        return jsonify({'error': 'id or anchor is required.'}), 400
 
-        converter = DocumentConverter(
-            format_options={
-                InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
-            }
-        )
-        conv_res = converter.convert(pdf_file_path)
+    try:
+        # 開いたファイルの内容とアウトラインを突き合わせる (読んでいる間に置き換えられても影響しない)
+        with open(md_path, 'rb') as f:
+            outline = load_markdown_outline(md_path, f)
+            sections = outline["sections"]
+            if section_id is None:
+                section_id = next((s["id"] for s in sections if s["anchor"] == anchor), None)
+            if section_id is None or not 0 <= section_id < len(sections):
+                return jsonify({'error': 'Section not found'}), 404
+
+            result = []
+            for section in sections[section_id:section_id + count]:
+                f.seek(section["start"])
+                content = f.read(section["end"] - section["start"]).decode('utf-8', errors='replace')
+                result.append({
+                    "id": section["id"],
+                    "heading": section["heading"],
+                    "anchor": section["anchor"],
+                    "content": content,
+                })
 
-        yield json.dumps({"status": "画像保存中..."})
-        table_counter = 0
-        picture_counter = 0
-        for element, _level in conv_res.document.iterate_items():
-            if isinstance(element, TableItem):
-                table_counter += 1
-                element_image_filename = os.path.join(output_dir, f"table-{table_counter}.png")
-                with open(element_image_filename, "wb") as fp:
-                    element.image.pil_image.save(fp, "PNG")
+        response = jsonify({"etag": outline["etag"], "total": len(sections), "sections": result})
+        response.set_etag(f"{outline['etag']}-{section_id}-{count}")
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
 
-            if isinstance(element, PictureItem):
-                picture_counter += 1
-                element_image_filename = os.path.join(output_dir, f"picture-{picture_counter}.png")
-                with open(element_image_filename, "wb") as fp:
-                    element.image.pil_image.save(fp, "PNG")
+########################################################################
+# _origin.md から LLM でマークダウンを生成する処理 (翻訳・解説・スレ形式の共通部分)
+#   spec には出力サフィックス・プロンプト・温度・進捗メッセージなどを持たせる
+########################################################################
+def prepare_generation(data, use_digest=False):
+    """
+    入力チェックと _origin.md の読み込み (use_digest の場合はダイジェストを使う)。
+    戻り値: (エラーメッセージ or None, dir_name, ベース名, マークダウン本文)
+    """
+    dir_name = data.get('dir_name') if data else None
+    if not dir_name:
+        return "dir_name is required", None, None, None
 
-        yield json.dumps({"status": "マークダウン変換中..."})
-        md_text = conv_res.document.export_to_markdown()
+    dir_path = os.path.join(CONTENT_DATA_DIR, dir_name)
+    if not os.path.isdir(dir_path):
+        return "Directory not found", None, None, None
 
-        yield json.dumps({"llm_output": "$=~=$start$=~=$"})
-        result_text = ""
+    origin_md_path, base_name = find_origin_markdown(dir_name)
+    if not origin_md_path:
+        return "Origin markdown file not found", None, None, None
 
-        with get_openai_callback() as cb:
-            chat_model = app.config["CHAT_MODEL"]
-            chat_model.temperature = 0
-            chat_model.streaming = True
+    with trace_span("markdown.load", digest=use_digest) as span:
+        if use_digest:
+            md_text = load_paper_digest(origin_md_path, base_name)["text"]
+        else:
+            with open(origin_md_path, 'r', encoding='utf-8') as f:
+                md_text = f.read()
+        span.set("chars", len(md_text))
+    return None, dir_name, base_name, md_text
 
-            system_prompt = SystemMessage(
-                content=
-                """
-                与えられたマークダウン文章に以下の処理を行い、追記後のマークダウン文章を出力してください。
+def build_generation_messages(spec, md_text):
+    return build_chat_messages(spec["system_prompt"], md_text)
 
-                ・文章中における図の部分に、`![Local Image](picture-$.png)\n`($は図番号)を追記してください。
-                ・文章中における表の部分に、`![Local Image](table-$.png)\n`($は表番号)を追記してください。
+def save_generated_markdown(spec, dir_name, base_name, result_text, overwrite=True):
+    """
+    生成結果を {base}{suffix} に保存する。
+    overwrite=False の場合は既存のファイルを残し、保存しなかったら False を返す
+    """
+    if spec["strip_code_fence"]:
+        result_text = strip_code_fence(result_text)
 
-                出力は、必ずマークダウン文章のみで、余計な文章は含めないでください。
-                """
-            )
-            image_message = HumanMessage(content=md_text)
-            messages = [system_prompt, image_message]
+    md_filename = os.path.join(CONTENT_DATA_DIR, dir_name, f"{base_name}{spec['suffix']}")
+    with trace_span("markdown.save", chars=len(result_text)) as span:
+        if overwrite:
+            with atomic_write(md_filename) as f:
+                f.write(result_text)
+        else:
+            # 書き終えた一時ファイルをリンクする (同名のファイルがあれば失敗するので上書きしない)
+            tmp_filename = unique_tmp_path(md_filename)
+            try:
+                with open(tmp_filename, mode="w", encoding="utf-8") as f:
+                    f.write(result_text)
+                os.link(tmp_filename, md_filename)
+            except FileExistsError:
+                span.set("skipped", True)
+                # 他で作られたファイルをカタログ等に反映しておく
+                on_artifact_written(dir_name, md_filename)
+                return False
+            finally:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+        on_artifact_written(dir_name, md_filename)
+    return True
+
+# 生成中の出力は {base}{suffix}.partial に追記し、この間隔 (秒) で fsync してチェックポイントを更新する
+GENERATION_SYNC_INTERVAL = float(os.getenv("GENERATION_SYNC_INTERVAL", "2.0"))
+PARTIAL_SUFFIX = ".partial"
+CHECKPOINT_SUFFIX = ".partial.json"
+# 再開時に LLM へ渡す、出力済み部分の末尾の文字数
+RESUME_TAIL_CHARS = 2000
+MARKDOWN_HEADING_LINE = re.compile(r'^#{1,6}\s.*$', re.M)
+
+class GenerationInProgress(Exception):
+    pass
+
+def split_resume_point(text):
+    """
+    途中までの出力を、最後の見出しの手前 (書き終えたセクションまで) で切る。
+    戻り値: (引き継ぐ出力, 再開する見出しの行)。見出しが無ければ ("", None)
+    """
+    headings = list(MARKDOWN_HEADING_LINE.finditer(text))
+    if not headings or headings[-1].start() == 0:
+        return "", None
+    last = headings[-1]
+    return text[:last.start()], last.group(0)
 
-            for result in chat_model.stream(messages):
-                result_text += result.content
-                if result == '':
-                    continue
-                yield json.dumps({"llm_output": result.content})
+class GenerationCheckpoint:
+    """
+    生成中の出力をファイルに追記し、完了したら {base}{suffix} に置き換える (atomic rename)。
+    途中で終わった場合は .partial と .partial.json を残し、次回は書き終えたセクションの続きから再開する。
+    同じファイルの生成が他で実行中なら GenerationInProgress。
+    paper_lock を渡すと、閉じるときに一緒に解放する
+    """
+    def __init__(self, md_filename, source_fingerprint, paper_lock=None):
+        self.md_filename = md_filename
+        self.paper_lock = paper_lock
+        self.partial_path = f"{md_filename}{PARTIAL_SUFFIX}"
+        self.meta_path = f"{md_filename}{CHECKPOINT_SUFFIX}"
+        self.source_fingerprint = source_fingerprint
+        self.prefix = ""
+        self.resume_heading = None
+        self.chars = 0
+        self.started_at = time.time()
+        self._file = None
+        self._last_sync = 0.0
+
+    def read_meta(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
 
-            print(f"\nTotal Tokens: {cb.total_tokens}")
-            print(f"Prompt Tokens: {cb.prompt_tokens}")
-            print(f"Completion Tokens: {cb.completion_tokens}")
-            print(f"Total Cost (USD): ${cb.total_cost}\n")
+    def open(self, resume=True):
+        import fcntl
 
-        result_text = result_text.replace("```markdown", "").replace("```", "")
+        partial = open(self.partial_path, 'a+', encoding='utf-8')
+        try:
+            fcntl.flock(partial, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            partial.close()
+            self.close()
+            raise GenerationInProgress("この論文の同じ生成が実行中です。")
+        self._file = partial
+
+        meta = self.read_meta()
+        partial.seek(0)
+        previous = partial.read()
+        if resume and previous and meta and meta.get("source") == self.source_fingerprint:
+            self.prefix, self.resume_heading = split_resume_point(previous)
+        partial.seek(0)
+        partial.truncate()
+        partial.write(self.prefix)
+        self.chars = len(self.prefix)
+        self.sync()
+        return self
+
+    def append(self, content):
+        self._file.write(content)
+        self.chars += len(content)
+
+    def sync_due(self):
+        return time.monotonic() - self._last_sync >= GENERATION_SYNC_INTERVAL
+
+    def sync(self, state="running", error=None):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        meta = {
+            "source": self.source_fingerprint,
+            "state": state,
+            "chars": self.chars,
+            "resumed_chars": len(self.prefix),
+            "started_at": self.started_at,
+            "updated_at": time.time(),
+            "error": str(error) if error else None,
+        }
+        with atomic_write(self.meta_path) as f:
+            json.dump(meta, f)
+        self._last_sync = time.monotonic()
+
+    def complete(self, strip_fence=False):
+        self._file.flush()
+        if strip_fence:
+            self._file.seek(0)
+            text = strip_code_fence(self._file.read())
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(text)
+            self._file.flush()
+        os.fsync(self._file.fileno())
+        os.replace(self.partial_path, self.md_filename)
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        self.close()
+
+    def abort(self, error=None):
+        """
+        途中までの出力を保存して閉じる (次回の再開用)
+        """
+        if self._file is None:
+            return
+        try:
+            self.sync("interrupted", error)
+        except OSError:
+            traceback.print_exc()
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.paper_lock is not None:
+            self.paper_lock.release()
+            self.paper_lock = None
+
+def open_generation_checkpoint(spec, dir_name, base_name, resume=True):
+    origin_md_path, _ = find_origin_markdown(dir_name)
+    md_filename = os.path.join(CONTENT_DATA_DIR, dir_name, f"{base_name}{spec['suffix']}")
+    with trace_span("generation.checkpoint", resume=resume) as span:
+        # 生成中にディレクトリごと削除されないよう、終わるまで論文の共有ロックを持つ
+        paper_lock = PaperLock(dir_name).acquire()
+        try:
+            checkpoint = GenerationCheckpoint(md_filename, get_file_fingerprint(origin_md_path), paper_lock).open(resume)
+        except BaseException:
+            paper_lock.release()
+            raise
+        span.set("resumed_chars", len(checkpoint.prefix))
+    return checkpoint
+
+def build_resume_messages(spec, md_text, checkpoint):
+    """
+    再開する場合、見出しが原文にそのまま含まれていれば (翻訳など) その見出し以降の原文だけを渡し、
+    そうでなければ出力済み部分の末尾を添えて続きを出力させる
+    """
+    heading = checkpoint.resume_heading
+    if not heading:
+        return build_generation_messages(spec, md_text)
+    match = re.search(rf'^{re.escape(heading.strip())}\s*$', md_text, re.M)
+    if match:
+        return build_chat_messages(spec["system_prompt"], md_text[match.start():])
+    note = (
+        "\n・出力の途中から再開します。既に出力した部分の末尾は以下のとおりです。"
+        f"見出し「{heading.strip()}」から続きを出力し、それより前の部分は出力しないでください。\n\n"
+        f"{checkpoint.prefix[-RESUME_TAIL_CHARS:]}\n"
+    )
+    return build_chat_messages(spec["system_prompt"] + note, md_text)
 
-        md_filename = os.path.join(output_dir, f"{base_name}_origin.md")
-        with open(md_filename, mode="w", encoding="utf-8") as f:
-            f.write(result_text)
+def finish_generation(spec, dir_name, base_name, checkpoint):
+    """
+    生成結果を確定し、最後に送るイベントのリストを返す
+    """
+    with trace_span("markdown.save", chars=checkpoint.chars):
+        checkpoint.complete(spec["strip_code_fence"])
+        on_artifact_written(dir_name, checkpoint.md_filename)
+    return [
+        {"llm_output": LLM_OUTPUT_END},
+        {"status": spec["done_status"], "base_file_name": base_name},
+    ]
+
+def generation_username(data):
+    """
+    同時実行数の制限に使うユーザー名 (dir_name の先頭)
+    """
+    dir_name = data.get('dir_name') if isinstance(data, dict) else None
+    return split_user_dir_name(dir_name)[0] if dir_name else None
 
-        yield json.dumps({"llm_output": "$=~=$end$=~=$"})
-        yield json.dumps({"dir_name": f"{username}/{dir_name}", "base_file_name": base_name})
+def generation_steps(spec, data):
+    """
+    翻訳・解説・スレ形式の生成の手順 (Flask / ASGI 共通)
+    """
+    try:
+        error, dir_name, base_name, md_text = yield Call(prepare_generation, data, spec["use_digest"])
+        if error:
+            yield Emit({"error": error})
+            return
 
+        checkpoint = yield Call(open_generation_checkpoint, spec, dir_name, base_name, data.get('resume', True))
+        try:
+            yield Emit({"status": spec["status"] if not checkpoint.prefix else "前回の続きから生成します..."})
+            yield Emit({"llm_output": LLM_OUTPUT_START})
+            if checkpoint.prefix:
+                yield Emit({"llm_output": checkpoint.prefix})
+
+            stream = yield OpenLLMStream(spec["route"], build_resume_messages(spec, md_text, checkpoint), spec["temperature"])
+            while True:
+                content = yield NextChunk(stream)
+                if content is None:
+                    break
+                checkpoint.append(content)
+                if checkpoint.sync_due():
+                    yield Call(checkpoint.sync)
+                yield Emit({"llm_output": content})
+
+            events = yield Call(finish_generation, spec, dir_name, base_name, checkpoint)
+        except BaseException as e:
+            # 切断 (GeneratorExit) やエラーでも、途中までの出力は残しておく
+            checkpoint.abort(e)
+            raise
+        for event in events:
+            yield Emit(event)
+    except (GenerationInProgress, PaperBusy) as e:
+        yield Emit({"error": str(e)})
     except Exception as e:
-        # ★失敗時、作りかけのディレクトリを削除する
-        shutil.rmtree(output_dir, ignore_errors=True)
-        raise e  # エラーを再送出して SSE に載せる
+        error_traceback = traceback.format_exc()
+        print(error_traceback)
+        yield Emit({"error": f"{spec['error_prefix']}: {str(e)}"})
+
+def iter_generation_events(spec, data):
+    """
+    生成処理を実行し、SSE の文字列を順に返すジェネレータ
+    """
+    yield from iter_step_events(generation_steps(spec, data))
 
 ########################################################################
 # 日本語翻訳
 ########################################################################
-@app.route('/trans_markdown', methods=['POST'])
-def trans_markdown():
-    @stream_with_context
-    def generate():
-        try:
-            data = request.get_json()
-            dir_name = data.get('dir_name')
-            if not dir_name:
-                yield f'data: {json.dumps({"error": "dir_name is required"})}\n\n'
-                return
-
-            dir_path = os.path.join(CONTENT_DATA_DIR, dir_name)
-            if not os.path.isdir(dir_path):
-                yield f'data: {json.dumps({"error": "Directory not found"})}\n\n'
-                return
-
-            files = os.listdir(dir_path)
-            origin_md_files = [f for f in files if f.lower().endswith('_origin.md')]
-            if not origin_md_files:
-                yield f'data: {json.dumps({"error": "Origin markdown file not found"})}\n\n'
-                return
-
-            origin_md_file = origin_md_files[0]
-            origin_md_path = os.path.join(dir_path, origin_md_file)
-            base_name = os.path.splitext(origin_md_file)[0].replace('_origin', '')
-
-            with open(origin_md_path, 'r', encoding='utf-8') as f:
-                md_text = f.read()
-
-            yield f'data: {json.dumps({"status": "日本語に変換中..."})}\n\n'
-            yield f'data: {json.dumps({"llm_output": "$=~=$start$=~=$"})}\n\n'
-            result_text = ""
-
-            with get_openai_callback() as cb:
-                chat_model = app.config["CHAT_MODEL"]
-                chat_model.temperature = 0
-                chat_model.streaming = True
-
-                system_prompt = SystemMessage(
-                    content=
-                    """
+TRANS_SYSTEM_PROMPT = \
+"""
                     以下のマークダウン文書を日本語に翻訳してください。
                     コードブロックやマークダウンの書式はそのままにしてください。
                     見出し部分は、翻訳せず原文そのままとしてください。
 
                     出力は、必ずマークダウン文章のみで、余計な文章は含めないでください。
                     """
-                )
-                translate_message = HumanMessage(content=md_text)
-                messages = [system_prompt, translate_message]
-
-                for result in chat_model.stream(messages):
-                    result_text += result.content
-                    if result == '':
-                        continue
-                    yield f'data: {json.dumps({"llm_output": result.content})}\n\n'
-
-                print(f"\nTotal Tokens: {cb.total_tokens}")
-                print(f"Prompt Tokens: {cb.prompt_tokens}")
-                print(f"Completion Tokens: {cb.completion_tokens}")
-                print(f"Total Cost (USD): ${cb.total_cost}\n")
-
-            ja_md_filename = os.path.join(dir_path, f"{base_name}_trans.md")
-            with open(ja_md_filename, mode="w", encoding="utf-8") as f:
-                f.write(result_text)
 
-            yield f'data: {json.dumps({"llm_output": "$=~=$end$=~=$"})}\n\n'
-            yield f'data: {json.dumps({"status": "変換完了しました", "base_file_name": base_name})}\n\n'
-        except Exception as e:
-            error_traceback = traceback.format_exc()
-            print(error_traceback)
-            yield f'data: {json.dumps({"error": f"Error during translation: {str(e)}"})}\n\n'
-            return
+TRANS_SPEC = {
+    "route": "translate",
+    "suffix": "_trans.md",
+    "system_prompt": TRANS_SYSTEM_PROMPT,
+    "temperature": 0,
+    "use_digest": False,
+    "strip_code_fence": False,
+    "status": "日本語に変換中...",
+    "done_status": "変換完了しました",
+    "error_prefix": "Error during translation",
+}
 
-    return Response(generate(), mimetype='text/event-stream')
+@app.route('/trans_markdown', methods=['POST'])
+def trans_markdown():
+    data = request.get_json(silent=True)
+
+    def generate():
+        yield from iter_generation_events(TRANS_SPEC, data)
+
+    return stream_with_admission("generate", generation_username(data), generate)
 
 ########################################################################
 # マークダウン保存
@@ -724,10 +5122,13 @@ def save_markdown():
             return jsonify({'error': 'Directory not found.'}), 404
 
         target_file_path = os.path.join(target_dir, file_name)
-        with open(target_file_path, 'w', encoding='utf-8') as f:
+        with PaperLock(dir_name), atomic_write(target_file_path) as f:
             f.write(content)
+        on_artifact_written(dir_name, target_file_path)
 
         return jsonify({'message': 'File saved successfully.'}), 200
+    except PaperBusy as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         error_traceback = traceback.format_exc()
         print(error_traceback)
@@ -757,19 +5158,22 @@ def delete_file():
         if not os.path.isdir(target_dir):
             return jsonify({'error': 'Directory not found.'}), 404
 
-        # ディレクトリ内から suffix にマッチするファイルを探す
-        found_file = None
-        for f in os.listdir(target_dir):
-            if f.lower().endswith(suffix.lower()):
-                found_file = os.path.join(target_dir, f)
-                break
+        with PaperLock(f"{username}/{dir_name}"):
+            # ディレクトリ内から suffix にマッチするファイルを探す
+            found_file = None
+            for f in os.listdir(target_dir):
+                if f.lower().endswith(suffix.lower()):
+                    found_file = os.path.join(target_dir, f)
+                    break
 
-        if found_file and os.path.isfile(found_file):
+            if not found_file or not os.path.isfile(found_file):
+                return jsonify({'error': 'No matching file found to delete'}), 404
             os.remove(found_file)
-            return jsonify({'message': f'File "{os.path.basename(found_file)}" has been deleted.'}), 200
-        else:
-            return jsonify({'error': 'No matching file found to delete'}), 404
+        on_artifact_removed(f"{username}/{dir_name}", os.path.basename(found_file))
+        return jsonify({'message': f'File "{os.path.basename(found_file)}" has been deleted.'}), 200
 
+    except PaperBusy as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         error_traceback = traceback.format_exc()
         print(error_traceback)
@@ -798,9 +5202,16 @@ def delete_directory():
         if not os.path.isdir(target_dir):
             return jsonify({'error': 'Directory not found.'}), 404
 
-        import shutil
-        shutil.rmtree(target_dir)
+        # 生成・取り込み中の論文は削除しない (排他ロックが取れるまで待ち、取れなければ 409)
+        lock = PaperLock(f"{username}/{dir_name}", exclusive=True).acquire()
+        try:
+            shutil.rmtree(target_dir)
+        finally:
+            lock.release(remove=not os.path.exists(lock.dir_path))
+        on_artifact_removed(f"{username}/{dir_name}")
         return jsonify({'message': f'Directory "{dir_name}" has been deleted successfully.'}), 200
+    except PaperBusy as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         error_traceback = traceback.format_exc()
         print(error_traceback)
@@ -823,19 +5234,17 @@ def initialize_state():
     if not os.path.isdir(input_dir):
         return jsonify({"error": f"指定されたディレクトリが存在しません: {input_dir_param}"}), 400
 
-    md_files = [f for f in os.listdir(input_dir) if f.endswith('_origin.md')]
-    if not md_files:
+    md_path, base_name = find_origin_markdown(input_dir_param)
+    if not md_path:
         return jsonify({"error": "ディレクトリ内に_origin.mdファイルが存在しません。"}), 400
 
-    md_path = os.path.join(input_dir, md_files[0])
-    with open(md_path, mode="r", encoding="utf-8") as f:
-        md_text = f.read()
+    if CHAT_USE_DIGEST:
+        md_text = load_paper_digest(md_path, base_name)["text"]
+    else:
+        with open(md_path, mode="r", encoding="utf-8") as f:
+            md_text = f.read()
 
-    png_files = []
-    for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            if (file.startswith('table') or file.startswith('picture')) and file.endswith('.png'):
-                png_files.append(os.path.join(root, file))
+    png_files = get_catalog_entry(input_dir_param)['image_files']
 
     state = {"messages": []}
     system_prompt = """
@@ -848,6 +5257,7 @@ def initialize_state():
     }
     state["messages"].append(system_message)
 
+    from langchain_core.prompts import PromptTemplate
     prompt_template = PromptTemplate(
         input_variables=["paper_content"],
         template="""
@@ -888,26 +5298,19 @@ def initialize_state():
 ########################################################################
 # LangGraphエージェント構築
 ########################################################################
-class State(TypedDict):
-    messages: Annotated[list, add_messages]
-
 def initialize_agent():
-    graph_builder = StateGraph(State)
+    from typing import Annotated
+    from typing_extensions import TypedDict
+    from langgraph.graph import StateGraph
+    from langgraph.graph.message import add_messages
 
-    def chatbot(state: State):
-        with get_openai_callback() as cb:
-            chat_model = app.config["CHAT_MODEL"]
-            chat_model.temperature = 1
-            chat_model.streaming = False
+    class State(TypedDict):
+        messages: Annotated[list, add_messages]
 
-            answer = {"messages": [chat_model.invoke(state["messages"])]}
-
-            print(f"\nTotal Tokens: {cb.total_tokens}")
-            print(f"Prompt Tokens: {cb.prompt_tokens}")
-            print(f"Completion Tokens: {cb.completion_tokens}")
-            print(f"Total Cost (USD): ${cb.total_cost}\n")
+    graph_builder = StateGraph(State)
 
-            return answer
+    def chatbot(state: State):
+        return {"messages": [invoke_llm("chat", state["messages"], temperature=1)]}
 
     graph_builder.add_node("chatbot", chatbot)
     graph_builder.set_entry_point("chatbot")
@@ -1006,7 +5409,142 @@ def scholar_agent():
 
 ########################################################################
 # ディレクトリダウンロード (Zip)
+#   zip を書きながら送信し、同時にキャッシュへ保存する。
+#   PNG/PDF など圧縮済みの形式は無圧縮 (STORED) で格納する。
 ########################################################################
+ZIP_CACHE_DIR = os.path.join(CACHE_DIR, 'zip')
+# zip キャッシュ全体の上限 (バイト)。超えたら古いものから削除
+ZIP_CACHE_MAX_BYTES = int(os.getenv("ZIP_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+ZIP_STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.pdf', '.zip', '.gz', '.br', '.zst')
+# zip に含めないファイル (配信用の圧縮版や書き込み途中の一時ファイル)
+ZIP_EXCLUDED_EXTENSIONS = (
+    '.md.gz', '.md.br', '.tmp', DIGEST_SUFFIX, DOCLING_SUFFIX, PARTIAL_SUFFIX, CHECKPOINT_SUFFIX, OUTLINE_SUFFIX,
+    ORIGIN_EXPORT_SUFFIX, INGEST_STATE_FILE,
+)
+
+class ZipStreamBuffer:
+    """
+    zipfile の書き込み先。書かれたバイト列を溜めておき、drain() で取り出す。
+    (シーク不可のストリームとして扱われるため zipfile はデータディスクリプタを使う)
+    """
+    def __init__(self, tee=None):
+        self.chunks = []
+        self.tee = tee
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        if self.tee:
+            self.tee.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def collect_zip_entries(sources):
+    """
+    sources: [(ディレクトリのパス, zip内の接頭辞), ...] から (ファイルパス, zip内パス, stat) を列挙する
+    """
+    entries = []
+    for root_dir, prefix in sources:
+        # ストレージにだけある (ローカルのキャッシュから消えた) 成果物を先に取ってくる
+        for root, _, _ in os.walk(root_dir):
+            fetch_paper_artifacts(root)
+        for root, _, files in os.walk(root_dir):
+            for file in sorted(files):
+                if file.lower().endswith(ZIP_EXCLUDED_EXTENSIONS):
+                    continue
+                file_path = os.path.join(root, file)
+                arcname = os.path.join(prefix, os.path.relpath(file_path, root_dir))
+                entries.append((file_path, arcname, os.stat(file_path)))
+    return entries
+
+def get_zip_fingerprint(entries):
+    """
+    zip に含まれるファイルの (パス, サイズ, 更新時刻) から内容のフィンガープリントを作る
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for _, arcname, st in entries:
+        digest.update(f"{arcname}\0{st.st_size}\0{st.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def prune_zip_cache():
+    """
+    zip キャッシュの合計サイズが上限を超えたら、最終アクセスが古いものから削除する
+    """
+    cached = []
+    for root, _, files in os.walk(ZIP_CACHE_DIR):
+        for file in files:
+            path = os.path.join(root, file)
+            st = os.stat(path)
+            cached.append((st.st_atime, st.st_size, path))
+    total = sum(size for _, size, _ in cached)
+    for _, size, path in sorted(cached):
+        if total <= ZIP_CACHE_MAX_BYTES:
+            break
+        os.remove(path)
+        total -= size
+
+def stream_zip(entries, cache_path):
+    """
+    zip を書きながらチャンクを返すジェネレータ。最後まで送れた場合のみキャッシュとして保存する。
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = unique_tmp_path(cache_path)
+    completed = False
+    try:
+        with open(tmp_path, 'wb') as cache_file:
+            buffer = ZipStreamBuffer(tee=cache_file)
+            with zipfile.ZipFile(buffer, 'w') as zf:
+                for file_path, arcname, st in entries:
+                    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+                    if file_path.lower().endswith(ZIP_STORED_EXTENSIONS):
+                        zinfo.compress_type = zipfile.ZIP_STORED
+                    else:
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    with open(file_path, 'rb') as src, \
+                            zf.open(zinfo, 'w', force_zip64=st.st_size > zipfile.ZIP64_LIMIT) as dst:
+                        for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                            dst.write(chunk)
+                            yield buffer.drain()
+                    yield buffer.drain()
+            yield buffer.drain()
+        os.replace(tmp_path, cache_path)
+        completed = True
+        prune_zip_cache()
+    finally:
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def send_zip(entries, cache_path, download_name):
+    """
+    キャッシュ済みならファイルとして (ETag/Range 付きで) 返し、無ければ生成しながら返す
+    """
+    if os.path.exists(cache_path):
+        os.utime(cache_path)  # LRU 用にアクセス時刻を更新
+        return send_file(
+            cache_path,
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name=download_name,
+            etag=os.path.basename(cache_path)[:-4],
+        )
+
+    response = Response(stream_zip(entries, cache_path), mimetype='application/zip')
+    response.headers['Content-Disposition'] = \
+        f"attachment; filename=\"download.zip\"; filename*=UTF-8''{url_quote(download_name)}"
+    return response
+
 @app.route('/download_directory', methods=['GET'])
 def download_directory():
     """
@@ -1037,69 +5575,63 @@ def download_directory():
         if not os.path.isdir(target_dir):
             return jsonify({'error': 'Directory not found.'}), 404
 
-        memory_file = BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for root, _, files in os.walk(target_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, target_dir)
-                    zf.write(file_path, arcname)
-
-        memory_file.seek(0)
-        return send_file(
-            memory_file,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=f'{dir_name}.zip'
-        )
+        entries = collect_zip_entries([(target_dir, '')])
+        fingerprint = get_zip_fingerprint(entries)
+        cache_path = os.path.join(ZIP_CACHE_DIR, username, f"{fingerprint}.zip")
+        return send_zip(entries, cache_path, f'{dir_name}.zip')
 
     except Exception as e:
         error_traceback = traceback.format_exc()
         print(error_traceback)
         return jsonify({'error': f'Error creating zip file: {str(e)}'}), 500
 
-########################################################################
-# 論文解説 _explain.md 生成
-########################################################################
-@app.route('/explain_paper', methods=['POST'])
-def explain_paper():
-    @stream_with_context
-    def generate():
-        try:
-            data = request.get_json()
-            dir_name = data.get('dir_name')
-            if not dir_name:
-                yield f'data: {json.dumps({"error": "dir_name is required"})}\n\n'
-                return
-
-            dir_path = os.path.join(CONTENT_DATA_DIR, dir_name)
-            if not os.path.isdir(dir_path):
-                yield f'data: {json.dumps({"error": "Directory not found"})}\n\n'
-                return
-
-            files = os.listdir(dir_path)
-            origin_md_files = [f for f in files if f.lower().endswith('_origin.md')]
-            if not origin_md_files:
-                yield f'data: {json.dumps({"error": "Origin markdown file not found"})}\n\n'
-                return
+@app.route('/download_library', methods=['GET'])
+def download_library():
+    """
+    複数ディレクトリ (dir_names をカンマ区切りで指定、省略時は全論文) を1つのzipでダウンロード
+    """
+    try:
+        username = request.args.get('username')
+        if not username:
+            return jsonify({'error': 'username is required'}), 400
 
-            origin_md_path = os.path.join(dir_path, origin_md_files[0])
-            base_name = os.path.splitext(origin_md_files[0])[0].replace('_origin', '')
+        if '..' in username or '/' in username or '\\' in username:
+            return jsonify({'error': 'Invalid username.'}), 400
 
-            with open(origin_md_path, 'r', encoding='utf-8') as f:
-                md_text = f.read()
+        user_dir = os.path.join(CONTENT_DATA_DIR, username)
+        if not os.path.isdir(user_dir):
+            return jsonify({'error': f'User directory not found: {username}'}), 404
 
-            yield f'data: {json.dumps({"status": "論文を解説中..."})}\n\n'
-            yield f'data: {json.dumps({"llm_output": "$=~=$start$=~=$"})}\n\n'
-            result_text = ""
+        dir_names_param = request.args.get('dir_names')
+        if dir_names_param:
+            dir_names = [d for d in dir_names_param.split(',') if d]
+        else:
+            ensure_catalog(username)
+            with user_db(username) as conn:
+                dir_names = [r[0] for r in conn.execute('SELECT dir_name FROM papers ORDER BY dir_name')]
+
+        for d in dir_names:
+            if '..' in d or '/' in d or '\\' in d:
+                return jsonify({'error': 'Invalid directory name.'}), 400
+            if not os.path.isdir(os.path.join(user_dir, d)):
+                return jsonify({'error': f'Directory not found: {d}'}), 404
+        if not dir_names:
+            return jsonify({'error': 'No directories to download.'}), 404
+
+        entries = collect_zip_entries([(os.path.join(user_dir, d), d) for d in sorted(dir_names)])
+        fingerprint = get_zip_fingerprint(entries)
+        cache_path = os.path.join(ZIP_CACHE_DIR, username, f"{fingerprint}.zip")
+        return send_zip(entries, cache_path, f'{username}_library.zip')
 
-            with get_openai_callback() as cb:
-                chat_model = app.config["CHAT_MODEL"]
-                chat_model.temperature = 0
-                chat_model.streaming = True
+    except Exception as e:
+        error_traceback = traceback.format_exc()
+        print(error_traceback)
+        return jsonify({'error': f'Error creating zip file: {str(e)}'}), 500
 
-                system_prompt = SystemMessage(
-                    content=
+########################################################################
+# 論文解説 _explain.md 生成
+########################################################################
+EXPLAIN_SYSTEM_PROMPT = \
 """
 この論文を読みたいです。以下の制約を守り、要約をお願いします。
 目的：論文の概要から詳細をつかみ、この論文をより詳しく読むべきか判断したい
@@ -1140,79 +5672,33 @@ def explain_paper():
 
 # 今後の発展
 """
-                )
-                explain_message = HumanMessage(content=md_text)
-                messages = [system_prompt, explain_message]
-
-                for result in chat_model.stream(messages):
-                    result_text += result.content
-                    if result == '':
-                        continue
-                    yield f'data: {json.dumps({"llm_output": result.content})}\n\n'
-
-                print(f"\nTotal Tokens: {cb.total_tokens}")
-                print(f"Prompt Tokens: {cb.prompt_tokens}")
-                print(f"Completion Tokens: {cb.completion_tokens}")
-                print(f"Total Cost (USD): ${cb.total_cost}\n")
-
-            explain_md_filename = os.path.join(dir_path, f"{base_name}_explain.md")
-            with open(explain_md_filename, mode="w", encoding="utf-8") as f:
-                f.write(result_text)
 
-            yield f'data: {json.dumps({"llm_output": "$=~=$end$=~=$"})}\n\n'
-            yield f'data: {json.dumps({"status": "解説の生成が完了しました"})}\n\n'
+EXPLAIN_SPEC = {
+    "route": "explain",
+    "suffix": "_explain.md",
+    "system_prompt": EXPLAIN_SYSTEM_PROMPT,
+    "temperature": 0,
+    "use_digest": GENERATION_USE_DIGEST,
+    "strip_code_fence": False,
+    "status": "論文を解説中...",
+    "done_status": "解説の生成が完了しました",
+    "error_prefix": "Error during explanation",
+}
 
-        except Exception as e:
-            error_traceback = traceback.format_exc()
-            print(error_traceback)
-            yield f'data: {json.dumps({"error": f"Error during explanation: {str(e)}"})}\n\n'
-            return
+@app.route('/explain_paper', methods=['POST'])
+def explain_paper():
+    data = request.get_json(silent=True)
 
-    return Response(generate(), mimetype='text/event-stream')
+    def generate():
+        yield from iter_generation_events(EXPLAIN_SPEC, data)
+
+    return stream_with_admission("generate", generation_username(data), generate)
 
 ########################################################################
 # なんJスレ形式解説 _thread.md 生成
 ########################################################################
-@app.route('/thread_paper', methods=['POST'])
-def thread_paper():
-    @stream_with_context
-    def generate():
-        try:
-            data = request.get_json()
-            dir_name = data.get('dir_name')
-            if not dir_name:
-                yield f'data: {json.dumps({"error": "dir_name is required"})}\n\n'
-                return
-
-            dir_path = os.path.join(CONTENT_DATA_DIR, dir_name)
-            if not os.path.isdir(dir_path):
-                yield f'data: {json.dumps({"error": "Directory not found"})}\n\n'
-                return
-
-            files = os.listdir(dir_path)
-            origin_md_files = [f for f in files if f.lower().endswith('_origin.md')]
-            if not origin_md_files:
-                yield f'data: {json.dumps({"error": "Origin markdown file not found"})}\n\n'
-                return
-
-            origin_md_path = os.path.join(dir_path, origin_md_files[0])
-            base_name = os.path.splitext(origin_md_files[0])[0].replace('_origin', '')
-
-            with open(origin_md_path, 'r', encoding='utf-8') as f:
-                md_text = f.read()
-
-            yield f'data: {json.dumps({"status": "スレッド形式で解説中..."})}\n\n'
-            yield f'data: {json.dumps({"llm_output": "$=~=$start$=~=$"})}\n\n'
-            result_text = ""
-
-            with get_openai_callback() as cb:
-                chat_model = app.config["CHAT_MODEL"]
-                chat_model.temperature = 1
-                chat_model.streaming = True
-
-                system_prompt = SystemMessage(
-                    content=
-                    """
+THREAD_SYSTEM_PROMPT = \
+"""
                     以下の論文内容に対してなんJの架空のスレを創造的に書いてください。
 
                     [指示]
@@ -1244,37 +5730,310 @@ def thread_paper():
 
                     （以下、レスが続く）
                     """
-                )
-                thread_message = HumanMessage(content=md_text)
-                messages = [system_prompt, thread_message]
 
-                for result in chat_model.stream(messages):
-                    result_text += result.content
-                    if result == '':
-                        continue
-                    yield f'data: {json.dumps({"llm_output": result.content})}\n\n'
+THREAD_SPEC = {
+    "route": "thread",
+    "suffix": "_thread.md",
+    "system_prompt": THREAD_SYSTEM_PROMPT,
+    "temperature": 1,
+    "use_digest": GENERATION_USE_DIGEST,
+    "strip_code_fence": True,
+    "status": "スレッド形式で解説中...",
+    "done_status": "スレッド生成が完了しました",
+    "error_prefix": "Error during thread generation",
+}
 
-                print(f"\nTotal Tokens: {cb.total_tokens}")
-                print(f"Prompt Tokens: {cb.prompt_tokens}")
-                print(f"Completion Tokens: {cb.completion_tokens}")
-                print(f"Total Cost (USD): ${cb.total_cost}\n")
+@app.route('/thread_paper', methods=['POST'])
+def thread_paper():
+    data = request.get_json(silent=True)
 
-            thread_md_filename = os.path.join(dir_path, f"{base_name}_thread.md")
+    def generate():
+        yield from iter_generation_events(THREAD_SPEC, data)
 
-            result_text = result_text.replace("```markdown", "").replace("```", "")
-            with open(thread_md_filename, mode="w", encoding="utf-8") as f:
-                f.write(result_text)
+    return stream_with_admission("generate", generation_username(data), generate)
+
+########################################################################
+# 空き時間の事前生成 (翻訳・解説)
+#   _origin.md はあるが _trans.md などが無い論文を全ユーザー分探し、
+#   対話的な処理が無いとき (同時実行数が PREGEN_MAX_INTERACTIVE 以下) に1件ずつ生成しておく。
+#   1日あたりのコストの上限・一時停止・再開は /pregen (管理者用) で操作でき、
+#   状態は PREGEN_STATE_PATH に保存する (複数ワーカーでも実行するのはロックを取った1プロセスのみ)。
+#   既存のファイルは上書きしない。
+########################################################################
+PREGEN_ENABLED = os.getenv("PREGEN_ENABLED", "0") == "1"
+PREGEN_KINDS = [k for k in os.getenv("PREGEN_KINDS", "trans,explain").split(",") if k]
+PREGEN_DAILY_BUDGET_USD = float(os.getenv("PREGEN_DAILY_BUDGET_USD", "1.0"))
+PREGEN_INTERVAL = float(os.getenv("PREGEN_INTERVAL", "30"))
+PREGEN_MAX_INTERACTIVE = int(os.getenv("PREGEN_MAX_INTERACTIVE", "0"))
+# 同じ論文・種類でこの回数失敗したら対象から外す
+PREGEN_MAX_FAILURES = 3
+# 失敗したときの待ち時間の上限 (秒)。失敗するたびに倍にする
+PREGEN_BACKOFF_MAX = 1800
+PREGEN_STATE_PATH = os.path.join(CACHE_DIR, "pregen_state.json")
+PREGEN_LOCK_PATH = os.path.join(CACHE_DIR, "pregen.lock")
+PREGEN_SPECS = {"trans": TRANS_SPEC, "explain": EXPLAIN_SPEC, "thread": THREAD_SPEC}
+# 日ごとの集計を残す日数
+PREGEN_HISTORY_DAYS = 30
+
+def default_pregen_state():
+    return {
+        "paused": False,
+        "daily_budget_usd": None,
+        "days": {},
+        "failures": {},
+        "current": None,
+        "last_error": None,
+        "backoff_until": 0,
+    }
 
-            yield f'data: {json.dumps({"llm_output": "$=~=$end$=~=$"})}\n\n'
-            yield f'data: {json.dumps({"status": "スレッド生成が完了しました"})}\n\n'
+def load_pregen_state():
+    try:
+        with open(PREGEN_STATE_PATH, 'r', encoding='utf-8') as f:
+            return {**default_pregen_state(), **json.load(f)}
+    except (OSError, ValueError):
+        return default_pregen_state()
+
+def save_pregen_state(state):
+    for day in sorted(state["days"])[:-PREGEN_HISTORY_DAYS]:
+        del state["days"][day]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with atomic_write(PREGEN_STATE_PATH) as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+
+def pregen_today(state):
+    return state["days"].setdefault(
+        datetime.now().strftime("%Y-%m-%d"), {"cost_usd": 0.0, "total_tokens": 0, "done": 0, "failed": 0}
+    )
 
+def pregen_budget(state):
+    budget = state.get("daily_budget_usd")
+    return PREGEN_DAILY_BUDGET_USD if budget is None else budget
+
+def iter_pregen_candidates(state):
+    """
+    事前生成が必要な (ユーザー名, ディレクトリ名, 種類) を、新しい論文から順に返す
+    """
+    if not os.path.isdir(CONTENT_DATA_DIR):
+        return
+    kinds = [kind for kind in PREGEN_KINDS if kind in PREGEN_SPECS]
+    for username in sorted(os.listdir(CONTENT_DATA_DIR)):
+        if not os.path.isdir(get_user_dir(username)):
+            continue
+        ensure_catalog(username)
+        with user_db(username) as conn:
+            rows = conn.execute(
+                f"SELECT dir_name, {', '.join(f'has_{kind}' for kind in kinds)} FROM papers "
+                "WHERE has_origin = 1 ORDER BY updated_at DESC"
+            ).fetchall()
+        for sub_dir, *has_kinds in rows:
+            for kind, has_kind in zip(kinds, has_kinds):
+                key = f"{username}/{sub_dir}:{kind}"
+                if not has_kind and state["failures"].get(key, 0) < PREGEN_MAX_FAILURES:
+                    yield username, sub_dir, kind
+
+class PregenScheduler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._lock_file = None
+        self._route_errors = {}
+        self._backoff = PREGEN_INTERVAL
+
+    def start(self):
+        """
+        実行役のロックが取れた場合だけスケジューラのスレッドを起動する。戻り値: 起動したか
+        """
+        import fcntl
+
+        if self._thread is not None:
+            return True
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        lock_file = open(PREGEN_LOCK_PATH, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.update(current=None)
+        self._thread = threading.Thread(target=self._loop, name="pregen", daemon=True)
+        self._thread.start()
+        print(f">>> 事前生成を開始しました (対象: {', '.join(PREGEN_KINDS)})")
+        return True
+
+    def _loop(self):
+        while True:
+            time.sleep(PREGEN_INTERVAL)
+            try:
+                self.run_once()
+            except Exception:
+                traceback.print_exc()
+
+    def update(self, func=None, **changes):
+        """
+        状態ファイルを読み、changes (と func(state)) を反映して保存する
+        """
+        with self._lock:
+            state = load_pregen_state()
+            state.update(changes)
+            if func is not None:
+                func(state)
+            save_pregen_state(state)
+            return state
+
+    def blocked_reason(self, state):
+        """
+        今は事前生成しない理由を返す (実行してよければ None)
+        """
+        if state["paused"]:
+            return "paused"
+        if pregen_today(state)["cost_usd"] >= pregen_budget(state):
+            return "budget_exhausted"
+        if time.time() < state["backoff_until"]:
+            return "backing_off"
+        snapshot = admission.snapshot()
+        if sum(snapshot["running"].values()) > PREGEN_MAX_INTERACTIVE or any(snapshot["queued"].values()):
+            return "busy"
+        # 前回の確認から LLM のエラー (レート制限など) が増えていたら見送る
+        errors = {route: stats["errors"] for route, stats in get_route_stats().items()}
+        increased = any(count > self._route_errors.get(route, 0) for route, count in errors.items())
+        self._route_errors = errors
+        if increased:
+            return "llm_errors"
+        return None
+
+    def run_once(self):
+        """
+        実行できる状態なら1件生成する。戻り値: 生成した (ユーザー名, ディレクトリ名, 種類) または見送った理由
+        """
+        state = load_pregen_state()
+        reason = self.blocked_reason(state)
+        if reason:
+            return reason
+        candidate = next(iter_pregen_candidates(state), None)
+        if candidate is None:
+            return "idle"
+        self.generate(*candidate)
+        return candidate
+
+    def generate(self, username, sub_dir, kind):
+        spec = PREGEN_SPECS[kind]
+        dir_name = f"{username}/{sub_dir}"
+        key = f"{dir_name}:{kind}"
+        self.update(current={"dir_name": dir_name, "kind": kind, "started_at": time.time()})
+        usage = {}
+        try:
+            with trace_span("pregen.generate", dir_name=dir_name, kind=kind) as span, PaperLock(dir_name):
+                error, dir_name, base_name, md_text = prepare_generation({"dir_name": dir_name}, spec["use_digest"])
+                if error:
+                    raise FileNotFoundError(error)
+                md_filename = os.path.join(CONTENT_DATA_DIR, dir_name, f"{base_name}{spec['suffix']}")
+                if os.path.exists(md_filename):
+                    # カタログが古かっただけなので、反映して LLM は呼ばない
+                    on_artifact_written(dir_name, md_filename)
+                    self.update(current=None)
+                    return False
+                messages = build_generation_messages(spec, md_text)
+                result_text = "".join(stream_llm(spec["route"], messages, spec["temperature"], usage=usage))
+                saved = save_generated_markdown(spec, dir_name, base_name, result_text, overwrite=False)
+                span.set("saved", saved)
         except Exception as e:
-            error_traceback = traceback.format_exc()
-            print(error_traceback)
-            yield f'data: {json.dumps({"error": f"Error during thread generation: {str(e)}"})}\n\n'
-            return
+            traceback.print_exc()
+            self._backoff = min(PREGEN_BACKOFF_MAX, self._backoff * 2)
+
+            def record_failure(state):
+                today = pregen_today(state)
+                today["failed"] += 1
+                today["cost_usd"] += usage.get("cost_usd", 0.0)
+                state["failures"][key] = state["failures"].get(key, 0) + 1
+            self.update(
+                record_failure, current=None, backoff_until=time.time() + self._backoff,
+                last_error={"dir_name": dir_name, "kind": kind, "error": str(e), "time": time.time()},
+            )
+            return False
+
+        self._backoff = PREGEN_INTERVAL
+
+        def record_success(state):
+            today = pregen_today(state)
+            today["done"] += int(saved)
+            today["cost_usd"] += usage.get("cost_usd", 0.0)
+            today["total_tokens"] += usage.get("total_tokens", 0)
+            state["failures"].pop(key, None)
+        self.update(record_success, current=None)
+        print(f">>> 事前生成: {dir_name} ({kind}) ${usage.get('cost_usd', 0.0):.4f}")
+        return saved
+
+    def status(self):
+        state = load_pregen_state()
+        pending = {kind: 0 for kind in PREGEN_KINDS}
+        for _username, _sub_dir, kind in iter_pregen_candidates(state):
+            pending[kind] += 1
+        today = pregen_today(state)
+        return {
+            "enabled": PREGEN_ENABLED,
+            "runner_in_this_process": self._thread is not None,
+            "kinds": PREGEN_KINDS,
+            "paused": state["paused"],
+            "daily_budget_usd": pregen_budget(state),
+            "today": {**today, "cost_usd": round(today["cost_usd"], 6)},
+            "pending": pending,
+            "current": state["current"],
+            "last_error": state["last_error"],
+            "backoff_until": state["backoff_until"] or None,
+            "days": state["days"],
+        }
 
-    return Response(generate(), mimetype='text/event-stream')
+pregen = PregenScheduler()
+
+@app.route('/pregen', methods=['GET', 'POST'])
+def pregen_status():
+    """
+    GET: 事前生成の進捗・残り件数・コスト
+    POST: {"action": "pause" | "resume"} で一時停止・再開、{"daily_budget_usd": N} で1日の上限を変更 (null で既定値)
+    """
+    if not is_admin(request.args.get('username')):
+        return jsonify({"error": "Forbidden"}), 403
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        changes = {}
+        if data.get('action') in ('pause', 'resume'):
+            changes['paused'] = data['action'] == 'pause'
+        elif 'action' in data:
+            return jsonify({"error": "action must be pause or resume"}), 400
+        if 'daily_budget_usd' in data:
+            budget = data['daily_budget_usd']
+            if budget is not None and (not isinstance(budget, (int, float)) or budget < 0):
+                return jsonify({"error": "daily_budget_usd must be a non-negative number or null"}), 400
+            changes['daily_budget_usd'] = budget
+        if changes.get('paused') is False:
+            # 再開時は失敗による待ちも解除する
+            changes['backoff_until'] = 0
+        pregen.update(**changes)
+    return jsonify(pregen.status()), 200
+
+########################################################################
+# 起動時間チェック
+#   重いモジュールが起動時に読み込まれていないか、import 時間が予算内かを確認する
+#   (詳細な内訳は profile_startup.py で確認できる)
+########################################################################
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "2.0"))
+HEAVY_MODULES = ("docling", "docling_core", "langchain_openai", "langgraph", "langchain_community")
+
+def check_startup_budget():
+    """
+    戻り値: (起動にかかった秒数, 起動時に読み込まれた重いモジュールのリスト)
+    """
+    elapsed = time.perf_counter() - BOOT_STARTED_AT
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    if elapsed > STARTUP_BUDGET_SECONDS:
+        print(f">>> 警告: 起動に {elapsed:.2f}s かかりました (予算 {STARTUP_BUDGET_SECONDS:.2f}s)")
+    if loaded:
+        print(f">>> 警告: 起動時に重いモジュールが読み込まれています: {', '.join(loaded)}")
+    return elapsed, loaded
+
+STARTUP_SECONDS, STARTUP_HEAVY_MODULES = check_startup_budget()
 
 ########################################################################
 # メイン
@@ -1282,20 +6041,62 @@ def thread_paper():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--aoai', action='store_true', help="Use AzureOpenAI instead of ChatOpenAI")
+    parser.add_argument('--fake_llm', action='store_true',
+                        help="Use a fake streaming model (for load testing without API calls)")
+    parser.add_argument('--rebuild_catalog', nargs='?', const='*', metavar='USERNAME',
+                        help="Rebuild the paper catalog (all users if USERNAME is omitted) and exit")
+    parser.add_argument('--reexport', nargs='?', const='*', metavar='USERNAME',
+                        help="Re-export images and markdown from the saved docling documents "
+                             "(all users if USERNAME is omitted) and exit")
+    parser.add_argument('--images_only', action='store_true', help="With --reexport, regenerate only the images")
+    parser.add_argument('--force', action='store_true',
+                        help="With --reexport, overwrite edited _origin.md files (the edited version is kept as .bak)")
+    parser.add_argument('--upload_storage', nargs='?', const='*', metavar='USERNAME',
+                        help="Upload existing PDFs and images to STORAGE_BACKEND (all users if USERNAME is omitted) and exit")
     args = parser.parse_args()
 
-    if args.aoai:
-        app.config["CHAT_MODEL"] = AzureChatOpenAI(
-            openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            azure_deployment=os.getenv("AZURE_CHAT_DEPLOYMENT"),
-            temperature=0
-        )
-        print(">>> AzureOpenAI を使用します。")
-    else:
-        app.config["CHAT_MODEL"] = ChatOpenAI(
-            model="gpt-4o-mini",
-            temperature=1
-        )
-        print(">>> ChatOpenAI を使用します。")
+    if args.upload_storage:
+        if not get_storage().remote:
+            raise SystemExit("STORAGE_BACKEND が local のため、アップロードするものはありません。")
+        if args.upload_storage == '*':
+            usernames = [u for u in os.listdir(CONTENT_DATA_DIR) if os.path.isdir(get_user_dir(u))]
+        else:
+            usernames = [args.upload_storage]
+        for username in usernames:
+            sub_dirs = [d for d in sorted(os.listdir(get_user_dir(username))) if os.path.isdir(os.path.join(get_user_dir(username), d))]
+            for sub_dir in sub_dirs:
+                store_paper_artifacts(f"{username}/{sub_dir}")
+            print(f">>> {username}: {len(sub_dirs)} 件の論文の成果物をアップロードしました。")
+        raise SystemExit(0)
+
+    if args.reexport:
+        app.config["CHAT_MODEL_OPTIONS"] = {"use_aoai": args.aoai, "fake_llm": args.fake_llm}
+        if args.reexport == '*':
+            usernames = [u for u in os.listdir(CONTENT_DATA_DIR) if os.path.isdir(get_user_dir(u))]
+        else:
+            usernames = [args.reexport]
+        for username in usernames:
+            done, skipped = reexport_library(username, args.images_only, args.force)
+            print(f">>> {username}: {done} 件を再エクスポートしました ({len(skipped)} 件はスキップ)。")
+        raise SystemExit(0)
+
+    if args.rebuild_catalog:
+        if args.rebuild_catalog == '*':
+            usernames = [u for u in os.listdir(CONTENT_DATA_DIR) if os.path.isdir(get_user_dir(u))]
+        else:
+            usernames = [args.rebuild_catalog]
+        for username in usernames:
+            print(f">>> {username}: {rebuild_catalog(username)} 件の論文をカタログに登録しました。")
+        raise SystemExit(0)
+
+    app.config["CHAT_MODEL_OPTIONS"] = {"use_aoai": args.aoai, "fake_llm": args.fake_llm}
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        # debug のリローダーでは、リクエストを処理する子プロセスでのみ実行する
+        # (リロードで止まった本変換もここで片付く)
+        reconciled = reconcile_ingest_jobs()
+        if reconciled:
+            print(f">>> 中断された本変換を {reconciled} 件片付けました。")
+        if PREGEN_ENABLED:
+            pregen.start()
 
     app.run(host='0.0.0.0', port=5601, debug=True)
@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# server の import 時に作られるディレクトリを一時ディレクトリに向ける
+_tmp_dir = tempfile.mkdtemp()
+os.environ.setdefault("CONTENT_DATA_DIR", os.path.join(_tmp_dir, "users"))
+os.environ.setdefault("CACHE_DIR", os.path.join(_tmp_dir, "cache"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def content_dir(tmp_path, monkeypatch):
+    """
+    CONTENT_DATA_DIR をテストごとの一時ディレクトリに差し替える
+    """
+    import server
+
+    path = tmp_path / "users"
+    path.mkdir()
+    monkeypatch.setattr(server, "CONTENT_DATA_DIR", str(path))
+    return path
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import server
+
+
+def test_atomic_write_replaces_file(tmp_path):
+    path = tmp_path / "paper_origin.md"
+    path.write_text("old", encoding="utf-8")
+
+    with server.atomic_write(str(path)) as f:
+        f.write("new")
+        # 書いている間、読み手には元の内容が見える
+        assert path.read_text(encoding="utf-8") == "old"
+
+    assert path.read_text(encoding="utf-8") == "new"
+    assert os.listdir(tmp_path) == ["paper_origin.md"]
+
+
+def test_atomic_write_keeps_original_on_error(tmp_path):
+    path = tmp_path / "paper_origin.md"
+    path.write_text("old", encoding="utf-8")
+
+    with pytest.raises(RuntimeError):
+        with server.atomic_write(str(path)) as f:
+            f.write("half")
+            raise RuntimeError("failed while writing")
+
+    assert path.read_text(encoding="utf-8") == "old"
+    assert os.listdir(tmp_path) == ["paper_origin.md"]
+
+
+def test_atomic_write_binary(tmp_path):
+    path = tmp_path / "picture-1.png"
+    with server.atomic_write(str(path), "wb") as f:
+        f.write(b"\x89PNG")
+    assert path.read_bytes() == b"\x89PNG"
+
+
+def test_paper_lock_shared_and_exclusive(content_dir):
+    (content_dir / "alice" / "paper").mkdir(parents=True)
+
+    reader = server.PaperLock("alice/paper").acquire()
+    other_reader = server.PaperLock("alice/paper").acquire(timeout=0)
+    with pytest.raises(server.PaperBusy):
+        server.PaperLock("alice/paper", exclusive=True).acquire(timeout=0)
+
+    reader.release()
+    other_reader.release()
+    writer = server.PaperLock("alice/paper", exclusive=True).acquire(timeout=0)
+    with pytest.raises(server.PaperBusy):
+        server.PaperLock("alice/paper/images").acquire(timeout=0)
+    writer.release()
+    # 2回目の release は何もしない
+    writer.release()
+
+
+def test_paper_lock_on_removed_directory(content_dir):
+    (content_dir / "alice" / "paper").mkdir(parents=True)
+
+    writer = server.PaperLock("alice/paper", exclusive=True).acquire()
+    (content_dir / "alice" / "paper").rmdir()
+    writer.release(remove=True)
+
+    assert not (content_dir / "alice" / ".paper.lock").exists()
+    with pytest.raises(FileNotFoundError):
+        server.PaperLock("alice/paper").acquire(timeout=0)
+
+
+def test_paper_lock_rejects_invalid_dir_name():
+    with pytest.raises(ValueError):
+        server.PaperLock("paper")
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+import server
+
+
+def open_checkpoint(tmp_path, source="v1", resume=True):
+    return server.GenerationCheckpoint(str(tmp_path / "paper_trans.md"), source).open(resume)
+
+
+def test_split_resume_point_cuts_before_last_heading():
+    text = "# Title\n\nintro\n\n## 2 Method\n\nhalf"
+    assert server.split_resume_point(text) == ("# Title\n\nintro\n\n", "## 2 Method")
+    assert server.split_resume_point("# Title\n\nonly the first section") == ("", None)
+    assert server.split_resume_point("no heading") == ("", None)
+
+
+def test_completed_checkpoint_replaces_markdown(tmp_path):
+    checkpoint = open_checkpoint(tmp_path)
+    checkpoint.append("```markdown\n# Title\n\nbody\n```")
+    checkpoint.complete(strip_fence=True)
+
+    assert (tmp_path / "paper_trans.md").read_text(encoding="utf-8").strip() == "# Title\n\nbody"
+    assert not (tmp_path / f"paper_trans.md{server.PARTIAL_SUFFIX}").exists()
+    assert not (tmp_path / f"paper_trans.md{server.CHECKPOINT_SUFFIX}").exists()
+
+
+def test_interrupted_checkpoint_resumes_after_last_finished_section(tmp_path):
+    checkpoint = open_checkpoint(tmp_path)
+    checkpoint.append("# Title\n\nintro\n\n## 2 Method\n\nhal")
+    checkpoint.abort(RuntimeError("disconnected"))
+
+    meta = json.loads((tmp_path / f"paper_trans.md{server.CHECKPOINT_SUFFIX}").read_text(encoding="utf-8"))
+    assert meta["state"] == "interrupted"
+    assert meta["error"] == "disconnected"
+    assert not (tmp_path / "paper_trans.md").exists()
+
+    resumed = open_checkpoint(tmp_path)
+    assert resumed.prefix == "# Title\n\nintro\n\n"
+    assert resumed.resume_heading == "## 2 Method"
+    resumed.append("## 2 Method\n\nfull")
+    resumed.complete()
+    assert (tmp_path / "paper_trans.md").read_text(encoding="utf-8") == "# Title\n\nintro\n\n## 2 Method\n\nfull"
+
+
+@pytest.mark.parametrize("source, resume", [("v2", True), ("v1", False)])
+def test_checkpoint_starts_over_when_source_changed_or_not_resuming(tmp_path, source, resume):
+    checkpoint = open_checkpoint(tmp_path)
+    checkpoint.append("# Title\n\nintro\n\n## 2 Method\n\nhal")
+    checkpoint.abort()
+
+    restarted = open_checkpoint(tmp_path, source, resume)
+    assert restarted.prefix == ""
+    assert restarted.resume_heading is None
+    restarted.close()
+    assert (tmp_path / f"paper_trans.md{server.PARTIAL_SUFFIX}").read_text(encoding="utf-8") == ""
+
+
+def test_checkpoint_rejects_concurrent_generation(tmp_path):
+    checkpoint = open_checkpoint(tmp_path)
+    try:
+        with pytest.raises(server.GenerationInProgress):
+            open_checkpoint(tmp_path)
+    finally:
+        checkpoint.close()
@@ -0,0 +1,46 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("heading", [
+    "References",
+    "REFERENCES",
+    "7 References",
+    "7. References",
+    "Bibliography",
+    "Appendix",
+    "Appendix A: Proofs",
+    "A Appendix",
+    "A.1 Supplementary Material",
+    "Appendices",
+    "参考文献",
+    "付録",
+])
+def test_tail_heading_matches(heading):
+    assert server.DIGEST_TAIL_HEADING.match(heading)
+
+
+@pytest.mark.parametrize("heading", [
+    "Preferences and Reward Modeling",
+    "Bappendix Study",
+    "3 Preferences",
+    "Referenced Works in Practice",
+    "Supplementarity of Features",
+    "Introduction",
+])
+def test_tail_heading_ignores_body_sections(heading):
+    assert not server.DIGEST_TAIL_HEADING.match(heading)
+
+
+def test_digest_keeps_sections_before_references():
+    md_text = (
+        "# 1 Introduction\nintro text\n\n"
+        "# 2 Preferences and Reward Modeling\nreward text\n\n"
+        "# 3 Results\nresult text\n\n"
+        "# References\n[1] cited paper\n"
+    )
+    digest = server.build_paper_digest(md_text)
+    headings = [s["heading"] for s in digest["sections"]]
+    assert headings == ["1 Introduction", "2 Preferences and Reward Modeling", "3 Results"]
+    assert "cited paper" not in digest["text"]
@@ -0,0 +1,41 @@
+import server
+
+
+def make_running_paper(content_dir, sub_dir, preview_saved):
+    (content_dir / "alice" / sub_dir).mkdir(parents=True)
+    dir_name = f"alice/{sub_dir}"
+    server.write_ingest_state(dir_name, {"state": "running", "base_name": "paper", "preview_saved": preview_saved})
+    return dir_name
+
+
+def test_interrupted_ingest_with_preview_is_marked_failed(content_dir):
+    dir_name = make_running_paper(content_dir, "with_preview", True)
+
+    state = server.load_ingest_state(dir_name)
+
+    assert state["state"] == "failed"
+    assert state["error"]
+    assert server.read_ingest_state(dir_name)["state"] == "failed"
+
+
+def test_interrupted_ingest_without_preview_is_removed(content_dir):
+    dir_name = make_running_paper(content_dir, "no_preview", False)
+
+    assert server.load_ingest_state(dir_name) is None
+    assert not (content_dir / "alice" / "no_preview").exists()
+    assert not (content_dir / "alice" / ".no_preview.lock").exists()
+
+
+def test_running_ingest_is_left_alone(content_dir):
+    dir_name = make_running_paper(content_dir, "running", False)
+
+    # 変換中のプロセスは論文の共有ロックを持っている
+    lock = server.PaperLock(dir_name).acquire()
+    try:
+        assert server.reconcile_ingest_jobs() == 0
+        assert server.load_ingest_state(dir_name)["state"] == "running"
+    finally:
+        lock.release()
+
+    assert server.reconcile_ingest_jobs() == 1
+    assert not (content_dir / "alice" / "running").exists()
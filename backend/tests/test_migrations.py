@@ -0,0 +1,73 @@
+import pytest
+
+import server
+
+
+def open_db(tmp_path):
+    return server.open_sqlite_connection(str(tmp_path / "chat_history.db"))
+
+
+def schema_versions(conn):
+    return [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+
+
+def table_names(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_migrations_create_latest_schema(tmp_path):
+    conn = open_db(tmp_path)
+    server.migrate_db(conn, server.CHAT_DB_MIGRATIONS)
+
+    assert schema_versions(conn) == [version for version, _ in server.CHAT_DB_MIGRATIONS]
+    assert {"chat_sessions", "chat_messages", "papers", "catalog_state"} <= table_names(conn)
+    # v3: auto_vacuum = INCREMENTAL (VACUUM 後に反映される)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    # 外部キー制約は元に戻っている
+    assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+
+def test_migrations_are_applied_once(tmp_path):
+    conn = open_db(tmp_path)
+    server.migrate_db(conn, server.CHAT_DB_MIGRATIONS)
+    server.migrate_db(conn, server.CHAT_DB_MIGRATIONS)
+
+    assert len(schema_versions(conn)) == len(server.CHAT_DB_MIGRATIONS)
+
+
+def test_v2_drops_orphan_messages_and_cascades(tmp_path):
+    conn = open_db(tmp_path)
+    server.migrate_db(conn, server.CHAT_DB_MIGRATIONS[:1])
+
+    # v1 の DB には、セッションを消した後のメッセージが残っていることがある
+    conn.execute("PRAGMA foreign_keys = OFF")
+    session_id = conn.execute("INSERT INTO chat_sessions (dir_name) VALUES ('alice/paper')").lastrowid
+    conn.execute("INSERT INTO chat_messages (session_id, role, content) VALUES (?, 'user', 'kept')", (session_id,))
+    conn.execute("INSERT INTO chat_messages (session_id, role, content) VALUES (?, 'user', 'orphan')", (session_id + 1,))
+    conn.commit()
+    conn.execute("PRAGMA foreign_keys = ON")
+
+    server.migrate_db(conn, server.CHAT_DB_MIGRATIONS)
+
+    assert [row[0] for row in conn.execute("SELECT content FROM chat_messages")] == ["kept"]
+    conn.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+    conn.commit()
+    assert conn.execute("SELECT COUNT(*) FROM chat_messages").fetchone()[0] == 0
+
+
+def test_failed_migration_is_rolled_back(tmp_path):
+    def broken(conn):
+        conn.execute("CREATE TABLE half_done (x INTEGER)")
+        raise RuntimeError("broken migration")
+
+    conn = open_db(tmp_path)
+    with pytest.raises(RuntimeError):
+        server.migrate_db(conn, server.CHAT_DB_MIGRATIONS[:1] + [(2, broken)])
+
+    assert schema_versions(conn) == [1]
+    assert "half_done" not in table_names(conn)
+    assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+    # 直したマイグレーションは続きから適用される
+    server.migrate_db(conn, server.CHAT_DB_MIGRATIONS)
+    assert schema_versions(conn) == [version for version, _ in server.CHAT_DB_MIGRATIONS]
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+def test_resolve_markdown_path(content_dir):
+    assert server.resolve_markdown_path("alice/paper", "paper_origin.md") == \
+        os.path.join(str(content_dir), "alice", "paper", "paper_origin.md")
+
+
+@pytest.mark.parametrize("dir_name, file_name", [
+    ("/alice/paper", "paper_origin.md"),
+    ("alice/../bob", "paper_origin.md"),
+    ("alice\\paper", "paper_origin.md"),
+    ("alice/paper", "../paper_origin.md"),
+    ("alice/paper", "sub/paper_origin.md"),
+    ("alice/paper", "paper.pdf"),
+    ("alice", "paper_origin.md"),
+    ("", "paper_origin.md"),
+])
+def test_resolve_markdown_path_rejects_invalid(content_dir, dir_name, file_name):
+    assert server.resolve_markdown_path(dir_name, file_name) is None
+
+
+def test_contents_serves_files_inside_content_dir(content_dir, client):
+    paper_dir = content_dir / "alice" / "paper"
+    paper_dir.mkdir(parents=True)
+    (paper_dir / "paper.pdf").write_bytes(b"%PDF-1.4")
+    (paper_dir / "picture-1.png").write_bytes(b"\x89PNG")
+
+    response = client.get("/contents/alice/paper/paper.pdf")
+    assert response.status_code == 200
+    assert response.cache_control.max_age == server.PDF_CACHE_MAX_AGE
+    assert client.get(
+        "/contents/alice/paper/paper.pdf", headers={"If-None-Match": response.headers["ETag"]}
+    ).status_code == 304
+
+    response = client.get("/contents/alice/paper/picture-1.png")
+    assert response.status_code == 200
+    assert response.cache_control.no_cache
+
+
+def test_contents_rejects_sibling_directory(content_dir, monkeypatch):
+    # CONTENT_DATA_DIR と同じ接頭辞を持つ隣のディレクトリ (users-x/) は配信しない
+    sibling = content_dir.parent / f"{content_dir.name}-x"
+    sibling.mkdir()
+    (sibling / "secret.pdf").write_bytes(b"%PDF-1.4")
+    fetched = []
+    monkeypatch.setattr(server, "ensure_local_artifact", lambda path: fetched.append(path) or True)
+
+    with server.app.test_request_context("/"):
+        response, status = server.serve_content_files(f"../{sibling.name}/secret.pdf")
+    assert status == 400
+    assert fetched == []
+
+
+def test_ingest_state_path_stays_inside_content_dir(content_dir):
+    assert server.get_ingest_state_path("alice/paper") == \
+        os.path.join(str(content_dir), "alice", "paper", server.INGEST_STATE_FILE)
+    for dir_name in ["alice/../bob", "alice/paper/sub", "alice\\paper", "alice", None]:
+        assert server.get_ingest_state_path(dir_name) is None
@@ -0,0 +1,26 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("line", [
+    "1 Introduction",
+    "3.2 Experimental Setup",
+    "IV. Results",
+    "Abstract",
+    "ABSTRACT",
+    "Related Work",
+    "Acknowledgments",
+])
+def test_preview_heading_matches(line):
+    assert server.PREVIEW_HEADING.match(line)
+
+
+@pytest.mark.parametrize("line", [
+    "10 times faster than the baseline, and",
+    "2 layers with dropout",
+    "iv. results",
+    "The introduction of attention",
+])
+def test_preview_heading_ignores_body_text(line):
+    assert not server.PREVIEW_HEADING.match(line)
@@ -50,6 +50,10 @@ import Chat from './Chat';
 // PDF.js のワーカーを設定
 pdfjs.GlobalWorkerOptions.workerSrc = '/pdf.worker.js';
 
+// 本変換 (ingest_events) に繋がらない・途中で切れた場合の再接続の間隔と、続けて失敗できる回数
+const INGEST_RETRY_DELAY_MS = 3000;
+const INGEST_MAX_RETRIES = 20;
+
 const PaperPreview = () => {
   // URL から username を取得
   const { username } = useParams();
@@ -113,6 +117,16 @@ const PaperPreview = () => {
   const [showExplainButton, setShowExplainButton] = useState(true);
   const [showThreadButton, setShowThreadButton] = useState(true);
 
+  // バックグラウンド変換の完了時に、表示中の論文・マークダウンを確認するための参照
+  const selectedDirectoryRef = useRef(null);
+  const currentMarkdownTypeRef = useRef('origin');
+  const isModifiedRef = useRef(false);
+  useEffect(() => {
+    selectedDirectoryRef.current = selectedDirectory;
+    currentMarkdownTypeRef.current = currentMarkdownType;
+    isModifiedRef.current = isModified;
+  }, [selectedDirectory, currentMarkdownType, isModified]);
+
   // PDF.js のコンテナ幅をアップデート
   const updateContainerWidth = () => {
     if (pdfContainerRef.current) {
@@ -500,6 +514,91 @@ const PaperPreview = () => {
     }
   }, [content, isAppending]);
 
+  // プレビュー表示後、バックグラウンドの本変換 (docling + LLM) を ingest_events で追い、
+  // 終わったら (同じ論文の原文を表示中で、編集していなければ) _origin.md を読み直す。
+  // 接続できない・完了前に切れた場合は INGEST_RETRY_DELAY_MS ごとに繋ぎ直す
+  // (別のワーカーに繋がった場合も、サーバーは状態ファイルから進捗を送る)
+  const followIngest = async (dirName, baseFileName) => {
+    let failures = 0;
+    let finished = false;
+    let failed = '';
+
+    while (!finished && failures < INGEST_MAX_RETRIES) {
+      if (failures > 0) {
+        await new Promise((resolve) => setTimeout(resolve, INGEST_RETRY_DELAY_MS));
+      }
+      try {
+        const response = await fetch(
+          `http://${import.meta.env.VITE_APP_IP}:5601/ingest_events?dir_name=${encodeURIComponent(dirName)}`,
+          {
+            method: 'GET',
+            mode: 'cors',
+          }
+        );
+        if (!response.ok) {
+          failures += 1;
+          continue;
+        }
+        failures = 0;
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder('utf-8');
+        let buffer = '';
+
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) break;
+
+          const chunk = decoder.decode(value, { stream: true });
+          buffer += chunk;
+
+          let messages = buffer.split('\n\n');
+          buffer = messages.pop();
+
+          for (const message of messages) {
+            if (!message.startsWith('data:')) continue;
+            try {
+              const data = JSON.parse(message.slice('data: '.length));
+              // 本文は完了後にファイルから読み直すので、ここでは流れてくる本文を表示に使わない
+              if (data.error) {
+                failed = data.error;
+                finished = true;
+              } else if (data.dir_name) {
+                finished = true;
+              }
+            } catch (e) {
+              console.error('Error parsing data:', e);
+            }
+          }
+        }
+        if (!finished) failures += 1;
+      } catch (error) {
+        console.error('Error following ingest:', error);
+        failures += 1;
+      }
+    }
+
+    if (!finished) {
+      console.error('Gave up following the background conversion:', dirName);
+      return;
+    }
+    if (failed) {
+      console.error('Background conversion failed:', failed);
+      return;
+    }
+    if (
+      selectedDirectoryRef.current === dirName &&
+      currentMarkdownTypeRef.current === 'origin' &&
+      !isModifiedRef.current
+    ) {
+      try {
+        await fetchMarkdownContent(dirName, baseFileName, 'origin');
+      } catch (error) {
+        console.error('Error following ingest:', error);
+      }
+    }
+  };
+
   // PDF/URLでpdf2markdown
   useEffect(() => {
     const processPdf = async () => {
@@ -551,7 +650,10 @@ const PaperPreview = () => {
 
           let receivedDirName = '';
           let receivedBaseFileName = '';
+          let receivedPreview = false;
           let inLLMOutput = false;
+          // プレビューは1イベントが大きいので、読み込みの途中で切れたイベントは次に持ち越す
+          let buffer = '';
 
           setIsAppending(true);
 
@@ -560,7 +662,10 @@ const PaperPreview = () => {
             if (done) break;
 
             const chunk = decoder.decode(value, { stream: true });
-            const lines = chunk.split('\n\n');
+            buffer += chunk;
+
+            const lines = buffer.split('\n\n');
+            buffer = lines.pop();
 
             for (const line of lines) {
               if (line.startsWith('data:')) {
@@ -601,6 +706,8 @@ const PaperPreview = () => {
                   if (data.dir_name) {
                     receivedDirName = data.dir_name;
                     receivedBaseFileName = data.base_file_name;
+                    // プレビューの後、サーバーは本変換を待たずにストリームを閉じる
+                    receivedPreview = Boolean(data.preview);
                   }
                 } catch (e) {
                   console.error('Error parsing data:', e);
@@ -678,6 +785,10 @@ const PaperPreview = () => {
           await fetchAgentState(dirName);
           await fetchChatSessions(dirName);
 
+          if (receivedPreview) {
+            followIngest(dirName, baseFileName);
+          }
+
         } catch (error) {
           console.error('Error processing PDF:', error);
           alert('処理中にエラーが発生しました: ' + error.message);